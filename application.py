@@ -19,34 +19,109 @@ Functionality:
 """
 
 
+#taken before the imports, they are part of the startup time
+import time
+STARTED = time.time()
+
 import tkinter as tk
 from tkinter import ttk
 from tkinter import filedialog
-from PIL import Image, ImageTk
 from tkinter import font as tkfont
-import cv2
-import numpy as np
-import matplotlib.pyplot as plt
-from multiprocessing import Pool
-import threading
-import csv
-import re
+import multiprocessing
 from tkinter import messagebox
-import psutil
+import argparse
+import sqlite3
 import sys
 import os
+import bisect
+
+#opencv, numpy and PIL come with pipeline, batch, cache, export and watch, they take most of the start
+#so these are imported on first use and warm_up_job loads them once the window is shown
+from image_list import VirtualListbox
+from jobs import EVENT_POLL_MS, JobRunner
+from profiling import STARTUP_ENVIRONMENT_VARIABLE, StageSummary, StartupLog, TraceWriter, trace_path_from_environment
+from scheduler import ImageScheduler
+
+
+#images read ahead of the workers while browsing, an image read ahead is processed before a newly viewed one
+BROWSE_PREFETCH = 2
+
+
+class ProgressWindow:
+    #progress of a background job, the app stays usable while it is open
+    def __init__(self, root, title, text, job, show_stages=False):
+        self.job = job
+        self.text = text
+        self.window = tk.Toplevel(root)
+        self.window.title(title)
+        #calculate window position to center it on the screen
+        window_width = 300
+        #room for the stage summary when profiling
+        window_height = 240 if show_stages else 140
+        screen_width = root.winfo_screenwidth()
+        screen_height = root.winfo_screenheight()
+        x_coordinate = (screen_width - window_width) // 2
+        y_coordinate = (screen_height - window_height) // 2
+        self.window.geometry(f"{window_width}x{window_height}+{x_coordinate}+{y_coordinate}")
+        self.window.transient(root)  #set the progress window as transient to the main window
+        #closing the window cancels the job
+        self.window.protocol("WM_DELETE_WINDOW", self.cancel)
+
+        #add text to the window
+        self.text_label = tk.Label(self.window, text=text, fg="white", font=("Century Gothic", 10))
+        self.text_label.pack(pady=10)
+
+        self.progress_bar = ttk.Progressbar(self.window, mode="determinate", length=250)
+        self.progress_bar.pack(pady=5)
+
+        buttons_frame = tk.Frame(self.window)
+        buttons_frame.pack(pady=5)
+        self.pause_button = ttk.Button(buttons_frame, text="Pause", command=self.toggle_pause, style="Custom.TButton")
+        self.pause_button.pack(side=tk.LEFT, padx=5)
+        self.cancel_button = ttk.Button(buttons_frame, text="Cancel", command=self.cancel, style="Custom.TButton")
+        self.cancel_button.pack(side=tk.LEFT, padx=5)
+
+        #slowest stages while profiling
+        self.stage_summary_label = None
+        if show_stages:
+            self.stage_summary_label = tk.Label(self.window, text="", fg="white", font=("Century Gothic", 8), justify="left")
+            self.stage_summary_label.pack(pady=5)
+
+    def set_progress(self, done, total):
+        self.progress_bar["value"] = done / total * 100 if total else 100
+        if not self.job.cancelled:
+            self.text_label.config(text=f"{self.text} {done}/{total}" + (" (paused)" if self.job.paused else ""))
+
+    def show_stages(self, lines):
+        if self.stage_summary_label:
+            self.stage_summary_label.config(text="\n".join(lines))
+
+    def toggle_pause(self):
+        if self.job.paused:
+            self.job.resume()
+            self.pause_button.config(text="Pause")
+        else:
+            #the images already on the workers still finish
+            self.job.pause()
+            self.pause_button.config(text="Resume")
 
+    def cancel(self):
+        self.job.cancel()
+        self.text_label.config(text="Cancelling...")
+        self.pause_button.config(state="disabled")
+        self.cancel_button.config(state="disabled")
 
-
-#for sorting the image filenames
-def natural_sort_key(s):
-    #split the string into a list of strings and integers
-    return [int(text) if text.isdigit() else text.lower() for text in re.split(r'(\d+)', s)]
+    def close(self):
+        self.window.destroy()
 
 
 class ImageSelectorApp:
-    def __init__(self, root):
+    #folder is opened once the window is shown, startup_log (profiling.StartupLog) records the start
+    #quit_after_first_result closes the app once the first result is shown, for the startup benchmark
+    def __init__(self, root, folder=None, startup_log=None, quit_after_first_result=False):
         self.root = root
+        self.startup_log = startup_log
+        self.quit_after_first_result = quit_after_first_result
         self.root.title("PhenoSnap Cassava")
         
         #for deployment
@@ -58,10 +133,9 @@ class ImageSelectorApp:
             #if running in a normal Python environment
             base_path = os.path.abspath(os.path.dirname(__file__))
         
-        #load the icon image
-        icon_path = os.path.join(base_path, "resources", "icon.ico")
-        icon_image = Image.open(icon_path)
-        icon_photo = ImageTk.PhotoImage(icon_image)
+        #load the icon image, tk reads the gif without PIL
+        icon_path = os.path.join(base_path, "resources", "icon.gif")
+        icon_photo = tk.PhotoImage(file=icon_path)
         self.root.iconphoto(False, icon_photo)
         
         #center window on the screen
@@ -89,6 +163,7 @@ class ImageSelectorApp:
         forest_dark_tcl_path = os.path.join(base_dir, "forest-dark.tcl")
 
         #import the dark theme tcl file
+        #it reads the images from forest-dark-packed.png when it is there (see pack_theme.py)
         self.root.tk.call("source", forest_dark_tcl_path)
         
         #set the dark theme with the theme_use method
@@ -97,6 +172,8 @@ class ImageSelectorApp:
         #create variables to store image paths and current index
         self.image_paths = []
         self.current_index = 0
+        #opened or watched folder, the images are named by their path below it on the csv files and exports
+        self.folder_path = None
         
         #create a Frame for input widgets
         self.widgets_frame = tk.Frame(root, bg="#4C4A48", width=300, height=600)
@@ -114,10 +191,22 @@ class ImageSelectorApp:
         self.open_folder_button = ttk.Button(self.widgets_frame, text="Open Folder", command=self.open_folder, style="Custom.TButton")
         self.open_folder_button.pack(padx=5, pady=10, fill=tk.X)
 
+        #button to watch the folder the imaging station writes to
+        self.watch_folder_button = ttk.Button(self.widgets_frame, text="Watch Folder", command=self.toggle_watch, style="Custom.TButton")
+        self.watch_folder_button.pack(padx=5, pady=(0, 10), fill=tk.X)
+
         #button to manually select images
         self.save_images_button = ttk.Button(self.widgets_frame, text="Save Images", command=self.save_images, style="Custom.TButton",state = "disabled")
         self.save_images_button.pack(padx=5, fill=tk.X)
 
+        #format of the saved images, the quality is the default of the format when None
+        #the formats are listed when the list is opened, export.py is not needed before
+        self.export_format = tk.StringVar(value="jpeg")
+        self.export_quality = None
+        self.export_format_combobox = ttk.Combobox(self.widgets_frame, textvariable=self.export_format, values=["jpeg"],
+                                                   postcommand=self.list_export_formats, state="readonly")
+        self.export_format_combobox.pack(padx=5, pady=5, fill=tk.X)
+
         #separator
         separator = ttk.Separator(self.widgets_frame, orient="horizontal")
         separator.pack(fill="x", pady=10)
@@ -130,14 +219,10 @@ class ImageSelectorApp:
         separator = ttk.Separator(self.widgets_frame, orient="horizontal")
         separator.pack(fill="x", pady=10)
 
-        #listbox to display selected image names
-        self.image_listbox = tk.Listbox(self.widgets_frame, selectmode=tk.SINGLE, bg="#4C4A48")
-        self.image_listbox.pack(side=tk.LEFT, padx=5, pady=5, fill=tk.BOTH, expand=True)
-
-        #scrollbar for the listbox
-        scrollbar = ttk.Scrollbar(self.widgets_frame, orient=tk.VERTICAL, command=self.image_listbox.yview)
-        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-        self.image_listbox.config(yscrollcommand=scrollbar.set)
+        #list to display the image names with its scrollbar
+        #only the visible rows are inserted, so a folder of any size lists at once
+        self.image_listbox = VirtualListbox(self.widgets_frame, command=self.display_selected_image, bg="#4C4A48")
+        self.image_listbox.pack(padx=5, pady=5, fill=tk.BOTH, expand=True)
 
         #create a Frame for the canvas and navigation buttons
         self.canvas_frame = tk.Frame(root, width=700, height=600)
@@ -183,403 +268,609 @@ class ImageSelectorApp:
         self.next_button = ttk.Button(self.canvas_frame, text="Next", command=self.next_image, style="Accent.TButton")
         self.next_button.pack(side=tk.LEFT, padx=10, pady=10, fill=tk.X)
 
-        #image cache
-        self.image_cache = {}
+        #results of previous sessions, re-opened folders only process new or changed images
+        #opened by warm_up_job with the number of worker processes used when processing a folder
+        self.result_store = None
+        self.num_workers = 1
+
+        #image cache, evicted images are reloaded or processed again when needed
+        #and small previews shown on the canvas, the full images are only needed for export
+        #both are made by reset_session when a folder is opened
+        self.image_cache = None
+        self.preview_cache = None
         self.leaf_area_dict = {}
         self.count_processed_images = 0
 
-        #placeholder for the progress bar
-        self.progress_bar = ttk.Progressbar(self.root, mode="indeterminate", length=200)
+        #stage timings are only traced when PHENOSCAN_TRACE names a trace file
+        self.trace_path = trace_path_from_environment()
+
+        #images whose result can be shown, and images that could not be processed
+        self.ready = set()
+        self.failed = set()
+        #images processed again because their result was lost (see reprocess_images)
+        self.reprocessing = set()
+        #images whose preview is loaded on a job (see request_preview)
+        self.loading_previews = set()
+        #bumped by reset_session, results of the images of a previous folder are dropped
+        self.session = 0
+        #order in which the images of the opened folder are processed, the viewed image first
+        self.scheduler = None
+
+        #processing, saving and watching run as background jobs, their events are drained on the main loop
+        self.jobs = JobRunner()
+        self.process_job = None
+        self.watch_job = None
+        #job whose images are listed
+        self.active_job = None
+        self.root.after(EVENT_POLL_MS, self.poll_jobs)
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+
+        #the heavy modules are loaded once the window is drawn, the folder opened after them
+        self.warm_up = None
+        self.root.after_idle(self.on_window_shown, folder)
+
+    #runs once the window is drawn
+    def on_window_shown(self, folder):
+        if self.startup_log:
+            self.startup_log.mark('window')
+        self.warm_up = self.jobs.submit(self.warm_up_job)
+        if folder:
+            self.open_folder(folder)
+
+    #runs on a job thread while the user looks for a folder: imports opencv, numpy and PIL through
+    #the modules using them and opens the result store
+    def warm_up_job(self, job):
+        import pipeline, export, watch
+        from PIL import ImageTk
+        from batch import default_workers
+        self.num_workers = default_workers()
+        self.result_store = self.open_result_store()
+        if self.startup_log:
+            self.startup_log.mark('warm')
+
+    #whether warm_up_job finished, the main loop never waits for it and the caller tries again later
+    #it is only still running when a folder is opened right after the start
+    def warmed_up(self):
+        return self.warm_up is not None and self.warm_up.future.done()
+
+    def list_export_formats(self):
+        from export import EXPORT_FORMATS
+        self.export_format_combobox.config(values=list(EXPORT_FORMATS))
     
-    #filtering to keep mask larger than said threshold
-    def filter_connected_components(self,mask, min_component_size):
-        #perform connected component analysis
-        num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=8)
-
-        #create a mask to keep only components larger than the threshold
-        filtered_mask = np.zeros_like(mask)
-        for label in range(1, num_labels):  #skip background label 0
-            if stats[label, cv2.CC_STAT_AREA] >= min_component_size:
-                filtered_mask[labels == label] = 255
-        
-        return filtered_mask
-    
-    #count pixels
-    def count_pixels_in_hull(self,image, hull):
-        #create an empty mask
-        mask = np.zeros(image.shape[:2], dtype=np.uint8)
-        
-        #fill the hull with white color on the mask
-        cv2.drawContours(mask, [hull], -1, (255), thickness=cv2.FILLED)
-        
-        #count the number of non-zero pixels in the mask
-        pixel_count = cv2.countNonZero(mask)
-        
-        return pixel_count
-
-    #image processing
+    #open the persistent result store, the app still works without it
+    def open_result_store(self):
+        from cache import ResultStore
+        try:
+            return ResultStore()
+        except (OSError, sqlite3.Error) as e:
+            print("Cannot open the result store:", e)
+            return None
+
+    #open the results file of a folder, the app still works without it
+    #images of subfolders are named with their subfolder so the ones sharing a filename can be told apart
+    #sync_every=1 makes every result reach the disk before it is shown, the default syncs in groups
+    def open_results_writer(self, folder_path, sync_every=20):
+        from export import ResultsWriter, session_results_path
+        try:
+            return ResultsWriter(session_results_path(folder_path), sync_every=sync_every, root_path=folder_path)
+        except OSError as e:
+            print("Cannot open the results file:", e)
+            return None
+
+    #open the trace file when profiling is on, the app still works without it
+    def open_trace_writer(self):
+        if not self.trace_path:
+            return None
+        try:
+            return TraceWriter(self.trace_path)
+        except OSError as e:
+            print("Cannot open the trace file:", e)
+            return None
+
+    #image processing, the pipeline itself lives on pipeline.py
+    #runs on the job threads and touches no state of the GUI, the result is kept on the store
+    #returns the processed image and its metrics, the caller posts the metrics to the main loop
     def process_image(self,image_path):
-        #read image using cv 
-        #then apply gaussian blur
-        #then convert it to hsv format for easy identification
-        image = cv2.imread(image_path)
-        blurred_image = cv2.GaussianBlur(image, (5, 5), 0)
-        hsv_image = cv2.cvtColor(blurred_image, cv2.COLOR_BGR2HSV)
-
-        #------------------------morph first before masking-----------------
-        kernel = np.ones((9, 9), np.uint8)
-        green_mask = cv2.morphologyEx(hsv_image, cv2.MORPH_OPEN, kernel)
-        green_mask = cv2.inRange(green_mask, (34, 25, 25), (86, 255,255))
-
-        #apply filtering
-        #costumized threshold (you can adjust it)
-        min_component_size = 20000
-        green_mask = self.filter_connected_components(green_mask, min_component_size)
-
-        #find contours in the green mask
-        contours, _ = cv2.findContours(green_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-        #compute the convex hull for each contour
-        hulls = [cv2.convexHull(contour) for contour in contours]
-
-        #--------------------------for convex hull----------------------------
-        #function to compute the distance between two convex hulls
-        def hulls_close(hull1, hull2, max_distance):
-            for point1 in hull1:
-                for point2 in hull2:
-                    distance = np.linalg.norm(point1[0] - point2[0])
-                    if distance < max_distance:
-                        return True
-            return False
-
-        #merge convex hulls if they are close to each other
-        def merge_hulls(hulls, max_distance):
-            merged = []
-            while hulls:
-                current_hull = hulls.pop(0)
-                to_merge = [current_hull]
-                i = 0
-                while i < len(hulls):
-                    if hulls_close(current_hull, hulls[i], max_distance):
-                        to_merge.append(hulls.pop(i))
-                    else:
-                        i += 1
-                merged_hull = np.vstack(to_merge)
-                merged.append(cv2.convexHull(merged_hull))
-            return merged if merged else hulls  #return original hulls if no merges occurred
-
-        #merging hulls
-        #customized threshold value (you can adjust it)
-        max_distance = 500  #set your desired maximum distance here
-        merged_hulls = merge_hulls(hulls, max_distance)
-
-
-        #find the largest hull
-        largest_hull = max(merged_hulls, key=cv2.contourArea)
-
-        #create a mask representing the largest hull
-        largest_hull_mask = np.zeros_like(green_mask)
-        cv2.drawContours(largest_hull_mask, [largest_hull], -1, (255), thickness=cv2.FILLED)
-
-
-        #perform bitwise AND operation between green mask and largest hull mask
-        green_mask = cv2.bitwise_and(green_mask, largest_hull_mask)
-
-
-        # Slice the green
-        imask = green_mask>0
-        green = np.zeros_like(image, np.uint8)
-        green[imask] = image[imask]
-
-        #mask of blue (100,40,40) ~ (150,255,255)
-        blue_mask = cv2.inRange(hsv_image, (100, 40, 40), (150, 255, 255))
-
-        #slice the blue
-        imask_blue = blue_mask > 0
-        blue = np.zeros_like(image, np.uint8)
-        blue[imask_blue] = image[imask_blue]
-
-        #combine masks for blue and green areas
-        combined_mask = cv2.bitwise_or(green_mask, blue_mask)
-
-        #convert the image from BGR to RGB
-        rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-
-        #apply Gaussian Blur
-        blurred_image = cv2.GaussianBlur(rgb_image, (5, 5), 0)
+        import pipeline
+        masks = {} if self.result_store else None
+        image_with_contours, metrics = pipeline.process_image(image_path, masks=masks)
+
+        if self.result_store:
+            previews = pipeline.make_previews(image_with_contours)
+            self.result_store.save(self.result_store.result_key(image_path), metrics, masks or None, previews)
+
+        return image_with_contours, metrics
+
+    #load the processed image from the result store, KeyError when it is not there
+    #the loaders run on the job threads, the image is never processed here (see reprocess_images)
+    def load_image(self, image_path):
+        if self.result_store:
+            image_with_contours = self.result_store.load_image(self.result_store.result_key(image_path), image_path)
+            if image_with_contours is not None:
+                return image_with_contours
+        raise KeyError(image_path)
+
+    #load the preview shown on the canvas, KeyError when there is no result to make it from
+    def load_preview(self, image_path):
+        import pipeline
+        if self.result_store:
+            preview = self.result_store.load_preview(self.result_store.result_key(image_path), pipeline.PREVIEW_SIZES[0],
+                                                     image_path)
+            if preview is not None:
+                return preview
+        return pipeline.make_preview(self.image_cache[image_path], pipeline.PREVIEW_SIZES[0])
+
+    #load the preview of an image on a job, the store reads and draws it from the masks
+    #and may have to hash the image for its key, the preview is drawn when it arrives
+    def request_preview(self, image_path):
+        if image_path in self.loading_previews:
+            return
+        self.loading_previews.add(image_path)
+        self.jobs.submit(self.load_preview_job, image_path, self.session,
+                         handlers={'preview': self.on_preview_loaded, 'error': self.on_job_error})
+
+    #runs on a job thread
+    def load_preview_job(self, job, image_path, session):
         try:
-            #slice the combined mask
-            imask_combined = combined_mask > 0
-            combined_image = np.zeros_like(blurred_image, np.uint8)
-            combined_image[imask_combined] = blurred_image[imask_combined]
-
-            #calculate pixel area of the blue part
-            blue_area_pixel = np.sum(blue_mask > 0)
-
-            #calculate pixel area of the green part
-            leaf_area_pixel = np.sum(green_mask > 0)
-
-            convex_hull_pixel = self.count_pixels_in_hull(image, largest_hull)
-
-            print("Pixel area of the blue part:", blue_area_pixel, "pixels")
-            print("Pixel area of the green part:", leaf_area_pixel, "pixels")
-
-            leaf_area_cm2 = self.calculate_leaf_area_cm2(leaf_area_pixel, blue_area_pixel)
-            convex_hull_cm2 = self.calculate_leaf_area_cm2(convex_hull_pixel, blue_area_pixel)
-            #self.leaf_area_dict[image_path] = leaf_area_cm2
-
-            #store the values in the dictionary
-            self.leaf_area_dict[image_path] = {
-                'leaf_area_cm2': leaf_area_cm2,
-                'number_of_green_pixels': leaf_area_pixel,
-                'number_of_blue_pixels': blue_area_pixel,
-                'convex_hull_cm2': convex_hull_cm2,
-                'convex_hull_pixels': convex_hull_pixel
-            }
-
-            self.count_processed_images = self.count_processed_images + 1
-            print("number of processed images: ",self.count_processed_images)
-            
-            #draw contours on the original image to have the pesonalized image result requested by ipb
-            cv2.drawContours(combined_image, [largest_hull], -1, (0, 255, 0), 5)
-
-            #return final_image
-            #return blue_mask
-            return combined_image
-        
+            preview = self.preview_cache.get(image_path)
         except Exception as e:
-            print("An error occurred:", e)
-            print(image_path)
-            return blurred_image
-
-    #calculations
-    def calculate_leaf_area_cm2(self, leaf_area_pixel, blue_area_pixel):
-        blue_area_cm2 = 10
-
-        if leaf_area_pixel == 0 or blue_area_pixel == 0:
-            return 0
-        else:
-            #calculate conversion factor
-            conversion_factor = blue_area_pixel / blue_area_cm2
-
-            #calculate leaf area in square centimeters
-            leaf_area_cm2 = leaf_area_pixel / conversion_factor
-
-            print(f"Leaf area: {leaf_area_cm2} square centimeters")
-
-            return leaf_area_cm2
-    
-    #calculations
-    def calculate_convex_hull(self, convex_hull_pixel, blue_area_pixel):
-        blue_area_cm2 = 10
-
-        if convex_hull_pixel == 0 or blue_area_pixel == 0:
-            return 0
-        else:
-            #calculate conversion factor
-            conversion_factor = blue_area_pixel / blue_area_cm2
-
-            #calculate leaf area in square centimeters
-            convex_hull_cm2 = convex_hull_pixel / conversion_factor
-
-            print(f"Leaf area: {convex_hull_cm2} square centimeters")
-
-            return convex_hull_cm2
-    
-    #check if memory already at 85% then it will not run anymore
-    def is_memory_critical(self, threshold=85):
-            memory_info = psutil.virtual_memory()
-            return memory_info.percent > threshold
-
-    #open selected folder
-    def open_folder(self):
-        self.image_cache = {}
+            #an unreadable result is processed again like a missing one
+            print("Cannot load the preview:", e)
+            preview = None
+        job.post('preview', session, image_path, preview)
+
+    def on_preview_loaded(self, job, session, image_path, preview):
+        if session != self.session:
+            return
+        self.loading_previews.discard(image_path)
+        if preview is None:
+            #recorded by a previous session but its result is gone, it is processed again
+            self.ready.discard(image_path)
+            self.reprocess_images([image_path])
+        if self.image_paths and self.image_paths[self.current_index] == image_path:
+            if preview is None:
+                self.show_image()
+            else:
+                self.canvas.delete("all")
+                self.draw_preview(preview)
+
+    #process images again on a job, e.g. images recorded by a previous session whose result left the store
+    #their results reach the main loop like the ones of the folder job
+    def reprocess_images(self, image_paths):
+        image_paths = [image_path for image_path in image_paths if image_path not in self.reprocessing]
+        if not image_paths:
+            return
+        self.reprocessing.update(image_paths)
+        self.jobs.submit(self.reprocess_job, image_paths, self.session,
+                         handlers={'result': self.on_reprocessed, 'error': self.on_job_error})
+
+    #runs on a job thread, one worker processes the images on this thread like a folder job would
+    def reprocess_job(self, job, image_paths, session):
+        from batch import process_batch
+        results = process_batch(image_paths, 1, store=self.result_store, return_image=self.result_store is None)
+        try:
+            for result in results:
+                job.post('result', session, result)
+        finally:
+            results.close()
+
+    def on_reprocessed(self, job, session, result):
+        if session != self.session:
+            return
+        self.reprocessing.discard(result['image_path'])
+        self.apply_result(result)
+        self.refresh_current_image([result['image_path']])
+
+    #drain the events of the background jobs, the widgets are only touched here on the main loop
+    def poll_jobs(self):
+        self.jobs.dispatch()
+        self.root.after(EVENT_POLL_MS, self.poll_jobs)
+
+    #cancel the running jobs before closing the window, their threads end on their own
+    def on_close(self):
+        self.jobs.shutdown([job for job in (self.process_job, self.watch_job) if job])
+        if self.startup_log:
+            self.startup_log.close()
+        self.root.destroy()
+
+    #forget the images of the previous folder, folder_path is the folder opened next
+    def reset_session(self, folder_path=None):
+        from cache import DEFAULT_PREVIEW_BUDGET, ImageCache
+        self.folder_path = folder_path
+        self.session += 1
+        self.reprocessing = set()
+        self.loading_previews = set()
+        #an export would find the images of the new folder half processed
+        self.save_images_button.config(state="disabled")
+        self.save_csv_button.config(state="disabled")
+        self.image_cache = ImageCache(loader=self.load_image)
+        self.preview_cache = ImageCache(max_bytes=DEFAULT_PREVIEW_BUDGET, loader=self.load_preview)
         self.leaf_area_dict = {}
         self.count_processed_images = 0
         self.current_index = 0
-        self.image_path = []
+        self.image_paths = []
+        #natural sort keys of the names of a watched folder, computed once per image
+        self.image_keys = []
+        #images whose result can be shown, and images that could not be processed
+        self.ready = set()
+        self.failed = set()
+        self.scheduler = None
+        self.image_listbox.set_items(self.image_paths, label=os.path.basename)
+        self.canvas.delete("all")
+
+    #open selected folder, folder_path is asked with a dialog when it is not given
+    def open_folder(self, folder_path=None):
         #open file dialog to select a folder
-        folder_path = filedialog.askdirectory(title="Select Folder")
-
-        contents = os.listdir(folder_path)
-        
-        #check if the list is empty
-        if not contents:
+        folder_path = folder_path or filedialog.askdirectory(title="Select Folder")
+        if not folder_path:
+            return
+        if not self.warmed_up():
+            #opened once the modules are loaded
+            self.canvas.delete("all")
+            self.canvas.create_text(250, 200, text="Loading...", fill="white", font=("Century Gothic", 12))
+            self.root.after(EVENT_POLL_MS, self.open_folder, folder_path)
+            return
+
+        #check if the folder is empty, without listing all of it
+        with os.scandir(folder_path) as entries:
+            empty = next(entries, None) is None
+        if empty:
             #display error message
             messagebox.showerror("Error", f"Folder is empty\n")
             return True
-        else:
-            #start a new thread to process images
-            threading.Thread(target=self.process_images_thread, args=(folder_path,), daemon=True).start()
 
-    #i used threading for the progress bar
-    #unecessary but idgaf
-    def process_images_thread(self, folder_path):
-        if folder_path:
-            #create a progress window
-            self.progress_window = tk.Toplevel(self.root)
-            self.progress_window.title("Processing...")
-            #calculate window position to center it on the screen
-            window_width = 300
-            window_height = 100
-            screen_width = self.root.winfo_screenwidth()
-            screen_height = self.root.winfo_screenheight()
-            x_coordinate = (screen_width - window_width) // 2
-            y_coordinate = (screen_height - window_height) // 2
-            self.progress_window.geometry(f"{window_width}x{window_height}+{x_coordinate}+{y_coordinate}")
-
-            self.progress_window.transient(self.root)  # Set the progress window as transient to the main window
-            self.progress_window.grab_set()  # Grab focus to the progress window
-            # self.progress_window.overrideredirect(True)  # Remove window manager decorations
-
-            #add text to the window
-            text_label = tk.Label(self.progress_window, text="Processing images...", fg="white", font=("Century Gothic", 10))
-            text_label.pack(pady=10)
-
-            #create a progress bar as an instance attribute
-            self.progress_bar = ttk.Progressbar(self.progress_window, mode="determinate", length=250)
-            self.progress_bar.pack(pady=20)
-
-            #get list of image files in the folder
-            image_files = [f for f in os.listdir(folder_path) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp'))]
-            image_files.sort(key=natural_sort_key)  #sort the filenames naturally
-            self.image_paths = [os.path.join(folder_path, filename) for filename in image_files]
-            num_images = len(image_files)
-
-            if self.is_memory_critical():
-                print("Warning: Memory usage is above 85%. Cannot process more images.")
-                #close the progress window
-                self.progress_window.destroy()
-                #display error message
-                messagebox.showerror("Error", f"Memory Almost Full. Cannot process more images\n")
-                return True
-
-            #process each image and store in the cache
-            for i, image_path in enumerate(self.image_paths, start=1):
-                if image_path not in self.image_cache:
-                    image_with_contours = self.process_image(image_path)
-                    self.image_cache[image_path] = image_with_contours
-                
-                #update progress bar
-                progress_value = (i / num_images) * 100
-                self.progress_bar["value"] = progress_value
-                self.progress_bar.update()
+        #a watched folder or a folder still processing is let go first
+        if self.watch_job:
+            self.toggle_watch()
+        if self.process_job:
+            self.process_job.cancel()
+        self.reset_session(folder_path)
+
+        #the folder is listed by the job, the images show as soon as they are processed
+        trace_writer = self.open_trace_writer()
+        summary = StageSummary()
+        self.process_job = self.jobs.submit(
+            self.process_folder_job, folder_path, trace_writer, summary,
+            handlers={'listed': self.on_folder_listed, 'recorded': self.on_recorded, 'result': self.on_folder_result, 'progress': self.on_job_progress,
+                      'profile': self.on_job_profile, 'error': self.on_job_error, 'finished': self.on_folder_finished})
+        self.active_job = self.process_job
+        self.process_job.window = ProgressWindow(self.root, "Processing...", "Processing images...", self.process_job,
+                                                 show_stages=trace_writer is not None)
+
+    #runs on a job thread, the results reach the main loop as events
+    def process_folder_job(self, job, folder_path, trace_writer, summary):
+        from batch import process_batch
+        from folder_index import FolderIndex
+        #the images of the folder and of its subfolders, only the directories changed since the folder
+        #was last opened are read again
+        image_paths = FolderIndex(folder_path).refresh()
+        #the viewed image and its neighbours are processed first, the rest of the folder fills in behind
+        scheduler = ImageScheduler(image_paths)
+        job.post('listed', folder_path, list(image_paths), scheduler)
+        num_images = len(image_paths)
+
+        #results are written to the session file as they arrive so a crash loses nothing
+        #images recorded there by a previous run are not processed again, unless they changed since (see read_manifest)
+        results_writer = self.open_results_writer(folder_path)
+        listed = set(image_paths)
+        recorded = results_writer.recorded() if results_writer else {}
+        recorded = {image_path: metrics for image_path, metrics in recorded.items() if image_path in listed}
+        job.post('recorded', recorded)
+
+        #process the images on the worker processes in the order of the scheduler
+        scheduler.skip(recorded)
+        done = num_images - len(scheduler)
+        job.post('progress', done, num_images)
+        #with a result store the full images stay on disk until they are exported
+        #no task waits on the workers, a newly viewed image starts as soon as a worker is free
+        results = process_batch(scheduler, self.num_workers, store=self.result_store, return_image=self.result_store is None,
+                                profile=trace_writer is not None, prefetch=BROWSE_PREFETCH, max_in_flight=self.num_workers)
+        try:
+            for result in results:
+                if result['profile']:
+                    #the writer and the summary are thread safe
+                    trace_writer.write(result['profile'])
+                    summary.add(result['profile'])
+                    job.post('profile', summary.lines(limit=5))
+                if results_writer and not result['error']:
+                    results_writer.write(result['image_path'], result['metrics'])
+                job.post('result', result)
+                done += 1
+                job.post('progress', done, num_images)
+                #a paused job stops taking results, so no new image is sent to the workers
+                if not job.checkpoint():
+                    break
+        finally:
+            #closing the batch stops the workers of a cancelled job
+            results.close()
+            if results_writer:
+                results_writer.close()
+                print("Results written to:", results_writer.path)
+            if trace_writer:
+                trace_writer.close()
+                print("Trace written to:", trace_writer.path)
+
+    #put a finished image on the caches, False when it could not be processed
+    def apply_result(self, result):
+        image_path = result['image_path']
+        if result['error']:
+            print("An error occurred:", result['error'])
+            print(image_path)
+            self.failed.add(image_path)
+            return False
 
-            #update the label text
+        import pipeline
+        #full images left on the store are loaded by the cache when they are needed
+        if result['image'] is not None:
+            self.image_cache[image_path] = result['image']
+        self.preview_cache[image_path] = result['previews'][pipeline.PREVIEW_SIZES[0]]
+        self.ready.add(image_path)
+        if result['metrics'] is not None:
+            self.leaf_area_dict[image_path] = result['metrics']
+            self.count_processed_images = self.count_processed_images + 1
+            print("number of processed images: ",self.count_processed_images)
+        return True
+
+    #show the current image again when it is one of the images that just changed
+    def refresh_current_image(self, image_paths):
+        if self.image_paths and self.image_paths[self.current_index] in image_paths:
+            self.show_image()
             self.update_label_text()
 
-            #update the listbox
-            self.update_image_listbox()
-            
-            #highlight the first image name in the listbox
-            if self.image_paths:
-                self.image_listbox.selection_set(0)
-                self.current_index = 0
-                self.show_image()
+    #images recorded by a previous session, they are shown without processing them again
+    def on_folder_listed(self, job, folder_path, image_paths, scheduler):
+        if job is not self.active_job:
+            return
+        self.image_paths = image_paths
+        self.scheduler = scheduler
+        #images of subfolders are listed with their subfolder
+        self.image_listbox.set_items(self.image_paths, label=lambda image_path: os.path.relpath(image_path, folder_path))
+        if self.image_paths:
+            self.show_image()
+            self.update_label_text()
 
-            #close the progress window
-            self.progress_window.destroy()
+    def on_recorded(self, job, recorded):
+        if job is not self.active_job:
+            return
+        for image_path, metrics in recorded.items():
+            if metrics is not None:
+                self.leaf_area_dict[image_path] = metrics
+            self.ready.add(image_path)
+        self.refresh_current_image(recorded)
+
+    def on_folder_result(self, job, result):
+        if job is not self.active_job:
+            return
+        self.apply_result(result)
+        self.refresh_current_image([result['image_path']])
+
+    def on_job_progress(self, job, done, total):
+        job.window.set_progress(done, total)
+
+    def on_job_profile(self, job, lines):
+        job.window.show_stages(lines)
+
+    def on_job_error(self, job, message):
+        print("An error occurred:", message)
+        messagebox.showerror("Error", message)
+
+    def on_folder_finished(self, job):
+        job.window.close()
+        if job is not self.process_job:
+            return
+        self.process_job = None
+        self.scheduler = None
+
+        #keep the results in folder order for the csv
+        self.leaf_area_dict = {image_path: self.leaf_area_dict[image_path] for image_path in self.image_paths if image_path in self.leaf_area_dict}
+        print("image cache:", self.image_cache.stats())
+        if self.image_paths:
+            self.save_images_button.config(state="enabled")
+            self.save_csv_button.config(state="enabled")
+
+    #start watching a folder, or stop watching it
+    #new images are processed as they are written while the app stays usable
+    def toggle_watch(self):
+        if self.watch_job:
+            #the images already on the workers still finish
+            self.watch_job.cancel()
+            self.watch_job = None
+            self.watch_folder_button.config(text="Watch Folder")
+            return
+
+        folder_path = filedialog.askdirectory(title="Select Folder to Watch")
+        if folder_path:
+            self.start_watch(folder_path)
+
+    #watch folder_path once the modules are loaded
+    def start_watch(self, folder_path):
+        if not self.warmed_up():
+            self.root.after(EVENT_POLL_MS, self.start_watch, folder_path)
+            return
+        if self.process_job:
+            self.process_job.cancel()
+        self.reset_session(folder_path)
+
+        self.watch_job = self.jobs.submit(self.watch_folder_job, folder_path,
+                                          handlers={'recorded': self.on_watch_recorded, 'result': self.on_watch_result,
+                                                    'error': self.on_job_error})
+        self.active_job = self.watch_job
+        self.watch_folder_button.config(text="Stop Watching")
+
+    #runs on a job thread, processes the images of a watched folder until the job is cancelled
+    def watch_folder_job(self, job, folder_path):
+        from watch import watch_folder
+        #images recorded by a previous session are listed without processing them again
+        #the images arrive one at a time, each result is synced like watch.py does
+        results_writer = self.open_results_writer(folder_path, sync_every=1)
+        recorded = results_writer.recorded() if results_writer else {}
+        job.post('recorded', {image_path: metrics for image_path, metrics in recorded.items()
+                              if metrics is not None and os.path.exists(image_path)})
+
+        results = watch_folder(folder_path, job.stop_event, self.num_workers, store=self.result_store, skip=recorded,
+                               return_image=self.result_store is None)
+        try:
+            for result in results:
+                if results_writer and not result['error']:
+                    results_writer.write(result['image_path'], result['metrics'])
+                job.post('result', result)
+        finally:
+            results.close()
+            if results_writer:
+                results_writer.close()
+                print("Results written to:", results_writer.path)
+
+    def on_watch_recorded(self, job, recorded):
+        if job is not self.active_job:
+            return
+        for image_path, metrics in recorded.items():
+            self.leaf_area_dict[image_path] = metrics
+            self.ready.add(image_path)
+        self.add_watched_images(list(recorded))
+
+    def on_watch_result(self, job, result):
+        if job is not self.active_job:
+            return
+        if self.apply_result(result):
+            self.add_watched_images([result['image_path']])
+
+    #add images of the watched folder to the listbox in folder order
+    def add_watched_images(self, image_paths):
+        from batch import natural_sort_key
+        first = not self.image_paths
+        for image_path in image_paths:
+            key = natural_sort_key(os.path.basename(image_path))
+            index = bisect.bisect(self.image_keys, key)
+            self.image_keys.insert(index, key)
+            self.image_paths.insert(index, image_path)
+            #the image on the canvas stays selected
+            if not first and index <= self.current_index:
+                self.current_index += 1
+        #the list shows self.image_paths, only its visible rows are inserted again, it keeps its scroll position
+        self.image_listbox.select(self.current_index if self.image_paths else None, see=False)
+        if first and self.image_paths:
+            self.save_images_button.config(state="enabled")
+            self.save_csv_button.config(state="enabled")
+            self.show_image()
+            self.update_label_text()
 
     #save images
     def save_images(self):
         #open a dialog for the user to select the directory to save images
         save_directory = filedialog.askdirectory()
+        if not save_directory:
+            return
+
+        trace_writer = self.open_trace_writer()
+        summary = StageSummary()
+        job = self.jobs.submit(
+            self.save_images_job, save_directory, list(self.image_paths), self.folder_path, self.export_format.get(),
+            self.export_quality, trace_writer, summary, self.session,
+            handlers={'progress': self.on_job_progress, 'profile': self.on_job_profile, 'error': self.on_job_error,
+                      'metrics': self.on_export_metrics, 'finished': self.on_save_finished})
+        job.window = ProgressWindow(self.root, "Saving...", "Saving images...", job, show_stages=trace_writer is not None)
+
+    #runs on a job thread, the images are encoded on the export threads
+    #the images of subfolders of folder_path are saved in the same subfolders of save_directory
+    def save_images_job(self, job, save_directory, image_paths, folder_path, image_format, quality, trace_writer, summary,
+                        session):
+        from export import export_images
+        on_profile = None
+        if trace_writer:
+            #runs on the export threads, the writer and the summary are thread safe
+            def on_profile(record):
+                trace_writer.write(record)
+                summary.add(record)
+                job.post('profile', summary.lines(limit=5))
+
+        #runs on the export threads, the cache reloads evicted images from the store and the images
+        #it does not have are processed again, their metrics reach the main loop as events
+        def load_image(image_path):
+            image_with_contours = self.image_cache.get(image_path)
+            if image_with_contours is None:
+                image_with_contours, metrics = self.process_image(image_path)
+                job.post('metrics', session, image_path, metrics)
+            return image_with_contours
+
+        #encode on a thread pool
+        images = export_images(image_paths, save_directory, load_image, image_format, quality,
+                               on_profile=on_profile, source_root=folder_path)
+        try:
+            for i, (image_path, save_path, error) in enumerate(images, start=1):
+                if error:
+                    print("An error occurred:", error)
+                    print(image_path)
+                else:
+                    print(f"Saved {save_path}")
+                job.post('progress', i, len(image_paths))
+                #the images being encoded finish, no new one is started
+                if not job.checkpoint():
+                    break
+        finally:
+            images.close()
+            print("image cache:", self.image_cache.stats())
+            if trace_writer:
+                trace_writer.close()
+                print("Trace written to:", trace_writer.path)
+
+    #metrics of an image the export processed again
+    def on_export_metrics(self, job, session, image_path, metrics):
+        if session != self.session or metrics is None:
+            return
+        if image_path not in self.leaf_area_dict:
+            self.count_processed_images = self.count_processed_images + 1
+            print("number of processed images: ",self.count_processed_images)
+        self.leaf_area_dict[image_path] = metrics
 
-        #start a new thread to process images
-        threading.Thread(target=self.save_images_thread, args=(save_directory,)).start()
-        
-    #used threadung in saving message fo the progress bar
-    def save_images_thread(self, save_directory):
-        if save_directory:
-            #create a progress window
-            self.progress_window = tk.Toplevel(self.root)
-            self.progress_window.title("Saving...")
-            #calculate window position to center it on the screen
-            window_width = 300
-            window_height = 100
-            screen_width = self.root.winfo_screenwidth()
-            screen_height = self.root.winfo_screenheight()
-            x_coordinate = (screen_width - window_width) // 2
-            y_coordinate = (screen_height - window_height) // 2
-            self.progress_window.geometry(f"{window_width}x{window_height}+{x_coordinate}+{y_coordinate}")
-
-            self.progress_window.transient(self.root)  #set the progress window as transient to the main window
-            self.progress_window.grab_set()  #grab focus to the progress window
-
-            #add text to the window
-            text_label = tk.Label(self.progress_window, text="Saving images...", fg="white", font=("Poppins Light", 10))
-            text_label.pack(pady=10)
-
-            #create a progress bar as an instance attribute
-            self.progress_bar = ttk.Progressbar(self.progress_window, mode="determinate", length=250)
-            self.progress_bar.pack(pady=20)
-
-
-            for i, (image_path, image) in enumerate(self.image_cache.items(), start=1):
-                #extract the filename without extension
-                base_filename = os.path.splitext(os.path.basename(image_path))[0]
-                
-                #create a new filename with the counter
-                new_filename = f"{base_filename}.jpg"
-                save_path = os.path.join(save_directory, new_filename)
-                
-                #check if the file already exists and find a unique filename
-                counter = 1
-                while os.path.exists(save_path):
-                    new_filename = f"{base_filename}({counter}).jpg"
-                    save_path = os.path.join(save_directory, new_filename)
-                    counter += 1
-
-                #save the image using OpenCV
-                cv2.imwrite(save_path, cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
-                print(f"Saved {save_path}")
-                
-                #update progress bar
-                progress_value = (i / len(self.image_cache)) * 100
-                self.progress_bar["value"] = progress_value
-                self.progress_bar.update()
-
-            #close the progress window
-            self.progress_window.destroy()
+    def on_save_finished(self, job):
+        job.window.close()
 
     #for displaying the image
     def show_image(self):
         if self.image_paths:
             image_path = self.image_paths[self.current_index]
-
-            #cache the image
-            if image_path in self.image_cache:
-                image_with_contours = self.image_cache[image_path]
-            else:
-                image_with_contours = self.process_image(image_path)
-                self.image_cache[image_path] = image_with_contours
-
-            image = Image.fromarray(image_with_contours)
-
-            image.thumbnail((400, 400))  #resize image to fit canvas
-            photo = ImageTk.PhotoImage(image)
-            self.canvas.create_image(250, 250, image=photo, anchor=tk.CENTER)
-            self.canvas.image = photo  #keep reference to avoid garbage collection
-            
-            #highlight the first image name in the listbox when an image is opened
-            if self.current_index == 0:
-                self.image_listbox.selection_set(0)
+            #the images around the viewed one are processed next
+            if self.scheduler:
+                self.scheduler.focus(self.current_index)
+
+            self.canvas.delete("all")
+            #only a preview already in memory is drawn here, the others are loaded off the main loop
+            preview = self.preview_cache.peek(image_path) if image_path in self.ready else None
+            if preview is None:
+                #shown as soon as its result or its preview arrives
+                if image_path in self.ready:
+                    self.request_preview(image_path)
+                    text = "Loading..."
+                else:
+                    text = "Cannot process this image" if image_path in self.failed else "Processing..."
+                self.canvas.create_text(250, 200, text=text, fill="white", font=("Century Gothic", 12))
+                return
+            self.draw_preview(preview)
+
+    #draw the preview of the current image, it is already resized to fit the canvas
+    def draw_preview(self, preview):
+        from PIL import Image, ImageTk
+
+        image = Image.fromarray(preview)
+        photo = ImageTk.PhotoImage(image)
+        self.canvas.create_image(250, 250, image=photo, anchor=tk.CENTER)
+        self.canvas.image = photo  #keep reference to avoid garbage collection
+
+        #highlight the first image name in the listbox when an image is opened
+        if self.current_index == 0 and self.image_listbox.selected is None:
+            self.image_listbox.select(0)
+
+        if self.startup_log:
+            self.startup_log.mark('first_result')
+        if self.quit_after_first_result:
+            #after the image is drawn
+            self.root.after_idle(self.on_close)
     
-    #update image listbox
-    def update_image_listbox(self):
-        self.save_images_button.config(state="enabled")
-        self.save_csv_button.config(state="enabled")
-        self.image_listbox.delete(0, tk.END)
-
-        for image_path in self.image_paths:
-            self.image_listbox.insert(tk.END, os.path.basename(image_path))
-    
-    #display
-    def display_selected_image(self, event):
-        selected_index = self.image_listbox.curselection()
-        if selected_index:
-            self.current_index = selected_index[0]
-            self.show_image()
+    #display the image selected on the listbox
+    def display_selected_image(self, index):
+        self.current_index = index
+        self.show_image()
+        self.update_label_text()
     
     #image navigation
     def next_image(self):
@@ -588,10 +879,8 @@ class ImageSelectorApp:
             self.current_index = (self.current_index + 1) % len(self.image_paths)
             #show the image
             self.show_image()
-            #update the selection in the listbox
-            self.image_listbox.selection_clear(0, tk.END)  # Clear previous selection
-            self.image_listbox.selection_set(self.current_index)  # Highlight the current index
-            self.image_listbox.see(self.current_index)  # Scroll to the current index
+            #highlight the current image in the listbox and scroll to it
+            self.image_listbox.select(self.current_index)
             #update the label text
             self.update_label_text()
 
@@ -602,10 +891,8 @@ class ImageSelectorApp:
             self.current_index = (self.current_index - 1) % len(self.image_paths)
             #show the image
             self.show_image()
-            #update the selection in the listbox
-            self.image_listbox.selection_clear(0, tk.END)  # Clear previous selection
-            self.image_listbox.selection_set(self.current_index)  # Highlight the current index
-            self.image_listbox.see(self.current_index)  # Scroll to the current index
+            #highlight the current image in the listbox and scroll to it
+            self.image_listbox.select(self.current_index)
             #update the label text
             self.update_label_text()
 
@@ -617,30 +904,34 @@ class ImageSelectorApp:
         #get the leaf area for the current image path from the dictionary
         data = self.leaf_area_dict.get(current_image_path, None)
 
-        if data:
-            leaf_area = data.get('leaf_area_cm2', "Unknown")
+        #not processed yet or could not be measured
+        if data and data.get('leaf_area_cm2') is not None:
+            leaf_area = f"{data['leaf_area_cm2']:.2f}"
         else:
-            leaf_area = "Unknown"
+            leaf_area = "_"
         
         #update the text of the label with formatted leaf area
-        self.text_label.config(text=f"Projected Cassava Leaf Area: {leaf_area:.2f} squarecm")
+        self.text_label.config(text=f"Projected Cassava Leaf Area: {leaf_area} squarecm")
 
     def save_to_csv(self):
         #prompt the user to select a file path for saving the CSV file
         file_path = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSV files", "*.csv")])
         if file_path:
-            #open the CSV file for writing
-            with open(file_path, 'w', newline='') as csvfile:
-                writer = csv.writer(csvfile)
-                #write the header row
-                writer.writerow(['Image Filename', 'Leaf Area cm2', 'Number of Green Pixels', 'Number of Blue Pixels', 'Convex Hull Area', 'Convex Hull Pixels'])
-                #write each key-value pair from the dictionary to a separate row
-                for image_path, data in self.leaf_area_dict.items():
-                    filename = os.path.basename(image_path)
-                    writer.writerow([filename, data['leaf_area_cm2'], data['number_of_green_pixels'], data['number_of_blue_pixels'], data['convex_hull_cm2'], data['convex_hull_pixels']])
+            from export import write_results_csv
+            #write the CSV file with the same columns as the batch engine, images of subfolders keep their subfolder
+            write_results_csv(file_path, self.leaf_area_dict, self.folder_path)
             print("CSV file saved to:", file_path)
 
 if __name__ == "__main__":
+    #needed by the worker processes on the frozen PyInstaller build
+    multiprocessing.freeze_support()
+    parser = argparse.ArgumentParser(description="PhenoScan Cassava")
+    parser.add_argument('folder', nargs='?', default=None, help="folder opened at start")
+    parser.add_argument('--startup-log', default=os.environ.get(STARTUP_ENVIRONMENT_VARIABLE),
+                        help="json lines file receiving the time to the window and to the first result")
+    parser.add_argument('--quit-after-first-result', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
     root = tk.Tk()
-    app = ImageSelectorApp(root)
+    startup_log = StartupLog(args.startup_log, STARTED) if args.startup_log else None
+    app = ImageSelectorApp(root, args.folder, startup_log, args.quit_after_first_result)
     root.mainloop()
\ No newline at end of file
@@ -0,0 +1,373 @@
+"""
+Batch engine of PhenoScan Cassava.
+
+Description:
+    Fans the images of a folder out over a pool of worker processes and
+    streams the results back in completion order. It does not need the GUI,
+    so it can also be run from the command line on the acquisition workstation.
+
+Usage:
+    python batch.py /path/to/folder --workers 32 --output /path/to/results --csv results.csv
+"""
+
+
+import argparse
+import os
+import queue
+import re
+import time
+from multiprocessing import Pool
+
+import cv2
+
+from cache import ResultStore, save_result
+from card import CARD_MODES, process_tracker
+from export import EXPORT_FORMATS, RESULT_FORMATS, ResultsWriter, save_image, write_results_csv
+from pipeline import DEFAULT_TILE_SIZE, MORPHOLOGY_MODES, PREVIEW_SIZES, TILED_MIN_PIXELS, make_previews, process_image
+from prefetch import DEFAULT_IO_WORKERS, DEFAULT_PREFETCH_BYTES, Prefetcher
+from profiling import NULL_PROFILER, Profiler, StageSummary, TraceWriter
+from scheduler import ImageScheduler
+
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
+
+
+#for sorting the image filenames
+def natural_sort_key(s):
+    #split the string into a list of strings and integers
+    return [int(text) if text.isdigit() else text.lower() for text in re.split(r'(\d+)', s)]
+
+
+#get list of image files in the folder sorted naturally
+def list_image_files(folder_path):
+    image_files = [f for f in os.listdir(folder_path) if f.lower().endswith(IMAGE_EXTENSIONS)]
+    image_files.sort(key=natural_sort_key)
+    return [os.path.join(folder_path, filename) for filename in image_files]
+
+
+#number of worker processes when none is given
+def default_workers():
+    return os.cpu_count() or 1
+
+
+#runs once on every worker process
+def _init_worker():
+    #each worker gets one core, letting opencv spawn its own threads
+    #on top of the pool only oversubscribes the machine
+    cv2.setNumThreads(1)
+
+
+#path of the processed image on the output folder
+#with source_root the subfolders of the image below it are kept, images of a tree often share their names
+#the name is the one of the image when it already has the extension of the output format, otherwise the
+#extension of the image is kept before it (plant.png -> plant.png.jpg) so plant.png and plant.jpg do not
+#overwrite each other, the workers name their images without knowing the others
+def _output_path(output_dir, image_path, output_format, source_root=None):
+    filename = os.path.basename(image_path)
+    base_filename, extension = os.path.splitext(filename)
+    output_extension = EXPORT_FORMATS[output_format]['extension']
+    if extension == output_extension and os.path.splitext(base_filename)[1].lower() not in IMAGE_EXTENSIONS:
+        filename = base_filename
+    if source_root:
+        output_dir = os.path.join(output_dir, os.path.relpath(os.path.dirname(image_path), source_root))
+        os.makedirs(output_dir, exist_ok=True)
+    return os.path.join(output_dir, f"{filename}{output_extension}")
+
+
+#result dictionary of an image before it is filled
+def _new_result(image_path, key, cached=False):
+    return {'image_path': image_path, 'metrics': None, 'image': None, 'previews': None, 'masks': None,
+            'output_path': None, 'error': None, 'key': key, 'cached': cached, 'profile': None}
+
+
+#runs on a worker process, must stay at module level so it can be pickled
+def _process_task(task):
+    image_path = task['image_path']
+    output_dir = task['output_dir']
+    result = _new_result(image_path, task['key'])
+    profiler = Profiler() if task['profile'] else NULL_PROFILER
+    try:
+        #the raw bytes were read ahead by the parent, decoding them is part of the work here
+        masks = {} if task['blob_directory'] else None
+        #the card is searched where it was on the previous image of this worker first
+        image, metrics = process_image(image_path, task['params'], profiler, task.get('data'), task['tile_size'], masks,
+                                       process_tracker)
+        result['metrics'] = metrics
+        with profiler.stage('previews'):
+            result['previews'] = make_previews(image, task['preview_sizes'])
+        if task['blob_directory']:
+            #the masks are written here, the parent only records the metrics and where the masks are
+            with profiler.stage('store'):
+                result['masks'] = save_result(task['blob_directory'], task['key'], masks or None, result['previews'])
+        if output_dir:
+            #write the image here so only the path travels back to the parent
+            output_path = _output_path(output_dir, image_path, task['output_format'], task['source_root'])
+            save_image(output_path, image, task['output_format'], task['output_quality'], profiler)
+            result['output_path'] = output_path
+        elif task['return_image']:
+            result['image'] = image
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+    if task['profile']:
+        result['profile'] = profiler.record(image_path)
+    return result
+
+
+#result of an image already in the result store
+def _stored_result(image_path, key, metrics, store, output_dir, preview_sizes, output_format, output_quality,
+                   source_root=None):
+    previews = {size: store.load_preview(key, size, image_path) for size in preview_sizes}
+    if any(preview is None for preview in previews.values()):
+        return None
+    result = _new_result(image_path, key, cached=True)
+    result['metrics'] = metrics
+    result['previews'] = previews
+    if output_dir:
+        image = store.load_image(key, image_path)
+        if image is None:
+            return None
+        output_path = _output_path(output_dir, image_path, output_format, source_root)
+        save_image(output_path, image, output_format, output_quality)
+        result['output_path'] = output_path
+    return result
+
+
+#record a new result on the store
+def _record(store, result):
+    if store and not result['error']:
+        store.put(result['key'], result['metrics'], result['masks'])
+
+
+#result of a task that could not reach its worker
+def _failed_result(task, error):
+    result = _new_result(task['image_path'], task['key'])
+    result['error'] = f"{type(error).__name__}: {error}"
+    return result
+
+
+#stored result of an image, or the task to process it when it is not on the store
+#options holds the settings of the batch shared by every task
+#digest is the content hash of the image when it is already known
+def _prepare(image_path, store, options, digest=None):
+    key = None
+    if store:
+        key = store.result_key(image_path, options['params'], digest)
+        if key in store:
+            result = _stored_result(image_path, key, store.get_metrics(key), store, options['output_dir'],
+                                    options['preview_sizes'], options['output_format'], options['output_quality'],
+                                    options['source_root'])
+            if result is not None:
+                return result, None
+    return None, dict(options, image_path=image_path, key=key)
+
+
+#settings of a batch shared by every task
+def _task_options(params, output_dir, store, preview_sizes, return_image, output_format, output_quality, profile,
+                  tile_size=None, source_root=None):
+    return {'params': params, 'output_dir': output_dir, 'blob_directory': store.blob_directory if store else None,
+            'preview_sizes': preview_sizes, 'return_image': return_image, 'output_format': output_format,
+            'output_quality': output_quality, 'profile': profile, 'tile_size': tile_size,
+            'source_root': source_root}
+
+
+#stored result or task of an image read by the prefetcher
+def _prefetched_task(item, store, options):
+    image_path = item['image_path']
+    if item['error'] is not None:
+        return _failed_result({'image_path': image_path, 'key': None}, item['error']), None
+    if store and item['stat'] is not None:
+        #the image was hashed on the io threads, it is not read again for its key
+        store.remember_digest(image_path, item['stat'], item['digest'])
+    stored, task = _prepare(image_path, store, options, item['digest'])
+    if task is not None:
+        task['data'] = item['data']
+    return stored, task
+
+
+#process the images and yield a result dictionary for each one as soon as it finishes
+#result keys: image_path, metrics, image (or output_path when output_dir is set), previews
+#(one per preview size), error, key and cached (True when the result came from the store)
+#with a store, images already processed with the same parameters are not processed again
+#stored results and return_image=False leave image as None, the full image is then read from the store
+#with profile=True, profile holds the timed stages of the images processed here (see profiling.py)
+#the images are read ahead on io_workers threads, at most prefetch images (default: two per worker)
+#or prefetch_bytes bytes ahead of the workers, so the workers do not wait on the disk
+#max_in_flight images are sent to the workers at most (default: two per worker)
+#image_paths may be a scheduler.ImageScheduler, it is then consumed one image at a time as the workers
+#free up, so a change of its priorities applies to everything not read yet
+#tile_size is passed to pipeline.process_image, by default only very large images are processed in tiles
+#with source_root the processed images keep their subfolders below it on output_dir
+def process_batch(image_paths, workers=None, params=None, output_dir=None, store=None,
+                  preview_sizes=PREVIEW_SIZES, return_image=True, output_format='jpeg', output_quality=None,
+                  profile=False, prefetch=None, prefetch_bytes=DEFAULT_PREFETCH_BYTES, io_workers=DEFAULT_IO_WORKERS,
+                  tile_size=None, source_root=None, max_in_flight=None):
+    workers = workers or default_workers()
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    options = _task_options(params, output_dir, store, preview_sizes, return_image, output_format, output_quality, profile,
+                            tile_size, source_root)
+
+    if isinstance(image_paths, ImageScheduler):
+        #images whose digest is known from a previous run are not read, they are looked up when their turn comes
+        pending = image_paths
+        known_digest = store.known_digest if store else None
+    else:
+        #images whose digest is known from a previous run are looked up without reading them
+        pending = []
+        for image_path in image_paths:
+            digest = store.known_digest(image_path) if store else None
+            if digest:
+                stored, task = _prepare(image_path, store, options, digest)
+                if stored is not None:
+                    yield stored
+                    continue
+            pending.append(image_path)
+        known_digest = None
+
+    prefetcher = Prefetcher(pending, prefetch or 2 * workers, prefetch_bytes, io_workers, digest=store is not None,
+                            known_digest=known_digest)
+    #no pool for a single worker, it is easier to debug
+    pool = Pool(processes=min(workers, len(pending)), initializer=_init_worker) if workers > 1 and len(pending) > 1 else None
+    #by default one task running and one waiting per worker, the next ones wait on the prefetcher
+    max_in_flight = max_in_flight or 2 * workers
+    in_flight = 0
+    results = queue.Queue()
+    try:
+        while True:
+            while in_flight < max_in_flight:
+                item = prefetcher.next()
+                if item is None:
+                    break
+                stored, task = _prefetched_task(item, store, options)
+                if stored is not None:
+                    yield stored
+                elif pool is None:
+                    result = _process_task(task)
+                    _record(store, result)
+                    yield result
+                else:
+                    pool.apply_async(_process_task, (task,), callback=results.put,
+                                     error_callback=lambda error, task=task: results.put(_failed_result(task, error)))
+                    in_flight += 1
+            if not in_flight:
+                return
+            result = results.get()
+            in_flight -= 1
+            _record(store, result)
+            yield result
+    finally:
+        prefetcher.close()
+        if pool:
+            pool.terminate()
+
+
+#command line options of the pipeline parameters, shared with watch.py
+#card_tracking=False leaves out --card-tracking for images that are not a sequence of one rig (e.g. serve.py)
+def add_pipeline_arguments(parser, card_tracking=True):
+    parser.add_argument('--detection-scale', type=float, default=None,
+                        help="locate the plant on a copy downscaled by this factor (e.g. 0.25), measure at full resolution")
+    parser.add_argument('--morphology', default=None, choices=MORPHOLOGY_MODES,
+                        help="open the hsv image before the threshold (hsv, default) or the thresholded mask (mask)")
+    parser.add_argument('--card-mode', default=None, choices=CARD_MODES,
+                        help="measure the card as the largest blue component shaped like a card (component, default) "
+                             "or as every blue pixel (threshold)")
+    if card_tracking:
+        parser.add_argument('--card-tracking', action='store_true',
+                            help="search the card where it was on the previous image first, for a fixed rig "
+                                 "(a card that moved is still searched on the whole image)")
+    parser.add_argument('--tile-size', type=int, default=None,
+                        help=f"process the images in tiles of this many pixels to bound the memory, 0 never does "
+                             f"(default: {DEFAULT_TILE_SIZE} above {TILED_MIN_PIXELS // 1_000_000} megapixels)")
+
+
+#pipeline parameters given on the command line, the others keep their default
+def pipeline_params(args):
+    params = {}
+    if args.detection_scale:
+        params['detection_scale'] = args.detection_scale
+    if args.morphology:
+        params['morphology'] = args.morphology
+    if args.card_mode:
+        params['card_mode'] = args.card_mode
+    if getattr(args, 'card_tracking', False):
+        params['card_tracking'] = True
+    return params
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Process a folder of cassava images without the GUI.")
+    parser.add_argument('folder', help="folder containing the images")
+    parser.add_argument('--workers', type=int, default=None, help="number of worker processes (default: all cores)")
+    parser.add_argument('--output', default=None, help="folder to save the processed images to")
+    parser.add_argument('--format', default='jpeg', choices=list(EXPORT_FORMATS), help="format of the processed images")
+    parser.add_argument('--quality', type=int, default=None, help="JPEG/WebP quality or PNG compression level")
+    parser.add_argument('--csv', default=None, help="csv file to export the results to")
+    parser.add_argument('--results', default=None, help="results file written while the images finish, a rerun skips what it already has")
+    parser.add_argument('--results-format', default=None, choices=RESULT_FORMATS, help="csv, jsonl or parquet (default: from the extension)")
+    add_pipeline_arguments(parser)
+    parser.add_argument('--store', default=None, help="result store folder, images already stored are not processed again")
+    parser.add_argument('--trace', default=None, help="json lines file receiving the time and peak memory of every stage")
+    parser.add_argument('--io-workers', type=int, default=DEFAULT_IO_WORKERS, help="threads reading the images ahead of the workers")
+    parser.add_argument('--prefetch', type=int, default=None, help="images read ahead of the workers (default: two per worker)")
+    parser.add_argument('--prefetch-mb', type=int, default=DEFAULT_PREFETCH_BYTES // 2 ** 20, help="megabytes read ahead of the workers at most")
+    args = parser.parse_args(argv)
+
+    image_paths = list_image_files(args.folder)
+    leaf_area_dict = {}
+    start = time.perf_counter()
+    store = ResultStore(args.store) if args.store else None
+    params = pipeline_params(args)
+    results_writer = ResultsWriter(args.results, args.results_format, params) if args.results else None
+    trace_writer = TraceWriter(args.trace) if args.trace else None
+    summary = StageSummary()
+
+    #images recorded on the results file by a previous run are skipped
+    pending = image_paths
+    if results_writer:
+        recorded = results_writer.recorded()
+        pending = [image_path for image_path in image_paths if image_path not in recorded]
+        leaf_area_dict.update((image_path, metrics) for image_path, metrics in recorded.items() if metrics is not None)
+        if len(pending) < len(image_paths):
+            print(f"Skipping {len(image_paths) - len(pending)} images already recorded on {args.results}")
+
+    #previews are only worth making when they are kept on the store for the GUI
+    preview_sizes = PREVIEW_SIZES if store else ()
+    results = process_batch(pending, args.workers, params, output_dir=args.output, store=store, preview_sizes=preview_sizes,
+                            output_format=args.format, output_quality=args.quality, profile=trace_writer is not None,
+                            prefetch=args.prefetch, prefetch_bytes=args.prefetch_mb * 2 ** 20, io_workers=args.io_workers,
+                            tile_size=args.tile_size)
+    for i, result in enumerate(results, start=1):
+        if result['profile']:
+            trace_writer.write(result['profile'])
+            summary.add(result['profile'])
+        if result['metrics'] is not None:
+            leaf_area_dict[result['image_path']] = result['metrics']
+        if results_writer and not result['error']:
+            results_writer.write(result['image_path'], result['metrics'])
+        if result['error']:
+            print(f"[{i}/{len(pending)}] {result['image_path']}: {result['error']}")
+        elif result['cached']:
+            print(f"[{i}/{len(pending)}] {result['image_path']} (stored)")
+        else:
+            print(f"[{i}/{len(pending)}] {result['image_path']}")
+    elapsed = time.perf_counter() - start
+    print(f"Processed {len(pending)} images in {elapsed:.1f}s")
+    if results_writer:
+        results_writer.close()
+        print("Results written to:", args.results)
+    if trace_writer:
+        trace_writer.close()
+        print("Stages, slowest first:")
+        for line in summary.lines():
+            print("   ", line)
+        print("Trace written to:", args.trace)
+
+    if args.csv:
+        #keep the csv in folder order even though the results arrive out of order
+        ordered = {image_path: leaf_area_dict[image_path] for image_path in image_paths if image_path in leaf_area_dict}
+        write_results_csv(args.csv, ordered)
+        print("CSV file saved to:", args.csv)
+
+
+if __name__ == "__main__":
+    main()
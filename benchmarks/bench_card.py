@@ -0,0 +1,82 @@
+"""
+Benchmark of the reference card locator.
+
+Description:
+    Times the blue pass of the pipeline on a sequence of synthetic scenes of a
+    fixed rig (the card stays in place) with stray blue objects added: the
+    previous full frame count of every blue pixel, the card searched on the
+    whole image, and the card followed by a CardTracker. Reports the blue
+    pixels each one counts against the card drawn on the scene, and the share
+    of images whose card was found in the tracked region.
+
+Usage:
+    python benchmarks/bench_card.py --megapixels 12 --images 10
+"""
+
+
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import sys
+import time
+
+import cv2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from card import CardTracker
+from pipeline import locate_card, resolve_params
+from synthetic import CARD_COLOR, make_scene
+
+
+#blue objects of the scene that are not the card: a round label, a long strip and scattered pixels
+def add_stray_blue(image, seed):
+    height, width = image.shape[:2]
+    cv2.circle(image, (int(width * (0.6 + 0.02 * seed)), int(height * 0.7)), max(4, width // 60), CARD_COLOR, -1)
+    cv2.rectangle(image, (int(width * 0.7), int(height * 0.03)), (int(width * 0.95), int(height * 0.045)), CARD_COLOR, -1)
+    for x in range(0, width, 97):
+        image[int(height * 0.5) + (x * 7 + seed) % (height // 10), x] = CARD_COLOR
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the card locator against the full frame blue count.")
+    parser.add_argument('--megapixels', type=float, default=12, help="size of the synthetic scenes")
+    parser.add_argument('--images', type=int, default=10, help="scenes of the sequence")
+    args = parser.parse_args()
+
+    params = resolve_params({'card_tracking': True})
+    scenes = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for seed in range(args.images):
+            image, truth = make_scene(args.megapixels, 'low', seed=seed)
+            add_stray_blue(image, seed)
+            scenes.append((cv2.cvtColor(cv2.GaussianBlur(image, (5, 5), 0), cv2.COLOR_BGR2HSV), truth))
+
+    def full_frame(hsv_image, tracker):
+        return cv2.countNonZero(cv2.inRange(hsv_image, params['blue_lower'], params['blue_upper']))
+
+    def located(hsv_image, tracker):
+        card = locate_card(None, params, tracker, hsv_image=hsv_image)
+        return card['pixels'] if card else 0
+
+    tracker = CardTracker()
+    for name, count, make_tracker in (('full frame count', full_frame, lambda: None),
+                                      ('card, whole image', located, lambda: None),
+                                      ('card, tracked', located, lambda: tracker)):
+        times = []
+        errors = []
+        current_tracker = make_tracker()
+        for hsv_image, truth in scenes:
+            start = time.perf_counter()
+            pixels = count(hsv_image, current_tracker)
+            times.append(time.perf_counter() - start)
+            errors.append(abs(pixels - truth['card_pixels']) / truth['card_pixels'])
+        print(f"{name}: median {statistics.median(times) * 1000:.1f} ms per image, "
+              f"card pixels off by {statistics.mean(errors) * 100:.1f}% on average")
+    print(f"tracked: {tracker.hits} of {tracker.hits + tracker.misses} cards found in the region of the previous one")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Micro-benchmark of the convex hull merging.
+
+Description:
+    Times pipeline.merge_hulls against the previous pure Python implementation
+    (point by point hulls_close and a single greedy pass) on random hull sets.
+    The hulls it gives are checked by tests/test_pipeline.py.
+
+Usage:
+    python benchmarks/bench_hull_merge.py --hulls 10 30 60 120 --repeat 5
+"""
+
+
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pipeline import merge_hulls
+
+
+#previous implementation, kept here as the baseline
+def legacy_hulls_close(hull1, hull2, max_distance):
+    for point1 in hull1:
+        for point2 in hull2:
+            distance = np.linalg.norm(point1[0] - point2[0])
+            if distance < max_distance:
+                return True
+    return False
+
+
+#previous implementation, kept here as the baseline
+def legacy_merge_hulls(hulls, max_distance):
+    merged = []
+    while hulls:
+        current_hull = hulls.pop(0)
+        to_merge = [current_hull]
+        i = 0
+        while i < len(hulls):
+            if legacy_hulls_close(current_hull, hulls[i], max_distance):
+                to_merge.append(hulls.pop(i))
+            else:
+                i += 1
+        merged_hull = np.vstack(to_merge)
+        merged.append(cv2.convexHull(merged_hull))
+    return merged if merged else hulls
+
+
+#random blobs spread over a field image, like the contours surviving the filtering
+def random_hulls(rng, count, width=6000, height=4000):
+    hulls = []
+    for _ in range(count):
+        center = rng.integers((0, 0), (width, height))
+        radius = rng.integers(20, 300)
+        angles = np.sort(rng.uniform(0, 2 * np.pi, rng.integers(8, 60)))
+        radii = radius * rng.uniform(0.6, 1.0, len(angles))
+        points = np.stack([center[0] + radii * np.cos(angles), center[1] + radii * np.sin(angles)], axis=1)
+        hulls.append(cv2.convexHull(points.astype(np.int32).reshape(-1, 1, 2)))
+    return hulls
+
+
+def best_time(function, cases, max_distance, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for hulls in cases:
+            function(list(hulls), max_distance)
+        best = min(best, time.perf_counter() - start)
+    return best / len(cases)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the convex hull merging.")
+    parser.add_argument('--hulls', type=int, nargs='+', default=[10, 30, 60, 120], help="number of hulls per image")
+    parser.add_argument('--cases', type=int, default=20, help="random images per hull count")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--max-distance', type=float, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(args.seed)
+    print(f"{'hulls':>6} {'legacy ms':>10} {'merge ms':>10} {'speedup':>8}")
+    for count in args.hulls:
+        cases = [random_hulls(rng, count) for _ in range(args.cases)]
+        legacy = best_time(legacy_merge_hulls, cases, args.max_distance, args.repeat)
+        current = best_time(merge_hulls, cases, args.max_distance, args.repeat)
+        print(f"{count:>6} {legacy * 1000:>10.2f} {current * 1000:>10.2f} {legacy / current:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+Benchmark of the mask kernels of the pipeline.
+
+Description:
+    Times the previous and the current version of each mask step of
+    pipeline.process_image on large synthetic images and checks that both give
+    the same output. Peak allocation is measured with tracemalloc, which also
+    sees the arrays OpenCV returns since they are allocated by numpy.
+
+    - filter: connected component filtering (one pass per label vs lookup table)
+    - slice: green/blue/combined slicing and the second blur on the RGB image
+    - count: pixel counts of the blue, green and convex hull masks
+
+Usage:
+    python benchmarks/bench_mask_kernels.py --megapixels 12 24
+"""
+
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pipeline import count_pixels_in_hull, filter_connected_components
+
+
+#previous implementation, kept here as the baseline
+def legacy_filter_connected_components(mask, min_component_size):
+    num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    filtered_mask = np.zeros_like(mask)
+    for label in range(1, num_labels):
+        if stats[label, cv2.CC_STAT_AREA] >= min_component_size:
+            filtered_mask[labels == label] = 255
+    return filtered_mask
+
+
+#previous slicing of the green, blue and combined masks
+def legacy_slice(image, blurred_image, green_mask, blue_mask):
+    imask = green_mask > 0
+    green = np.zeros_like(image, np.uint8)
+    green[imask] = image[imask]
+    imask_blue = blue_mask > 0
+    blue = np.zeros_like(image, np.uint8)
+    blue[imask_blue] = image[imask_blue]
+    combined_mask = cv2.bitwise_or(green_mask, blue_mask)
+    rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    blurred_rgb = cv2.GaussianBlur(rgb_image, (5, 5), 0)
+    imask_combined = combined_mask > 0
+    combined_image = np.zeros_like(blurred_rgb, np.uint8)
+    combined_image[imask_combined] = blurred_rgb[imask_combined]
+    return combined_image
+
+
+#current slicing, as done in pipeline.process_image
+def current_slice(image, blurred_image, green_mask, blue_mask):
+    combined_mask = cv2.bitwise_or(green_mask, blue_mask, dst=blue_mask)
+    combined_image = cv2.bitwise_and(blurred_image, blurred_image, mask=combined_mask)
+    return cv2.cvtColor(combined_image, cv2.COLOR_BGR2RGB, dst=combined_image)
+
+
+#previous pixel counts
+def legacy_count(image, green_mask, blue_mask, hull, hull_mask):
+    return int(np.sum(blue_mask > 0)), int(np.sum(green_mask > 0)), count_pixels_in_hull(image, hull)
+
+
+#current pixel counts, the hull mask is already drawn by the pipeline
+def current_count(image, green_mask, blue_mask, hull, hull_mask):
+    return cv2.countNonZero(blue_mask), cv2.countNonZero(green_mask), cv2.countNonZero(hull_mask)
+
+
+#a field-like image with leaves, green noise and a blue card
+def synthetic_inputs(megapixels, seed=0):
+    rng = np.random.default_rng(seed)
+    width = int(np.sqrt(megapixels * 1e6 * 4 / 3))
+    height = int(megapixels * 1e6 / width)
+    image = np.empty((height, width, 3), np.uint8)
+    image[:] = (90, 110, 130)
+    for _ in range(12):
+        center = (int(rng.integers(width // 4, 3 * width // 4)), int(rng.integers(height // 4, 3 * height // 4)))
+        axes = (int(rng.integers(width // 30, width // 10)), int(rng.integers(height // 30, height // 10)))
+        cv2.ellipse(image, center, axes, float(rng.integers(0, 180)), 0, 360, (40, 160, 60), -1)
+    for _ in range(400):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        cv2.circle(image, center, int(rng.integers(3, 40)), (40, 160, 60), -1)
+    side = width // 20
+    cv2.rectangle(image, (side, side), (2 * side, 2 * side), (200, 60, 30), -1)
+
+    blurred_image = cv2.GaussianBlur(image, (5, 5), 0)
+    hsv_image = cv2.cvtColor(blurred_image, cv2.COLOR_BGR2HSV)
+    raw_green_mask = cv2.inRange(hsv_image, (34, 25, 25), (86, 255, 255))
+    blue_mask = cv2.inRange(hsv_image, (100, 40, 40), (150, 255, 255))
+    green_mask = filter_connected_components(raw_green_mask, 20000)
+    contours, _ = cv2.findContours(green_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    hull = cv2.convexHull(np.vstack(contours))
+    hull_mask = np.zeros_like(green_mask)
+    cv2.drawContours(hull_mask, [hull], -1, (255), thickness=cv2.FILLED)
+    return image, blurred_image, raw_green_mask, green_mask, blue_mask, hull, hull_mask
+
+
+#best wall time and peak allocation of a call
+def measure(function, make_args, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        args = make_args()
+        start = time.perf_counter()
+        function(*args)
+        best = min(best, time.perf_counter() - start)
+    args = make_args()
+    tracemalloc.start()
+    result = function(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the mask kernels of the pipeline.")
+    parser.add_argument('--megapixels', type=float, nargs='+', default=[12, 24])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    print(f"{'MP':>5} {'kernel':>7} {'legacy ms':>10} {'current ms':>11} {'legacy MB':>10} {'current MB':>11}")
+    for megapixels in args.megapixels:
+        image, blurred_image, raw_green_mask, green_mask, blue_mask, hull, hull_mask = synthetic_inputs(megapixels)
+        kernels = [
+            ('filter', legacy_filter_connected_components, filter_connected_components, lambda: (raw_green_mask, 20000)),
+            ('slice', legacy_slice, current_slice, lambda: (image, blurred_image, green_mask, blue_mask.copy())),
+            ('count', legacy_count, current_count, lambda: (image, green_mask, blue_mask, hull, hull_mask)),
+        ]
+        for name, legacy, current, make_args in kernels:
+            legacy_time, legacy_peak, legacy_result = measure(legacy, make_args, args.repeat)
+            current_time, current_peak, current_result = measure(current, make_args, args.repeat)
+            if isinstance(legacy_result, np.ndarray):
+                assert np.array_equal(legacy_result, current_result), f"{name} output differs"
+            else:
+                assert legacy_result == current_result, f"{name} output differs"
+            print(f"{megapixels:>5g} {name:>7} {legacy_time * 1000:>10.1f} {current_time * 1000:>11.1f} "
+                  f"{legacy_peak / 1e6:>10.1f} {current_peak / 1e6:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
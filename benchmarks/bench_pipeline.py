@@ -0,0 +1,174 @@
+"""
+Benchmark suite of the phenotyping pipeline.
+
+Description:
+    Generates synthetic cassava-like scenes (benchmarks/synthetic.py) at several
+    resolutions and clutter levels, times every stage of the pipeline and the
+    whole process_image call, and checks the measured leaf area against the
+    ground truth of the scene. The results are saved as JSON so runs can be
+    compared with --compare.
+
+Usage:
+    python benchmarks/bench_pipeline.py --megapixels 4 12 24 48 --clutter low high --output run.json
+    python benchmarks/bench_pipeline.py --compare run.json --output new.json
+"""
+
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pipeline
+from profiling import Profiler
+from synthetic import CLUTTER_LEVELS, make_scene
+
+
+#time the stages of the pipeline with its own profiler
+def stage_times(image_path, params, tile_size=None):
+    profiler = Profiler()
+    with contextlib.redirect_stdout(io.StringIO()):
+        pipeline.process_image(image_path, params, profiler, tile_size=tile_size)
+    #tracing slows down the untraced total time measured next
+    tracemalloc.stop()
+    return {name: stage['seconds'] for name, stage in profiler.stages.items()}, \
+        {name: stage['peak_bytes'] for name, stage in profiler.stages.items()}
+
+
+#process an image without the pixel count prints of the pipeline
+def timed_process(image_path, params, tile_size=None):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        _, metrics = pipeline.process_image(image_path, params, tile_size=tile_size)
+    return metrics, time.perf_counter() - start
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'opencv': cv2.__version__,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'opencv_threads': cv2.getNumThreads(),
+    }
+
+
+#benchmark one scene, the best of repeat runs is kept
+def run_scene(megapixels, clutter, seed, repeat, params, directory, tile_size=None):
+    image, truth = make_scene(megapixels, clutter, seed)
+    image_path = os.path.join(directory, f"scene_{megapixels:g}mp_{clutter}_{seed}.jpg")
+    cv2.imwrite(image_path, image, [cv2.IMWRITE_JPEG_QUALITY, 95])
+    del image
+
+    best_total = float('inf')
+    best_stages = None
+    peaks = None
+    metrics = None
+    for _ in range(repeat):
+        metrics, total = timed_process(image_path, params, tile_size)
+        best_total = min(best_total, total)
+        stages, peaks = stage_times(image_path, params, tile_size)
+        if best_stages is None or sum(stages.values()) < sum(best_stages.values()):
+            best_stages = stages
+    os.remove(image_path)
+
+    measured = metrics['leaf_area_cm2'] if metrics else None
+    error = (measured - truth['leaf_area_cm2']) / truth['leaf_area_cm2'] * 100 if measured is not None else None
+    return {
+        'scene': f"{megapixels:g}mp/{clutter}/{seed}",
+        'megapixels': megapixels,
+        'clutter': clutter,
+        'seed': seed,
+        'total_s': best_total,
+        'stages_s': best_stages,
+        'stage_peak_bytes': peaks,
+        'truth': truth,
+        'metrics': pipeline_metrics(metrics),
+        'leaf_area_error_pct': error,
+    }
+
+
+#metrics as plain json numbers
+def pipeline_metrics(metrics):
+    if metrics is None:
+        return None
+    return {key: float(value) for key, value in metrics.items()}
+
+
+#print how the scenes compare with a previous run
+def compare(results, previous_path):
+    with open(previous_path) as f:
+        previous = {result['scene']: result for result in json.load(f)['results']}
+    print(f"\ncompared with {previous_path}")
+    print(f"{'scene':>22} {'before s':>9} {'after s':>9} {'speedup':>8} {'error before %':>15} {'error after %':>14}")
+    for result in results:
+        before = previous.get(result['scene'])
+        if before is None:
+            continue
+        print(f"{result['scene']:>22} {before['total_s']:>9.3f} {result['total_s']:>9.3f} "
+              f"{before['total_s'] / result['total_s']:>7.2f}x {format_error(before['leaf_area_error_pct']):>15} "
+              f"{format_error(result['leaf_area_error_pct']):>14}")
+
+
+def format_error(error):
+    return "failed" if error is None else f"{error:.3f}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic scenes.")
+    parser.add_argument('--megapixels', type=float, nargs='+', default=[4, 12, 24, 48])
+    parser.add_argument('--clutter', nargs='+', default=['low', 'medium', 'high'], choices=list(CLUTTER_LEVELS))
+    parser.add_argument('--seeds', type=int, default=1, help="scenes per resolution and clutter level")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--detection-scale', type=float, default=None)
+    parser.add_argument('--morphology', default=None, choices=pipeline.MORPHOLOGY_MODES)
+    parser.add_argument('--tile-size', type=int, default=None, help="tile size of the tiled mode, 0 turns it off")
+    parser.add_argument('--output', default=None, help="json file to save the results to")
+    parser.add_argument('--compare', default=None, help="json file of a previous run to compare with")
+    args = parser.parse_args(argv)
+
+    params = {}
+    if args.detection_scale:
+        params['detection_scale'] = args.detection_scale
+    if args.morphology:
+        params['morphology'] = args.morphology
+
+    results = []
+    stage_names = None
+    with tempfile.TemporaryDirectory() as directory:
+        for megapixels in args.megapixels:
+            for clutter in args.clutter:
+                for seed in range(args.seeds):
+                    result = run_scene(megapixels, clutter, seed, args.repeat, params, directory, args.tile_size)
+                    results.append(result)
+                    if stage_names is None:
+                        stage_names = list(result['stages_s'])
+                        print(f"{'scene':>22} {'total s':>8} {'error %':>8} " + " ".join(f"{name[:10]:>10}" for name in stage_names))
+                    stages = " ".join(f"{result['stages_s'][name]:>10.3f}" for name in stage_names)
+                    print(f"{result['scene']:>22} {result['total_s']:>8.3f} {format_error(result['leaf_area_error_pct']):>8} {stages}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'params': pipeline.resolve_params(params),
+                       'environment': environment(), 'results': results}, f, indent=2)
+        print("Results saved to:", args.output)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Load test of the analysis service.
+
+Description:
+    Starts the service of serve.py on a free localhost port and sends it a
+    synthetic scene (benchmarks/synthetic.py) from several client threads,
+    each on its own keep-alive connection, for a fixed time. Prints the
+    answers per status (429 once the queue is full) and the /metrics of the
+    service: throughput, latency percentiles and mean batch size.
+
+Usage:
+    python benchmarks/bench_service.py --clients 8 --seconds 20 --workers 2 --megapixels 2
+    python benchmarks/bench_service.py --clients 32 --queue-size 8 --batch-size 1
+"""
+
+
+import argparse
+import contextlib
+import http.client
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+import cv2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from serve import DEFAULT_BATCH_SIZE, DEFAULT_QUEUE_SIZE, AnalysisService, make_server
+from synthetic import make_scene
+
+
+#send the image again and again on one connection until the deadline, counting the answers per status
+def run_client(port, data, deadline, statuses, lock):
+    connection = http.client.HTTPConnection("127.0.0.1", port)
+    while time.perf_counter() < deadline:
+        connection.request("POST", "/analyze?name=scene.jpg", body=data, headers={'Content-Type': 'image/jpeg'})
+        response = connection.getresponse()
+        response.read()
+        with lock:
+            statuses[response.status] += 1
+        if response.status == 429:
+            #a real client would honour Retry-After, a short pause keeps the pressure on
+            time.sleep(0.01)
+    connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the analysis service on localhost.")
+    parser.add_argument('--clients', type=int, default=8, help="concurrent client connections")
+    parser.add_argument('--seconds', type=float, default=20, help="duration of the test")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes of the service")
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE, help="queue size of the service")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help="batch size of the service")
+    parser.add_argument('--megapixels', type=float, default=2, help="size of the synthetic scene")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        image_path = os.path.join(directory, "scene.jpg")
+        with contextlib.redirect_stdout(io.StringIO()):
+            image, _ = make_scene(args.megapixels, 'low')
+        cv2.imwrite(image_path, image)
+        with open(image_path, 'rb') as f:
+            data = f.read()
+
+    service = AnalysisService(args.workers, queue_size=args.queue_size, batch_size=args.batch_size)
+    server = make_server(service, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_port
+
+    statuses = Counter()
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.seconds
+    clients = [threading.Thread(target=run_client, args=(port, data, deadline, statuses, lock))
+               for _ in range(args.clients)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+
+    connection = http.client.HTTPConnection("127.0.0.1", port)
+    connection.request("GET", "/metrics")
+    metrics = json.loads(connection.getresponse().read())
+    connection.close()
+    server.shutdown()
+    server.server_close()
+    service.close()
+
+    print(f"{args.clients} clients, {service.workers} workers, {args.megapixels} MP scene, {args.seconds:.0f}s")
+    print("answers:", dict(sorted(statuses.items())))
+    print(json.dumps(metrics, indent=2))
+
+
+if __name__ == "__main__":
+    main()
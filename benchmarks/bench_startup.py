@@ -0,0 +1,95 @@
+"""
+Startup benchmark of the GUI.
+
+Description:
+    Starts the application again and again in fresh processes and reports the
+    median time from the launch to the window and to the first processed image
+    shown, read from the startup log of the application (profiling.StartupLog).
+    The application opens a folder of synthetic scenes (benchmarks/synthetic.py)
+    at start and quits once the first result is shown. --command runs another
+    build, e.g. the frozen PyInstaller executable.
+
+    The GUI needs a display. --imports-only times the import of application.py
+    instead, which works anywhere and covers most of the start.
+
+Usage:
+    python benchmarks/bench_startup.py --runs 10
+    python benchmarks/bench_startup.py --command dist/PhenoScanCassava/PhenoScanCassava --runs 10
+    python benchmarks/bench_startup.py --imports-only --runs 20
+"""
+
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from synthetic import make_scene
+
+
+#seconds to import application.py in a fresh interpreter
+def time_import():
+    code = "import time; t = time.perf_counter(); import application; print(time.perf_counter() - t)"
+    output = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    return float(output.split()[-1])
+
+
+#seconds from the launch to the milestones of one start of the application
+#the application gets an empty home folder, so its result store never answers and every start is cold
+def time_start(command, folder, timeout):
+    with tempfile.TemporaryDirectory() as directory:
+        log_path = os.path.join(directory, "startup.jsonl")
+        environment = dict(os.environ, HOME=directory, USERPROFILE=directory)
+        launched = time.time()
+        subprocess.run(command + [folder, "--startup-log", log_path, "--quit-after-first-result"],
+                       cwd=ROOT, env=environment, capture_output=True, timeout=timeout, check=True)
+        with open(log_path) as f:
+            record = json.loads(f.readline())
+    #the milestones of the log are relative to the start of application.py, not to the launch
+    offset = record['started'] - launched
+    return {name[:-2]: offset + seconds for name, seconds in record.items() if name.endswith('_s')}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the start of the GUI.")
+    parser.add_argument('--runs', type=int, default=5, help="starts to time")
+    parser.add_argument('--command', nargs='+', default=None, help="command starting the application (default: python application.py)")
+    parser.add_argument('--megapixels', type=float, default=12, help="size of the synthetic scenes of the folder opened at start")
+    parser.add_argument('--timeout', type=float, default=120, help="seconds a start may take")
+    parser.add_argument('--imports-only', action='store_true', help="time the import of application.py only, no display needed")
+    args = parser.parse_args()
+
+    if args.imports_only:
+        times = [time_import() for _ in range(args.runs)]
+        print(f"import application: median {statistics.median(times) * 1000:.0f} ms, "
+              f"min {min(times) * 1000:.0f} ms over {args.runs} runs")
+        return
+
+    command = args.command or [sys.executable, os.path.join(ROOT, "application.py")]
+    with tempfile.TemporaryDirectory() as folder:
+        with contextlib.redirect_stdout(io.StringIO()):
+            for i in range(3):
+                image, _ = make_scene(args.megapixels, 'low', seed=i)
+                cv2.imwrite(os.path.join(folder, f"scene_{i}.jpg"), image)
+        runs = [time_start(command, folder, args.timeout) for _ in range(args.runs)]
+
+    for milestone in ('window', 'warm', 'first_result'):
+        times = [run[milestone] for run in runs if milestone in run]
+        if times:
+            print(f"{milestone}: median {statistics.median(times) * 1000:.0f} ms, "
+                  f"min {min(times) * 1000:.0f} ms over {len(times)} runs")
+
+
+if __name__ == "__main__":
+    main()
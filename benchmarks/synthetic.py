@@ -0,0 +1,117 @@
+"""
+Synthetic cassava-like scenes for the benchmarks.
+
+Description:
+    Draws a plant made of overlapping green leaf blobs on a soil coloured
+    background, stray green noise of several component sizes and a blue
+    10 cm2 reference card. The drawn masks give the ground truth pixel counts,
+    so the measured leaf area can be checked against them.
+"""
+
+
+import cv2
+import numpy as np
+
+
+#bgr colours, inside the default hsv ranges of the pipeline
+SOIL_COLOR = (70, 100, 135)
+LEAF_COLORS = [(40, 150, 50), (55, 170, 70), (35, 130, 60)]
+CARD_COLOR = (190, 70, 30)
+
+#noise components per clutter level, small ones are below min_component_size and counted
+#per megapixel, large ones survive the filtering but are far from the plant
+CLUTTER_LEVELS = {
+    'none': {'small_per_mp': 0, 'large': 0},
+    'low': {'small_per_mp': 3, 'large': 1},
+    'medium': {'small_per_mp': 10, 'large': 2},
+    'high': {'small_per_mp': 30, 'large': 3},
+}
+
+
+#width and height of a 4:3 image of the given size
+def scene_size(megapixels):
+    width = int(round(np.sqrt(megapixels * 1e6 * 4 / 3)))
+    height = int(round(megapixels * 1e6 / width))
+    return width, height
+
+
+#random ellipse of a given area in pixels
+def _ellipse(mask, rng, center, area, color):
+    ratio = rng.uniform(0.4, 1.0)
+    major = np.sqrt(area / (np.pi * ratio))
+    axes = (max(1, int(major)), max(1, int(major * ratio)))
+    cv2.ellipse(mask, (int(center[0]), int(center[1])), axes, float(rng.uniform(0, 180)), 0, 360, color, -1)
+
+
+#make a scene, returns the bgr image and its ground truth
+#leaf_area_cm2 of the ground truth is what the pipeline should measure
+def make_scene(megapixels, clutter='medium', seed=0, card_area_cm2=10, noise_sigma=4, min_component_size=20000,
+               max_distance=500):
+    rng = np.random.default_rng(seed)
+    width, height = scene_size(megapixels)
+    image = np.empty((height, width, 3), np.uint8)
+    image[:] = SOIL_COLOR
+
+    #plant: leaves around the center, overlapping so they are one or a few close components
+    leaf_mask = np.zeros((height, width), np.uint8)
+    center = np.array([width / 2, height / 2])
+    plant_radius = min(width, height) * 0.2
+    for _ in range(12):
+        offset = rng.normal(0, plant_radius / 2.5, 2)
+        #a leaf standing apart must survive the component filtering
+        area = max(rng.uniform(0.02, 0.06) * np.pi * plant_radius ** 2, 1.5 * min_component_size)
+        _ellipse(leaf_mask, rng, center + offset, area, 255)
+    leaf_pixels = cv2.countNonZero(leaf_mask)
+    leaf_color = LEAF_COLORS[int(rng.integers(len(LEAF_COLORS)))]
+    image[leaf_mask > 0] = leaf_color
+
+    #reference card in a corner, square of a known size
+    card_side = int(min(width, height) * 0.06)
+    card_x, card_y = int(width * 0.05), int(height * 0.05)
+    image[card_y:card_y + card_side, card_x:card_x + card_side] = CARD_COLOR
+    card_pixels = card_side * card_side
+
+    #stray green noise away from the plant and the card, spaced so it never grows into
+    #larger components, and large components never merge with each other or the plant
+    largest_noise_radius = np.sqrt(2.0 * min_component_size / (np.pi * 0.4))
+    keep_out = plant_radius * 1.8 + max_distance + largest_noise_radius
+    levels = CLUTTER_LEVELS[clutter]
+    small_count = int(round(levels['small_per_mp'] * megapixels))
+    placed = []
+    for kind, count in (('large', levels['large']), ('small', small_count)):
+        attempts = 0
+        remaining = count
+        #give up on crowded small images rather than loop forever
+        while remaining and attempts < 200 * count:
+            attempts += 1
+            if kind == 'small':
+                area = rng.uniform(0.02, 0.3) * min_component_size
+            else:
+                area = rng.uniform(1.2, 2.0) * min_component_size
+            radius = np.sqrt(area / (np.pi * 0.4))
+            point = rng.uniform((radius, radius), (width - radius, height - radius))
+            if np.linalg.norm(point - center) < keep_out:
+                continue
+            if card_x - radius - 20 < point[0] < card_x + card_side + radius + 20 and card_y - radius - 20 < point[1] < card_y + card_side + radius + 20:
+                continue
+            gap = max_distance if kind == 'large' else 10
+            if any(np.linalg.norm(point - other) < radius + other_radius + gap for other, other_radius in placed):
+                continue
+            _ellipse(image, rng, point, area, LEAF_COLORS[int(rng.integers(len(LEAF_COLORS)))])
+            placed.append((point, radius))
+            remaining -= 1
+
+    #sensor noise
+    if noise_sigma:
+        noise = rng.normal(0, noise_sigma, image.shape)
+        image = np.clip(image + noise, 0, 255).astype(np.uint8)
+
+    truth = {
+        'width': width,
+        'height': height,
+        'clutter': clutter,
+        'leaf_pixels': leaf_pixels,
+        'card_pixels': card_pixels,
+        'leaf_area_cm2': leaf_pixels / card_pixels * card_area_cm2,
+    }
+    return image, truth
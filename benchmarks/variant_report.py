@@ -0,0 +1,117 @@
+"""
+Accuracy and timing report of the pipeline variants.
+
+Description:
+    Processes a folder of images with the default pipeline and with each
+    variant (coarse to fine detection at several scales, mask-first morphology),
+    then reports the green pixel, leaf area and convex hull differences per
+    image and the time taken, so a variant can be adopted with confidence.
+
+Usage:
+    python benchmarks/variant_report.py /path/to/folder --scales 0.5 0.25 --mask-first --csv report.csv
+"""
+
+
+import argparse
+import contextlib
+import csv
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from batch import list_image_files
+from pipeline import process_image
+
+
+#relative difference in percent, 0 when both are 0
+def relative_error(value, reference):
+    if reference == 0:
+        return 0.0 if value == 0 else float('inf')
+    return (value - reference) / reference * 100
+
+
+#process an image without the pixel count prints of the pipeline
+def timed_process(image_path, params):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        _, metrics = process_image(image_path, params)
+    return metrics, time.perf_counter() - start
+
+
+#readable name of a variant
+def variant_name(params):
+    return ",".join(f"{key}={value}" for key, value in params.items()) or "default"
+
+
+#variants asked on the command line
+def variants_from_args(args):
+    variants = [{'detection_scale': scale} for scale in args.scales]
+    if args.mask_first:
+        variants.append({'morphology': 'mask'})
+        variants.extend({'morphology': 'mask', 'detection_scale': scale} for scale in args.scales)
+    return variants
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare pipeline variants against the default pipeline.")
+    parser.add_argument('folder', help="folder containing the images")
+    parser.add_argument('--scales', type=float, nargs='*', default=[], help="detection scales of the coarse to fine variant")
+    parser.add_argument('--mask-first', action='store_true', help="add the mask-first morphology variant")
+    parser.add_argument('--csv', default=None, help="csv file to write the per image report to")
+    args = parser.parse_args(argv)
+
+    variants = variants_from_args(args)
+    if not variants:
+        parser.error("nothing to compare, give --scales and/or --mask-first")
+
+    rows = []
+    names = ["default"] + [variant_name(params) for params in variants]
+    totals = {name: {'time': 0.0, 'green_errors': [], 'errors': [], 'hull_errors': [], 'failed': 0} for name in names}
+    for image_path in list_image_files(args.folder):
+        reference, reference_time = timed_process(image_path, None)
+        totals["default"]['time'] += reference_time
+        if reference is None:
+            print(f"{os.path.basename(image_path)}: cannot be measured by the default pipeline, skipped")
+            continue
+        for params in variants:
+            name = variant_name(params)
+            metrics, elapsed = timed_process(image_path, params)
+            totals[name]['time'] += elapsed
+            if metrics is None:
+                totals[name]['failed'] += 1
+                continue
+            green_difference = metrics['number_of_green_pixels'] - reference['number_of_green_pixels']
+            leaf_error = relative_error(metrics['leaf_area_cm2'], reference['leaf_area_cm2'])
+            hull_error = relative_error(metrics['convex_hull_cm2'], reference['convex_hull_cm2'])
+            totals[name]['green_errors'].append(abs(relative_error(metrics['number_of_green_pixels'], reference['number_of_green_pixels'])))
+            totals[name]['errors'].append(abs(leaf_error))
+            totals[name]['hull_errors'].append(abs(hull_error))
+            rows.append([os.path.basename(image_path), name, reference['number_of_green_pixels'], green_difference,
+                         reference['leaf_area_cm2'], metrics['leaf_area_cm2'], leaf_error,
+                         reference['convex_hull_cm2'], metrics['convex_hull_cm2'], hull_error, reference_time, elapsed])
+
+    print(f"{'variant':>36} {'time s':>8} {'speedup':>8} {'max |green| %':>14} {'mean |leaf| %':>14} "
+          f"{'max |leaf| %':>13} {'max |hull| %':>13} {'failed':>7}")
+    for name, total in totals.items():
+        speedup = totals["default"]['time'] / total['time'] if total['time'] else 0
+        green_errors = total['green_errors'] or [0.0]
+        errors = total['errors'] or [0.0]
+        hull_errors = total['hull_errors'] or [0.0]
+        print(f"{name:>36} {total['time']:>8.2f} {speedup:>7.2f}x {max(green_errors):>14.3f} {sum(errors) / len(errors):>14.3f} "
+              f"{max(errors):>13.3f} {max(hull_errors):>13.3f} {total['failed']:>7}")
+
+    if args.csv:
+        with open(args.csv, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(['Image Filename', 'Variant', 'Number of Green Pixels', 'Green Pixel Difference',
+                             'Leaf Area cm2', 'Variant Leaf Area cm2', 'Leaf Area Error %', 'Convex Hull Area',
+                             'Variant Convex Hull Area', 'Convex Hull Error %', 'Default Time s', 'Variant Time s'])
+            writer.writerows(rows)
+        print("CSV file saved to:", args.csv)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,366 @@
+"""
+Caches of PhenoScan Cassava.
+
+Description:
+    Memory-budgeted cache for the processed images. Entries are evicted least
+    recently used first once the byte budget is reached, and a missing entry is
+    recomputed through the loader so callers never see the eviction.
+
+    Persistent result store keyed by the content of the image and the pipeline
+    parameters, so re-opening a folder only processes new or changed images.
+    The store keeps the masks of a result (see masks.py) and small previews,
+    the full processed image is rebuilt from the masks and the source image
+    when it is needed. Every process appends the masks to a pack of its own,
+    the packs no result points to any more are deleted when the store opens.
+"""
+
+
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+import psutil
+
+from masks import PackReader, append_arrays, pack_owner, pack_path
+from pipeline import PIPELINE_VERSION, make_preview, render_preview, render_result, resolve_params
+
+
+#fraction of the available memory given to the image cache by default
+DEFAULT_BUDGET_FRACTION = 0.25
+
+#byte budget of the preview cache, previews are small so it holds thousands of them
+DEFAULT_PREVIEW_BUDGET = 256 * 1024 * 1024
+
+#seconds an unused pack is kept after its last write, its writer may not have recorded its results yet
+PACK_GRACE_SECONDS = 24 * 3600
+
+
+#default byte budget of the image cache
+def default_cache_budget(fraction=DEFAULT_BUDGET_FRACTION):
+    return int(psutil.virtual_memory().available * fraction)
+
+
+#size of a cached value in bytes
+def sizeof_image(image):
+    return getattr(image, 'nbytes', 0)
+
+
+class ImageCache:
+    #loader(key) is called on a miss to recompute or reload the value
+    def __init__(self, max_bytes=None, loader=None, sizeof=sizeof_image):
+        self.max_bytes = max_bytes if max_bytes is not None else default_cache_budget()
+        self.loader = loader
+        self.sizeof = sizeof
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __getitem__(self, key):
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+            self.misses += 1
+        if self.loader is None:
+            raise KeyError(key)
+
+        #load outside the lock, it may take a while
+        value = self.loader(key)
+        self[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            self._discard(key)
+            #a value larger than the whole budget is never kept
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._discard(oldest)
+                self.evictions += 1
+
+    def __delitem__(self, key):
+        with self._lock:
+            if key not in self._entries:
+                raise KeyError(key)
+            self._discard(key)
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= entry[1]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    #the value when it is cached, the loader is never called
+    def peek(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    #hit, miss and eviction counters
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+#default folder of the persistent result store
+def default_store_directory():
+    return os.path.join(os.path.expanduser("~"), ".phenoscan_cassava", "results")
+
+
+#content hash of a file, read in chunks so large images are not loaded at once
+def file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+#path of the stored image of a result
+def blob_path(blob_directory, key):
+    return os.path.join(blob_directory, key[:2], f"{key}.png")
+
+
+#path of a stored preview of a result
+def preview_path(blob_directory, key, size):
+    return os.path.join(blob_directory, key[:2], f"{key}_{size}.jpg")
+
+
+#write an rgb image through a temporary file so a crash never leaves half an image
+def _write_image(path, image, encode_params):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    root, extension = os.path.splitext(path)
+    temporary_path = f"{root}.{os.getpid()}.tmp{extension}"
+    cv2.imwrite(temporary_path, cv2.cvtColor(image, cv2.COLOR_RGB2BGR), encode_params)
+    os.replace(temporary_path, path)
+    return path
+
+
+#write the previews of a result and append its masks (see pipeline.process_image) to the pack of the process
+#returns the location of the masks for ResultStore.put, None without masks, safe to call from worker processes
+def save_result(blob_directory, key, masks=None, previews=None):
+    for size, preview in (previews or {}).items():
+        _write_image(preview_path(blob_directory, key, size), preview, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    if masks is None:
+        return None
+    path = pack_path(blob_directory)
+    offset = append_arrays(path, (masks['green'], masks['blue'], masks['hull']))
+    return {'pack': os.path.basename(path), 'offset': offset, 'shape': masks['shape'],
+            'counts': (len(masks['green']), len(masks['blue']), masks['hull'].size)}
+
+
+#types of the arrays of a masks record on a pack
+MASK_DTYPES = (np.uint32, np.uint32, np.int32)
+
+
+class ResultStore:
+    #persistent results keyed by image content and pipeline parameters
+    #metrics live in sqlite, the masks and previews in a blob folder next to it
+    def __init__(self, directory=None):
+        self.directory = directory or default_store_directory()
+        self.blob_directory = os.path.join(self.directory, "blobs")
+        os.makedirs(self.blob_directory, exist_ok=True)
+        self._packs = PackReader(self.blob_directory)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(os.path.join(self.directory, "results.sqlite3"), check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest TEXT)")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, metrics TEXT, created REAL)")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS masks (key TEXT PRIMARY KEY, pack TEXT, offset INTEGER, height INTEGER,"
+                " width INTEGER, green_runs INTEGER, blue_runs INTEGER, hull_values INTEGER)")
+        self.remove_unused_packs()
+
+    #delete the packs no result points to: their results were replaced, or their process stopped before
+    #recording them. the packs of the processes still running on this host and the packs written in the
+    #last grace_seconds are kept, their results may be recorded next. returns the names of the removed packs
+    def remove_unused_packs(self, grace_seconds=PACK_GRACE_SECONDS):
+        with self._lock:
+            used = {row[0] for row in self._connection.execute("SELECT DISTINCT pack FROM masks")}
+        hostname = socket.gethostname()
+        now = time.time()
+        removed = []
+        with os.scandir(self.blob_directory) as entries:
+            for entry in entries:
+                owner = pack_owner(entry.name)
+                if owner is None or entry.name in used:
+                    continue
+                if owner[0] == hostname and psutil.pid_exists(owner[1]):
+                    continue
+                try:
+                    if now - entry.stat().st_mtime < grace_seconds:
+                        continue
+                    os.remove(entry.path)
+                except OSError:
+                    #removed by another store opening at the same time, or still open elsewhere
+                    continue
+                removed.append(entry.name)
+        return removed
+
+    #content hash of an image known from a previous run, None if the file is new, changed or gone
+    #a file removed since it was listed is reported by the worker reading it
+    def known_digest(self, image_path):
+        try:
+            stat = os.stat(image_path)
+        except OSError:
+            return None
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT size, mtime_ns, digest FROM files WHERE path = ?", (os.path.abspath(image_path),)).fetchone()
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+        return None
+
+    #remember the content hash of an image hashed elsewhere, stat is the os.stat of the hashed content
+    def remember_digest(self, image_path, stat, digest):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                (os.path.abspath(image_path), stat.st_size, stat.st_mtime_ns, digest))
+
+    #content hash of an image, rehashed only when its size or modification time changed
+    def digest(self, image_path):
+        digest = self.known_digest(image_path)
+        if digest is None:
+            stat = os.stat(image_path)
+            digest = file_digest(image_path)
+            self.remember_digest(image_path, stat, digest)
+        return digest
+
+    #key of the result of an image processed with the given parameters
+    #digest is the content hash when it is already known
+    def result_key(self, image_path, params=None, digest=None):
+        settings = json.dumps(resolve_params(params), sort_keys=True)
+        key = f"{digest or self.digest(image_path)}:{settings}:{PIPELINE_VERSION}"
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._connection.execute("SELECT 1 FROM results WHERE key = ?", (key,)).fetchone() is not None
+
+    #stored metrics of a result, raises KeyError if the result is not stored
+    #the metrics are None for images that could not be measured
+    def get_metrics(self, key):
+        with self._lock:
+            row = self._connection.execute("SELECT metrics FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    #masks of a result as read only views on its pack, None if they are not stored
+    def load_masks(self, key):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT pack, offset, height, width, green_runs, blue_runs, hull_values FROM masks WHERE key = ?",
+                (key,)).fetchone()
+        if row is None:
+            return None
+        pack, offset, height, width, *counts = row
+        arrays = self._packs.read(pack, offset, counts, MASK_DTYPES)
+        if arrays is None:
+            return None
+        green, blue, hull = arrays
+        return {'shape': (height, width), 'green': green, 'blue': blue, 'hull': hull.reshape(-1, 2)}
+
+    #rgb image of a result, None if it cannot be made
+    #it is rebuilt from the masks and image_path, results of older versions are read from their png
+    def load_image(self, key, image_path=None):
+        path = blob_path(self.blob_directory, key)
+        image = cv2.imread(path) if os.path.exists(path) else None
+        if image is not None:
+            return cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=image)
+        masks = self.load_masks(key)
+        if masks is None and key not in self:
+            return None
+        source = cv2.imread(image_path) if image_path else None
+        if source is None and masks is None:
+            return None
+        return render_result(masks, source)
+
+    #stored preview of a result, for results stored without it the preview is rendered from the masks and
+    #the source image decoded at a reduced scale, or made from the full image when that is not possible
+    def load_preview(self, key, size, image_path=None):
+        preview = cv2.imread(preview_path(self.blob_directory, key, size))
+        if preview is not None:
+            return cv2.cvtColor(preview, cv2.COLOR_BGR2RGB, dst=preview)
+
+        masks = self.load_masks(key)
+        preview = render_preview(masks, image_path, size) if masks is not None and image_path else None
+        if preview is None:
+            image = self.load_image(key, image_path)
+            if image is None:
+                return None
+            preview = make_preview(image, size)
+        _write_image(preview_path(self.blob_directory, key, size), preview, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        return preview
+
+    #record a result whose masks were already written with save_result, masks is the location it returned
+    def put(self, key, metrics, masks=None):
+        if metrics is not None:
+            #numpy integers are not json serializable
+            metrics = {name: value.item() if hasattr(value, 'item') else value for name, value in metrics.items()}
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?)", (key, json.dumps(metrics), time.time()))
+            if masks is not None:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO masks VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (key, masks['pack'], masks['offset'], *masks['shape'], *masks['counts']))
+
+    #store the metrics, the masks and the previews of a result
+    def save(self, key, metrics, masks=None, previews=None):
+        self.put(key, metrics, save_result(self.blob_directory, key, masks, previews))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,129 @@
+"""
+Reference card of PhenoScan Cassava.
+
+Description:
+    Finds the blue calibration card (blue_area_cm2 square cm) on a mask of
+    the blue pixels of an image. Counting every blue pixel of the image lets
+    any blue object of the scene (a label, a glove, a reflection) add to the
+    card and shrink every area converted with it. The card is the largest
+    blue component with the shape of a card instead: about rectangular,
+    mostly filled and not too elongated.
+
+    On a fixed rig the card stays in place from one image to the next.
+    CardTracker remembers where it was and the next image is measured in a
+    small region around it first. It is opt-in (the card_tracking parameter)
+    and only a hint: pipeline.locate_card keeps the card of the region only
+    when the search of the whole image finds the card there too.
+"""
+
+
+import cv2
+import numpy as np
+
+
+#'component' measures the card as the largest blue component with the shape of a card,
+#'threshold' counts every blue pixel of the image like the first versions did
+CARD_MODES = ('component', 'threshold')
+
+#smallest card, in pixels of the mask it is found on
+MIN_CARD_PIXELS = 64
+
+#longest over shortest side of the rotated rectangle around the card
+MAX_CARD_ASPECT = 4.0
+
+#share of the rotated rectangle around the card covered by its pixels, a leaf over a corner lowers it
+MIN_CARD_FILL = 0.5
+
+#largest blue components checked for the shape of a card
+MAX_CARD_CANDIDATES = 8
+
+#margin of the region searched around the previous card, as a share of its longest side and in pixels at least
+CARD_REGION_MARGIN = 0.5
+MIN_CARD_REGION_MARGIN = 16
+
+#change of the pixel count past which a card found in the region is not taken for the previous one
+CARD_PIXEL_TOLERANCE = 0.2
+
+
+#whether a component has the shape of a card, from its outer contour and its pixel count
+def plausible_card(contour, pixels):
+    _, (width, height), _ = cv2.minAreaRect(contour)
+    if min(width, height) < 1:
+        return False
+    return max(width, height) / min(width, height) <= MAX_CARD_ASPECT and pixels / (width * height) >= MIN_CARD_FILL
+
+
+#the card on a blue mask as {'box': (x, y, width, height), 'pixels': count, 'mask': the card on its box}
+#None when there is none, mode is one of CARD_MODES
+def find_card(blue_mask, mode='component'):
+    if mode == 'threshold':
+        points = cv2.findNonZero(blue_mask)
+        if points is None:
+            return None
+        x, y, width, height = cv2.boundingRect(points)
+        mask = blue_mask[y:y + height, x:x + width]
+        return {'box': (x, y, width, height), 'pixels': cv2.countNonZero(mask), 'mask': mask}
+    if mode != 'component':
+        raise ValueError(f"Unknown card mode: {mode}")
+
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(blue_mask, connectivity=8)
+    areas = stats[1:, cv2.CC_STAT_AREA]
+    #largest first, the first one with the shape of a card is the card
+    for label in np.argsort(-areas, kind='stable')[:MAX_CARD_CANDIDATES] + 1:
+        pixels = int(stats[label, cv2.CC_STAT_AREA])
+        if pixels < MIN_CARD_PIXELS:
+            break
+        x, y, width, height = (int(value) for value in stats[label, :4])
+        mask = np.where(labels[y:y + height, x:x + width] == label, np.uint8(255), np.uint8(0))
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        if plausible_card(np.vstack(contours), pixels):
+            return {'box': (x, y, width, height), 'pixels': pixels, 'mask': mask}
+    return None
+
+
+class CardTracker:
+    #where the card was on the previous image of a sequence, the next image is searched there first
+    #it is only a hint, a card not found in the region is searched on the whole image
+    def __init__(self):
+        self.box = None
+        self.pixels = None
+        #images whose card was found in the region, and searched whole
+        self.hits = 0
+        self.misses = 0
+
+    #region (x, y, width, height) of an image of this shape to search first, None without a previous card
+    def region(self, shape):
+        if self.box is None:
+            return None
+        x, y, width, height = self.box
+        margin = max(MIN_CARD_REGION_MARGIN, int(CARD_REGION_MARGIN * max(width, height)))
+        x0, y0 = max(0, x - margin), max(0, y - margin)
+        x1, y1 = min(shape[1], x + width + margin), min(shape[0], y + height + margin)
+        if x1 <= x0 or y1 <= y0:
+            return None
+        return x0, y0, x1 - x0, y1 - y0
+
+    #whether a card found in the region, with its box on the image, is the previous card: about as large
+    #and not cut by the region, a card touching its edge may go on outside unless it is the edge of the image
+    def matches(self, card, region, shape):
+        if card is None:
+            return False
+        x, y, width, height = card['box']
+        region_x, region_y, region_width, region_height = region
+        if ((x == region_x and region_x > 0) or (y == region_y and region_y > 0)
+                or (x + width == region_x + region_width and region_x + region_width < shape[1])
+                or (y + height == region_y + region_height and region_y + region_height < shape[0])):
+            return False
+        return abs(card['pixels'] - self.pixels) <= CARD_PIXEL_TOLERANCE * self.pixels
+
+    #remember the card of an image, hit tells whether it was found in the region
+    def update(self, card, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        self.box, self.pixels = (card['box'], card['pixels']) if card else (None, None)
+
+
+#tracker of the images measured by this process, every worker process of a pool has its own
+process_tracker = CardTracker()
@@ -0,0 +1,466 @@
+"""
+Export of PhenoScan Cassava.
+
+Description:
+    Saves the processed images to a folder. The free filenames are resolved up
+    front from a single scan of the folder, and the images are encoded on a
+    thread pool (the encoders release the GIL) with a bounded number of images
+    in flight so exporting a large session does not hold it all in memory.
+
+    Writes the results as CSV, JSON Lines or Parquet while the images finish.
+    A manifest next to the results records what was written with the size and
+    modification time of every image, so a rerun over a partially processed
+    folder skips what is already recorded, but not an image replaced since.
+"""
+
+
+import csv
+import hashlib
+import io
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from PIL import Image
+
+from pipeline import PIPELINE_VERSION, resolve_params
+from profiling import NULL_PROFILER, Profiler
+
+
+#supported formats, the quality value is the JPEG/WebP quality or the PNG compression level
+EXPORT_FORMATS = {
+    'jpeg': {'extension': '.jpg', 'pil_format': 'JPEG', 'option': 'quality', 'default': 95},
+    'png': {'extension': '.png', 'pil_format': 'PNG', 'option': 'compress_level', 'default': 3},
+    'webp': {'extension': '.webp', 'pil_format': 'WEBP', 'option': 'quality', 'default': 90},
+}
+
+
+#number of encoding threads when none is given
+def default_export_workers():
+    return min(4, os.cpu_count() or 1)
+
+
+#save an rgb image, no BGR copy is needed since pillow encodes rgb directly
+#with a profiler the encoding and the disk write are timed apart
+def save_image(path, image, image_format='jpeg', quality=None, profiler=NULL_PROFILER):
+    settings = EXPORT_FORMATS[image_format]
+    value = settings['default'] if quality is None else quality
+    if profiler is NULL_PROFILER:
+        Image.fromarray(image).save(path, format=settings['pil_format'], **{settings['option']: value})
+        return
+    with profiler.stage('encode'):
+        encoded = io.BytesIO()
+        Image.fromarray(image).save(encoded, format=settings['pil_format'], **{settings['option']: value})
+    with profiler.stage('write'):
+        with open(path, 'wb') as f:
+            f.write(encoded.getbuffer())
+
+
+#find a unique filename for every image from a single scan of each output folder
+#same naming as before: name.jpg, then name(1).jpg, name(2).jpg...
+#with source_root the images keep their subfolders below it, which are created on save_directory
+def resolve_save_paths(image_paths, save_directory, extension, source_root=None):
+    #names taken per output folder, normcase so names differing only by case collide on windows like they do on disk
+    taken = {}
+    save_paths = {}
+    for image_path in image_paths:
+        directory = save_directory
+        if source_root is not None:
+            directory = os.path.normpath(os.path.join(save_directory, os.path.relpath(os.path.dirname(image_path), source_root)))
+        if directory not in taken:
+            os.makedirs(directory, exist_ok=True)
+            taken[directory] = {os.path.normcase(entry.name) for entry in os.scandir(directory)}
+        base_filename = os.path.splitext(os.path.basename(image_path))[0]
+        new_filename = f"{base_filename}{extension}"
+        counter = 1
+        while os.path.normcase(new_filename) in taken[directory]:
+            new_filename = f"{base_filename}({counter}){extension}"
+            counter += 1
+        taken[directory].add(os.path.normcase(new_filename))
+        save_paths[image_path] = os.path.join(directory, new_filename)
+    return save_paths
+
+
+#export the images and yield (image_path, save_path, error) as each one is saved
+#load_image(image_path) returns the rgb image, it runs on the export threads
+#at most max_in_flight images are being loaded or encoded at the same time
+#on_profile(record) receives the timed stages of every image when it is given
+#with source_root the images keep their subfolders below it (see resolve_save_paths)
+def export_images(image_paths, save_directory, load_image, image_format='jpeg', quality=None, workers=None,
+                  max_in_flight=None, on_profile=None, source_root=None):
+    workers = workers or default_export_workers()
+    max_in_flight = max_in_flight or workers
+    save_paths = resolve_save_paths(image_paths, save_directory, EXPORT_FORMATS[image_format]['extension'], source_root)
+
+    def export_one(image_path):
+        if on_profile is None:
+            save_image(save_paths[image_path], load_image(image_path), image_format, quality)
+            return
+        #the threads share the process so only the wall time is measured
+        profiler = Profiler(trace_memory=False)
+        with profiler.stage('load'):
+            image = load_image(image_path)
+        save_image(save_paths[image_path], image, image_format, quality, profiler)
+        on_profile(profiler.record(image_path, kind='export'))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        remaining = iter(image_paths)
+        in_flight = {}
+        while True:
+            #keep the window full
+            for image_path in remaining:
+                in_flight[executor.submit(export_one, image_path)] = image_path
+                if len(in_flight) >= max_in_flight:
+                    break
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                image_path = in_flight.pop(future)
+                error = future.exception()
+                yield image_path, save_paths[image_path], error
+
+
+CSV_HEADER = ['Image Filename', 'Leaf Area cm2', 'Number of Green Pixels', 'Number of Blue Pixels', 'Convex Hull Area', 'Convex Hull Pixels',
+              'Card X', 'Card Y', 'Card Width', 'Card Height', 'Pixels per cm2']
+
+#keys of the metrics in the order of the csv columns
+METRIC_KEYS = ['leaf_area_cm2', 'number_of_green_pixels', 'number_of_blue_pixels', 'convex_hull_cm2', 'convex_hull_pixels',
+               'card_x', 'card_y', 'card_width', 'card_height', 'pixels_per_cm2']
+
+#metrics that are fractional, the others are pixel counts and positions
+FLOAT_METRIC_KEYS = ('leaf_area_cm2', 'convex_hull_cm2', 'pixels_per_cm2')
+
+RESULT_FORMATS = ('csv', 'jsonl', 'parquet')
+
+
+#name of an image on the results, its path below root_path with / separators so the images of
+#different subfolders sharing a filename can be told apart, its filename without a root
+def image_name(image_path, root_path=None):
+    if root_path is None:
+        return os.path.basename(image_path)
+    return os.path.relpath(image_path, root_path).replace(os.sep, '/')
+
+
+#write the values of leaf_area_dict with the same columns as the application
+#the images are named by their path below root_path when it is given (see image_name)
+def write_results_csv(file_path, leaf_area_dict, root_path=None):
+    with open(file_path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        #write the header row
+        writer.writerow(CSV_HEADER)
+        #write each key-value pair from the dictionary to a separate row
+        for image_path, data in leaf_area_dict.items():
+            filename = image_name(image_path, root_path)
+            writer.writerow([filename] + [data[key] for key in METRIC_KEYS])
+
+
+#metrics with plain python numbers, numpy integers are not json serializable
+def plain_metrics(metrics):
+    if metrics is None:
+        return None
+    return {key: value.item() if hasattr(value, 'item') else value for key, value in metrics.items()}
+
+
+#format of a results file from its extension
+def result_format_for(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.jsonl', '.json'):
+        return 'jsonl'
+    if extension == '.parquet' or os.path.isdir(path):
+        return 'parquet'
+    return 'csv'
+
+
+#results of a session of the GUI, kept out of the image folder
+def session_results_path(folder_path):
+    folder_path = os.path.abspath(folder_path)
+    digest = hashlib.sha1(folder_path.encode()).hexdigest()[:10]
+    name = os.path.basename(folder_path.rstrip(os.sep)) or "root"
+    return os.path.join(os.path.expanduser("~"), ".phenoscan_cassava", "sessions", f"{name}-{digest}.csv")
+
+
+#path of the manifest of a results file
+def manifest_path_for(path):
+    return f"{path.rstrip(os.sep)}.manifest.jsonl"
+
+
+#settings recorded with every result, a result is only reused with the same parameters and pipeline version
+def results_settings(params=None):
+    return json.dumps({'params': resolve_params(params), 'pipeline_version': PIPELINE_VERSION}, sort_keys=True)
+
+
+#size and modification time of an image, recorded on the manifest with its metrics, None when it cannot be read
+#source_root is the folder a relative image path is relative to, e.g. the root of a shard run
+def file_state(image_path, source_root=None):
+    try:
+        stat = os.stat(os.path.join(source_root, image_path) if source_root else image_path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+#last record of every image on the manifest of a results file with the given settings, and the number
+#of lines of the manifest, every other line is a record replaced or made with other settings
+#an image whose size or modification time changed since it was recorded is left out, so it is processed again
+def _manifest_records(path, settings, source_root=None):
+    records = {}
+    lines = 0
+    manifest_path = manifest_path_for(path)
+    if not os.path.exists(manifest_path):
+        return records, lines
+    with open(manifest_path, encoding='utf-8') as f:
+        for line in f:
+            lines += 1
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  #line cut short by a crash
+            if record.get('settings') != settings:
+                continue
+            #records written before the file state was kept, and images not readable from here, are trusted
+            state = record.get('file')
+            records.pop(record['image_path'], None)
+            if state is not None and file_state(record['image_path'], source_root) not in (None, state):
+                continue
+            records[record['image_path']] = record
+    return records, lines
+
+
+#metrics per image path recorded on the manifest of a results file with the given parameters,
+#None for images that could not be measured, source_root is the folder relative image paths are relative to
+def read_manifest(path, params=None, source_root=None):
+    records, _ = _manifest_records(path, results_settings(params), source_root)
+    return {image_path: record['metrics'] for image_path, record in records.items()}
+
+
+#replace a results file or folder with a new one written next to it
+def _replace(new_path, path):
+    if os.path.isdir(path):
+        old_path = f"{path}.{os.getpid()}.old"
+        os.replace(path, old_path)
+        os.replace(new_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+    else:
+        os.replace(new_path, path)
+
+
+#flush a file and make sure it reached the disk
+def _fsync(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+
+class _CsvSink:
+    #a file written with other columns by an older version is kept aside with the time it was moved and a new one is started
+    #the images are named by their path below root_path when it is given (see image_name)
+    def __init__(self, path, root_path=None):
+        self._root_path = root_path
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, newline='') as f:
+                header = next(csv.reader(f), None)
+            if header != CSV_HEADER:
+                root, extension = os.path.splitext(path)
+                os.replace(path, f"{root}.old-{time.strftime('%Y%m%d-%H%M%S')}{extension}")
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, 'a', newline='')
+        self._writer = csv.writer(self._file)
+        if new_file:
+            self._writer.writerow(CSV_HEADER)
+
+    #rows of a results file, the header aside
+    @staticmethod
+    def count_rows(path):
+        if not os.path.exists(path):
+            return 0
+        with open(path, newline='') as f:
+            return max(0, sum(1 for _ in csv.reader(f)) - 1)
+
+    def write(self, image_path, metrics):
+        self._writer.writerow([image_name(image_path, self._root_path)] + [metrics[key] for key in METRIC_KEYS])
+
+    def sync(self):
+        _fsync(self._file)
+
+    def close(self):
+        self._file.close()
+
+
+class _JsonlSink:
+    def __init__(self, path, root_path=None):
+        self._root_path = root_path
+        self._file = open(path, 'a', encoding='utf-8')
+
+    @staticmethod
+    def count_rows(path):
+        if not os.path.exists(path):
+            return 0
+        with open(path, encoding='utf-8') as f:
+            return sum(1 for _ in f)
+
+    def write(self, image_path, metrics):
+        record = {'image_filename': image_name(image_path, self._root_path), 'image_path': image_path}
+        record.update(metrics)
+        self._file.write(json.dumps(record) + "\n")
+
+    def sync(self):
+        _fsync(self._file)
+
+    def close(self):
+        self._file.close()
+
+
+class _ParquetSink:
+    #the path is a folder and every sync writes a complete part file,
+    #a parquet file is unreadable until its footer is written so appending to one is not durable
+    def __init__(self, path, root_path=None):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Parquet results need pyarrow: pip install pyarrow")
+        self._pyarrow = pyarrow
+        self._parquet = pyarrow.parquet
+        self._path = path
+        self._root_path = root_path
+        self._rows = []
+        #explicit types, a column that is None on every row of a part would otherwise be typed null there
+        self._schema = pyarrow.schema(
+            [('image_filename', pyarrow.string()), ('image_path', pyarrow.string())]
+            + [(key, pyarrow.float64() if key in FLOAT_METRIC_KEYS else pyarrow.int64()) for key in METRIC_KEYS])
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def count_rows(path):
+        if not os.path.isdir(path):
+            return 0
+        import pyarrow.parquet
+        return sum(pyarrow.parquet.read_metadata(os.path.join(path, name)).num_rows
+                   for name in os.listdir(path) if name.endswith('.parquet'))
+
+    def write(self, image_path, metrics):
+        row = {'image_filename': image_name(image_path, self._root_path), 'image_path': image_path}
+        row.update(metrics)
+        self._rows.append(row)
+
+    def sync(self):
+        if not self._rows:
+            return
+        part_path = os.path.join(self._path, f"part-{time.time_ns()}-{os.getpid()}.parquet")
+        self._parquet.write_table(self._pyarrow.Table.from_pylist(self._rows, schema=self._schema), part_path)
+        with open(part_path, 'rb') as f:
+            os.fsync(f.fileno())
+        self._rows = []
+
+    def close(self):
+        self.sync()
+
+
+class ResultsWriter:
+    #appends each result to the results file as soon as it is written
+    #files are fsynced every sync_every results or sync_interval seconds, whichever comes first
+    #the manifest is only written after the results reached the disk, so a crash may at worst
+    #repeat a row on the rerun but never skips an image whose row was lost
+    #on opening, a file holding other rows than the last record of every image (records replaced by other
+    #parameters or a changed image, rows repeated after a crash) is rewritten with one row per image
+    #the rows name the images by their path below root_path when it is given (see image_name)
+    #source_root is the folder the image paths are relative to when they are relative (see file_state)
+    def __init__(self, path, result_format=None, params=None, sync_every=20, sync_interval=2.0, root_path=None,
+                 source_root=None):
+        self.path = path
+        self.result_format = result_format or result_format_for(path)
+        if self.result_format not in RESULT_FORMATS:
+            raise ValueError(f"Unknown results format: {self.result_format}")
+        self.manifest_path = manifest_path_for(path)
+        self.settings = results_settings(params)
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        #records of previous runs made with the same parameters
+        self._source_root = source_root
+        records, lines = _manifest_records(path, self.settings, source_root)
+        self._recorded = {image_path: record['metrics'] for image_path, record in records.items()}
+        self._lock = threading.Lock()
+        self._sink_class = {'csv': _CsvSink, 'jsonl': _JsonlSink, 'parquet': _ParquetSink}[self.result_format]
+        self._root_path = root_path
+        #the sink keeps aside a file written with older columns before the rows are counted
+        self._sink = self._sink_class(path, root_path)
+        measured = sum(metrics is not None for metrics in self._recorded.values())
+        if lines != len(records) or self._sink_class.count_rows(path) != measured:
+            self._compact(records)
+        self._manifest = open(self.manifest_path, 'a', encoding='utf-8')
+        self._unsynced = []
+        self._last_sync = time.monotonic()
+
+    #rewrite the results and the manifest with the given records only, next to them first so a crash
+    #leaves either file whole, the results go first since a longer manifest is compacted again next time
+    def _compact(self, records):
+        self._sink.close()
+        temporary_path = f"{self.path.rstrip(os.sep)}.{os.getpid()}.tmp"
+        sink = self._sink_class(temporary_path, self._root_path)
+        for image_path, record in records.items():
+            if record['metrics'] is not None:
+                sink.write(image_path, record['metrics'])
+        sink.sync()
+        sink.close()
+        _replace(temporary_path, self.path)
+
+        temporary_manifest_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(temporary_manifest_path, 'w', encoding='utf-8') as f:
+            for record in records.values():
+                f.write(json.dumps(record) + "\n")
+            _fsync(f)
+        os.replace(temporary_manifest_path, self.manifest_path)
+        self._sink = self._sink_class(self.path, self._root_path)
+
+    #metrics already recorded per image path, None for images that could not be measured
+    def recorded(self):
+        with self._lock:
+            return dict(self._recorded)
+
+    def __contains__(self, image_path):
+        with self._lock:
+            return image_path in self._recorded
+
+    #record the result of an image, metrics is None when it could not be measured
+    def write(self, image_path, metrics):
+        metrics = plain_metrics(metrics)
+        with self._lock:
+            #images that could not be measured are not exported, like on save_to_csv
+            if metrics is not None:
+                self._sink.write(image_path, metrics)
+            self._unsynced.append({'image_path': image_path, 'metrics': metrics, 'settings': self.settings,
+                                   'file': file_state(image_path, self._source_root)})
+            self._recorded[image_path] = metrics
+            if len(self._unsynced) >= self.sync_every or time.monotonic() - self._last_sync >= self.sync_interval:
+                self._sync()
+
+    def sync(self):
+        with self._lock:
+            self._sync()
+
+    def _sync(self):
+        self._sink.sync()
+        for record in self._unsynced:
+            self._manifest.write(json.dumps(record) + "\n")
+        _fsync(self._manifest)
+        self._unsynced = []
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            self._sink.close()
+            self._manifest.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,133 @@
+"""
+Folder index of PhenoScan Cassava.
+
+Description:
+    Lists the images of a folder and of its subfolders (plots, dates...) with
+    os.scandir, which tells files from folders without a stat per file. The
+    names of every directory are sorted once in the natural order of the GUI
+    and cached on disk with the modification time of the directory. Adding,
+    removing or renaming a file changes the modification time of its
+    directory, so opening a season folder again only lists the directories
+    that changed, every other directory costs one stat.
+
+    The images of a directory come before the ones of its subfolders, like
+    shard.list_image_tree, so a folder without subfolders is listed in the
+    same order as batch.list_image_files.
+"""
+
+
+import hashlib
+import json
+import os
+import time
+
+from batch import IMAGE_EXTENSIONS, natural_sort_key
+
+
+#bump when the format of the index files changes
+INDEX_VERSION = 1
+
+#directories modified this recently are listed again next time, a change made
+#right after the listing may not change their modification time
+SETTLE_SECONDS = 2
+
+
+#default folder of the index files
+def default_index_directory():
+    return os.path.join(os.path.expanduser("~"), ".phenoscan_cassava", "indexes")
+
+
+#index file of a folder, named after the folder so the files can be told apart
+def index_path_for(folder_path, index_directory=None):
+    folder_path = os.path.abspath(folder_path)
+    digest = hashlib.sha1(folder_path.encode()).hexdigest()[:10]
+    name = os.path.basename(folder_path.rstrip(os.sep)) or "root"
+    return os.path.join(index_directory or default_index_directory(), f"{name}-{digest}.json")
+
+
+#image names and subfolder names of a directory, both in natural order
+def list_directory(path):
+    images = []
+    folders = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.name)
+                elif entry.name.lower().endswith(IMAGE_EXTENSIONS) and entry.is_file():
+                    images.append(entry.name)
+            except OSError:
+                #removed while it was listed
+                continue
+    images.sort(key=natural_sort_key)
+    folders.sort(key=natural_sort_key)
+    return images, folders
+
+
+class FolderIndex:
+    #images of a folder tree, cached on disk and refreshed incrementally
+    #the paths are joined to folder_path as it is given, like batch.list_image_files
+    def __init__(self, folder_path, recursive=True, index_directory=None):
+        self.folder_path = folder_path
+        self.recursive = recursive
+        self.path = index_path_for(folder_path, index_directory)
+        #directories listed and taken from the index by the last refresh
+        self.listed = 0
+        self.reused = 0
+
+    def _load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if index.get('version') != INDEX_VERSION:
+            return {}
+        return index['directories']
+
+    #written through a temporary file so a crash never leaves half an index, the app works without it
+    def _save(self, directories):
+        temporary_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(temporary_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': INDEX_VERSION, 'folder': os.path.abspath(self.folder_path),
+                           'directories': directories}, f, separators=(',', ':'))
+            os.replace(temporary_path, self.path)
+        except OSError as e:
+            print("Cannot save the folder index:", e)
+
+    #image paths of the tree in order, only the directories whose modification time changed are listed again
+    def refresh(self):
+        cached = self._load()
+        directories = {}
+        image_paths = []
+        self.listed = self.reused = 0
+        settled = (time.time() - SETTLE_SECONDS) * 1e9
+        #depth first, the images of a directory then its subfolders in order
+        pending = ['']
+        while pending:
+            relative_directory = pending.pop()
+            directory = os.path.join(self.folder_path, relative_directory) if relative_directory else self.folder_path
+            try:
+                modified = os.stat(directory).st_mtime_ns
+            except OSError:
+                continue
+            entry = cached.get(relative_directory)
+            if entry is not None and entry[0] == modified:
+                self.reused += 1
+            else:
+                try:
+                    images, folders = list_directory(directory)
+                except OSError:
+                    continue
+                self.listed += 1
+                #a directory still changing is cached without its time, so it is listed again
+                entry = [modified if modified < settled else None, images, folders]
+            directories[relative_directory] = entry
+            image_paths.extend(os.path.join(directory, name) for name in entry[1])
+            if self.recursive:
+                pending.extend(os.path.join(relative_directory, name) for name in reversed(entry[2]))
+        if self.listed or len(directories) != len(cached):
+            self._save(directories)
+        return image_paths
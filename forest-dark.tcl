@@ -20,7 +20,32 @@ namespace eval ttk::theme::forest-dark {
 
     proc LoadImages {imgdir} {
         variable I
-        foreach file [glob -directory $imgdir *.png] {
+        # One sprite sheet made by pack_theme.py is faster to load than a file per image.
+        # Run "python pack_theme.py" after changing an image of $imgdir, the first line of the
+        # index is a hash of the images checked by "python pack_theme.py --check" and the tests.
+        # Only the names are compared here, the separate images are loaded when they differ.
+        set packed "$imgdir-packed"
+        set files [glob -directory $imgdir *.png]
+        set fresh [expr {[file exists $packed.png] && [file exists $packed.txt]}]
+        if {$fresh} {
+            set f [open $packed.txt]
+            gets $f stamp
+            set positions [read $f]
+            close $f
+            set names [lmap file $files {file tail [file rootname $file]}]
+            set packed_names [lmap {img x y width height} $positions {set img}]
+            set fresh [expr {[lsort $names] eq [lsort $packed_names]}]
+        }
+        if {$fresh} {
+            set sheet [image create photo -file $packed.png -format png]
+            foreach {img x y width height} $positions {
+                set I($img) [image create photo -width $width -height $height]
+                $I($img) copy $sheet -from $x $y [expr {$x + $width}] [expr {$y + $height}]
+            }
+            image delete $sheet
+            return
+        }
+        foreach file $files {
             set img [file tail [file rootname $file]]
             set I($img) [image create photo -file $file -format png]
         }
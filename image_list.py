@@ -0,0 +1,127 @@
+"""
+Image list of PhenoScan Cassava.
+
+Description:
+    A list widget for sessions of any size. A tk.Listbox holds every row it is
+    given, so a season folder of 100,000 images takes seconds to insert and
+    keeps the GUI slow afterwards. VirtualListbox keeps a reference to the
+    list of items and only inserts the rows that fit in the window, the
+    labels of the other rows are never computed. The scrollbar, the mouse
+    wheel and the arrow keys move the window over the items.
+"""
+
+
+import tkinter as tk
+from tkinter import font as tkfont
+from tkinter import ttk
+
+
+#rows moved by one step of the mouse wheel
+WHEEL_ROWS = 3
+
+
+class VirtualListbox(tk.Frame):
+    #a single selection list showing label(item) for the visible items only
+    #command(index) is called when the user selects an item, select(index) selects one from the code
+    def __init__(self, master, command=None, label=str, **listbox_options):
+        super().__init__(master, bg=listbox_options.get('bg', master.cget('bg')))
+        self.command = command
+        self.label = label
+        self.items = []
+        #index of the first visible item, and of the selected one (None when nothing is selected)
+        self.top = 0
+        self.selected = None
+        self.rows = 1
+
+        self.listbox = tk.Listbox(self, selectmode=tk.SINGLE, exportselection=False, **listbox_options)
+        self.listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.scrollbar = ttk.Scrollbar(self, orient=tk.VERTICAL, command=self.on_scrollbar)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+
+        self.listbox.bind("<Configure>", self.on_resize)
+        self.listbox.bind("<<ListboxSelect>>", self.on_listbox_select)
+        self.listbox.bind("<MouseWheel>", lambda event: self.scroll(-WHEEL_ROWS if event.delta > 0 else WHEEL_ROWS))
+        #mouse wheel on x11
+        self.listbox.bind("<Button-4>", lambda event: self.scroll(-WHEEL_ROWS))
+        self.listbox.bind("<Button-5>", lambda event: self.scroll(WHEEL_ROWS))
+        self.listbox.bind("<Up>", lambda event: self.on_key(-1))
+        self.listbox.bind("<Down>", lambda event: self.on_key(1))
+        self.listbox.bind("<Prior>", lambda event: self.on_key(-self.rows))
+        self.listbox.bind("<Next>", lambda event: self.on_key(self.rows))
+
+    #show a new list of items, the list is kept and not copied, call refresh after changing it
+    def set_items(self, items, label=None):
+        self.items = items
+        if label is not None:
+            self.label = label
+        self.top = 0
+        self.selected = None
+        self.refresh()
+
+    #select an item and scroll to it unless see is False, without calling command
+    def select(self, index, see=True):
+        self.selected = index
+        if index is not None and see:
+            if index < self.top:
+                self.top = index
+            elif index >= self.top + self.rows:
+                self.top = index - self.rows + 1
+        self.refresh()
+
+    #scroll by a number of rows
+    def scroll(self, rows):
+        self.top += rows
+        self.refresh()
+        return "break"
+
+    #insert the visible rows again
+    def refresh(self):
+        self.top = max(0, min(self.top, len(self.items) - self.rows))
+        visible = self.items[self.top:self.top + self.rows]
+        self.listbox.delete(0, tk.END)
+        if visible:
+            self.listbox.insert(tk.END, *[self.label(item) for item in visible])
+        if self.selected is not None and self.top <= self.selected < self.top + len(visible):
+            self.listbox.selection_set(self.selected - self.top)
+            self.listbox.activate(self.selected - self.top)
+        if self.items:
+            self.scrollbar.set(self.top / len(self.items), (self.top + len(visible)) / len(self.items))
+        else:
+            self.scrollbar.set(0, 1)
+
+    #number of rows fitting in the listbox, from its height and its font
+    def _fitting_rows(self, height):
+        listbox = self.listbox
+        border = int(listbox.cget('borderwidth')) + int(listbox.cget('highlightthickness'))
+        row_height = tkfont.Font(font=listbox.cget('font')).metrics('linespace') + 2 * int(listbox.cget('selectborderwidth'))
+        return max(1, (height - 2 * border) // row_height)
+
+    def on_resize(self, event):
+        rows = self._fitting_rows(event.height)
+        if rows != self.rows:
+            self.rows = rows
+            self.refresh()
+
+    def on_scrollbar(self, action, amount, unit=None):
+        if action == 'moveto':
+            self.top = int(float(amount) * len(self.items))
+            self.refresh()
+        else:
+            self.scroll(int(amount) * (self.rows if unit == 'pages' else 1))
+
+    def on_listbox_select(self, event):
+        selection = self.listbox.curselection()
+        if selection and self.top + selection[0] != self.selected:
+            self.selected = self.top + selection[0]
+            if self.command:
+                self.command(self.selected)
+
+    #arrow and page keys move the selection through every item, not only the visible ones
+    def on_key(self, step):
+        if self.items:
+            index = 0 if self.selected is None else min(max(self.selected + step, 0), len(self.items) - 1)
+            if index != self.selected:
+                self.select(index)
+                if self.command:
+                    self.command(index)
+        return "break"
@@ -0,0 +1,105 @@
+"""
+Background jobs of PhenoScan Cassava.
+
+Description:
+    Runs the long tasks of the GUI (processing a folder, saving the images,
+    watching a folder) on a background executor so the window stays usable.
+    A job never touches Tk: it posts its progress, results and errors on a
+    queue, and the Tk main loop drains the queue with after() and hands every
+    event to the handler the job was submitted with. Between two images the
+    job checks whether it was paused or cancelled.
+"""
+
+
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+#milliseconds between two drains of the event queue by the Tk main loop
+EVENT_POLL_MS = 50
+
+#events handled per drain at most, so a burst of results never freezes the window
+MAX_EVENTS_PER_POLL = 200
+
+
+class Job:
+    #state of a background job shared between its thread and the Tk main loop
+    def __init__(self, events, handlers):
+        self.handlers = handlers
+        self._events = events
+        #set once the job is cancelled, also usable as the stop event of watch.watch_folder
+        self.stop_event = threading.Event()
+        #cleared while the job is paused
+        self._running = threading.Event()
+        self._running.set()
+        self.future = None
+
+    #send an event to the Tk main loop, safe to call from any thread
+    def post(self, kind, *args):
+        self._events.put((self, kind, args))
+
+    def cancel(self):
+        self.stop_event.set()
+        #a paused job must wake up to see it was cancelled
+        self._running.set()
+
+    def pause(self):
+        self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    @property
+    def paused(self):
+        return not self._running.is_set()
+
+    @property
+    def cancelled(self):
+        return self.stop_event.is_set()
+
+    #called by the job between two images: blocks while it is paused, False once it is cancelled
+    def checkpoint(self):
+        self._running.wait()
+        return not self.stop_event.is_set()
+
+
+class JobRunner:
+    #runs the jobs on a thread pool, the events of every job go through one queue
+    def __init__(self, workers=4):
+        self._events = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+
+    #run function(job, *args) in the background and return the job
+    #handlers maps an event kind to a function(job, *args) called on the Tk main loop,
+    #every job posts 'error' (message) when it raises and 'finished' when it ends
+    def submit(self, function, *args, handlers=None):
+        job = Job(self._events, handlers or {})
+
+        def run():
+            try:
+                function(job, *args)
+            except Exception as e:
+                job.post('error', f"{type(e).__name__}: {e}")
+            finally:
+                job.post('finished')
+
+        job.future = self._executor.submit(run)
+        return job
+
+    #hand the pending events to their handlers, must run on the Tk main loop
+    def dispatch(self, limit=MAX_EVENTS_PER_POLL):
+        for _ in range(limit):
+            try:
+                job, kind, args = self._events.get_nowait()
+            except queue.Empty:
+                return
+            handler = job.handlers.get(kind)
+            if handler:
+                handler(job, *args)
+
+    #cancel the jobs still running, they end on their own thread
+    def shutdown(self, jobs=()):
+        for job in jobs:
+            job.cancel()
+        self._executor.shutdown(wait=False)
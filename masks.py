@@ -0,0 +1,110 @@
+"""
+Compact masks of PhenoScan Cassava.
+
+Description:
+    Run-length encoding of the binary masks of a result and the pack files
+    they are kept in. A mask is stored as the flat indices (row * width + col)
+    where its runs of set pixels start and end, so a plant mask of a 12 MP
+    image takes a few tens of kilobytes instead of 36 MB as an RGB image.
+
+    Every process appends its records to its own pack file, so the worker
+    processes never write to the same file, and the threads of a process (the
+    export threads of the GUI...) take turns on it. The packs are read back through
+    memory maps: a record is a view on the mapped file and the operating
+    system keeps in memory only the pages that are used.
+"""
+
+
+import mmap
+import os
+import socket
+import threading
+
+import numpy as np
+
+
+#held while a thread of this process appends a record, the offset of a record is only right
+#when no other thread writes between the tell and the end of the record
+_append_lock = threading.Lock()
+
+
+#pack file of the current process on a folder
+def pack_path(directory):
+    return os.path.join(directory, f"masks-{socket.gethostname()}-{os.getpid()}.pack")
+
+
+#host and process id of the process appending to a pack from its name (see pack_path), None for other files
+def pack_owner(name):
+    if not (name.startswith("masks-") and name.endswith(".pack")):
+        return None
+    hostname, _, pid = name[len("masks-"):-len(".pack")].rpartition('-')
+    return (hostname, int(pid)) if hostname and pid.isdigit() else None
+
+
+#runs of a binary mask as uint32 flat indices on an image of the given width: start, end, start, end...
+#offset (x, y) places a mask cut from a box of the image
+def encode_mask(mask, width=None, offset=(0, 0)):
+    height, mask_width = mask.shape
+    width = width or mask_width
+    #a blank column after every row keeps the runs inside their row
+    padded = np.zeros((height, mask_width + 2), np.int8)
+    padded[:, 1:-1] = mask > 0
+    changes = np.flatnonzero(np.diff(padded.reshape(-1)))
+    rows, columns = np.divmod(changes, mask_width + 2)
+    return ((rows + offset[1]) * width + columns + offset[0]).astype(np.uint32)
+
+
+#binary mask (0 or 255) of the given shape from its runs, runs of several pieces may be concatenated
+def decode_mask(runs, shape):
+    size = shape[0] * shape[1]
+    delta = np.zeros(size + 1, np.int8)
+    #the pieces do not overlap, so a start or an end is never repeated
+    delta[runs[0::2]] += 1
+    delta[runs[1::2]] -= 1
+    mask = np.cumsum(delta[:-1], dtype=np.int8).view(np.uint8)
+    mask *= 255
+    return mask.reshape(shape)
+
+
+#append arrays to a pack file, returns the byte offset of the first one
+def append_arrays(path, arrays):
+    with _append_lock, open(path, 'ab') as f:
+        offset = f.tell()
+        for array in arrays:
+            f.write(np.ascontiguousarray(array).data)
+    return offset
+
+
+class PackReader:
+    #memory maps the pack files of a folder, shared between threads
+    def __init__(self, directory):
+        self.directory = directory
+        self._maps = {}
+        self._lock = threading.Lock()
+
+    #map of a pack covering at least size bytes, a pack is mapped again once it grew past its map
+    def _map(self, name, size):
+        with self._lock:
+            mapped = self._maps.get(name)
+            if mapped is None or len(mapped) < size:
+                with open(os.path.join(self.directory, name), 'rb') as f:
+                    #the views of the previous map keep it alive until they are gone
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[name] = mapped
+            return mapped
+
+    #consecutive arrays of a pack starting at offset, counts and dtypes give their lengths and types
+    #the arrays are read only views on the map, None if the pack is shorter (e.g. cut by a crash)
+    def read(self, name, offset, counts, dtypes):
+        size = offset + sum(count * np.dtype(dtype).itemsize for count, dtype in zip(counts, dtypes))
+        try:
+            mapped = self._map(name, size)
+        except (OSError, ValueError):
+            return None
+        if len(mapped) < size:
+            return None
+        arrays = []
+        for count, dtype in zip(counts, dtypes):
+            arrays.append(np.frombuffer(mapped, dtype=dtype, count=count, offset=offset))
+            offset += count * np.dtype(dtype).itemsize
+        return arrays
@@ -0,0 +1,118 @@
+"""
+Theme packing of PhenoScan Cassava.
+
+Description:
+    Packs the images of the forest-dark theme into one sprite sheet
+    (forest-dark-packed.png) and the position of every image on it
+    (forest-dark-packed.txt). forest-dark.tcl cuts the theme images out of the
+    sheet when it finds it, which reads and decodes one file at startup
+    instead of one per image, a large part of the start on slow disks and on
+    the frozen build. Run it again after changing an image of the theme and
+    commit the new sheet.
+
+    The first line of the index is a hash of the names and contents of the
+    images the sheet was packed from. The theme does not look at the images
+    at startup beyond their names: --check (run by the tests) compares the
+    hash with the images and fails when the sheet is out of date. The
+    separate images are loaded while the sheet is missing or the names of
+    the images differ from the ones on the sheet.
+
+Usage:
+    python pack_theme.py
+    python pack_theme.py --theme forest-dark --width 256
+    python pack_theme.py --check
+"""
+
+
+import argparse
+import glob
+import hashlib
+import os
+import sys
+
+from PIL import Image
+
+
+#width of the sheet, the images are placed on shelves of this width
+DEFAULT_SHEET_WIDTH = 256
+
+
+#positions (name, x, y, width, height) of the images on shelves, tallest images first
+def pack_images(sizes, sheet_width=DEFAULT_SHEET_WIDTH):
+    positions = []
+    x = y = shelf_height = 0
+    for name, (width, height) in sorted(sizes.items(), key=lambda item: (-item[1][1], item[0])):
+        if x + width > sheet_width:
+            x, y = 0, y + shelf_height
+            shelf_height = 0
+        positions.append((name, x, y, width, height))
+        x += width
+        shelf_height = max(shelf_height, height)
+    return positions, y + shelf_height
+
+
+#hash of the names and contents of the images of a theme folder, the same on every checkout
+def theme_stamp(theme_directory):
+    digest = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(theme_directory, "*.png"))):
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest.update(os.path.basename(path).encode() + b"\0")
+        digest.update(hashlib.sha256(data).digest())
+    return digest.hexdigest()
+
+
+#path of the sheet and of its index
+def packed_paths(theme_directory):
+    prefix = os.path.normpath(theme_directory) + "-packed"
+    return prefix + ".png", prefix + ".txt"
+
+
+#hash of the images the sheet of a theme folder was packed from, None without a sheet or a stamp
+def read_stamp(theme_directory):
+    sheet_path, index_path = packed_paths(theme_directory)
+    if not os.path.exists(sheet_path) or not os.path.exists(index_path):
+        return None
+    with open(index_path) as f:
+        words = f.readline().split()
+    return words[1] if len(words) == 2 and words[0] == "stamp" else None
+
+
+#write the sheet and the index of a theme folder, returns their paths
+def pack_theme(theme_directory, sheet_width=DEFAULT_SHEET_WIDTH):
+    images = {os.path.splitext(os.path.basename(path))[0]: Image.open(path).convert("RGBA")
+              for path in glob.glob(os.path.join(theme_directory, "*.png"))}
+    positions, sheet_height = pack_images({name: image.size for name, image in images.items()}, sheet_width)
+
+    sheet = Image.new("RGBA", (sheet_width, sheet_height), (0, 0, 0, 0))
+    for name, x, y, _, _ in positions:
+        sheet.paste(images[name], (x, y))
+    sheet_path, index_path = packed_paths(theme_directory)
+    sheet.save(sheet_path, optimize=True)
+    #the stamp, then a flat tcl list: name x y width height, one image per line
+    with open(index_path, 'w', newline='\n') as f:
+        f.write(f"stamp {theme_stamp(theme_directory)}\n")
+        for position in positions:
+            f.write(" ".join(map(str, position)) + "\n")
+    return sheet_path, index_path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pack the images of the theme into one sprite sheet.")
+    parser.add_argument('--theme', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "forest-dark"),
+                        help="folder of the theme images")
+    parser.add_argument('--width', type=int, default=DEFAULT_SHEET_WIDTH, help="width of the sheet in pixels")
+    parser.add_argument('--check', action='store_true', help="only check that the sheet is packed from the current images")
+    args = parser.parse_args(argv)
+    if args.check:
+        if read_stamp(args.theme) != theme_stamp(args.theme):
+            print("The sheet is out of date, run: python pack_theme.py")
+            return 1
+        print("The sheet is up to date")
+        return 0
+    for path in pack_theme(args.theme, args.width):
+        print("Written:", path)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,857 @@
+"""
+Image processing pipeline of PhenoScan Cassava.
+
+Description:
+    GUI-free version of the leaf area pipeline used by the desktop application.
+    Everything here is plain functions on file paths and numpy arrays so the
+    pipeline can be pickled and run on worker processes.
+
+Functionality:
+    - Read the image, apply gaussian blur and convert it to hsv format.
+    - Find the green mask, filter small components and merge the convex hulls.
+    - Find the blue calibration card (card.py) and convert pixel counts to square cm.
+    - Optionally time every stage with a profiler (profiling.py).
+"""
+
+
+import cv2
+import numpy as np
+
+from card import find_card
+from masks import decode_mask, encode_mask
+from profiling import NULL_PROFILER
+
+
+#bump when a change of the pipeline changes its results
+#so results stored by an older version are not reused
+PIPELINE_VERSION = 2
+
+#default thresholds of the pipeline (you can adjust it)
+DEFAULT_PARAMS = {
+    'green_lower': (34, 25, 25),
+    'green_upper': (86, 255, 255),
+    'blue_lower': (100, 40, 40),
+    'blue_upper': (150, 255, 255),
+    'kernel_size': 9,
+    'min_component_size': 20000,
+    'max_distance': 500,
+    'blue_area_cm2': 10,
+    #below 1 the plant is located on a downscaled copy and measured at full resolution
+    'detection_scale': 1.0,
+    #'hsv' opens the hsv image before the green threshold, 'mask' opens the thresholded mask
+    'morphology': 'hsv',
+    #'component' measures the largest blue component shaped like a card, 'threshold' every blue pixel (see card.py)
+    'card_mode': 'component',
+    #search the card where it was on the previous image first (see card.CardTracker), for a fixed rig whose
+    #images are processed in order, off by default since a moved card then depends on the previous image
+    'card_tracking': False,
+}
+
+MORPHOLOGY_MODES = ('hsv', 'mask')
+
+
+#images with more pixels than this are processed in tiles unless a tile size is given
+TILED_MIN_PIXELS = 40_000_000
+
+#side of the tiles of the tiled mode
+DEFAULT_TILE_SIZE = 2048
+
+
+#longest side of the downscaled copy the card is searched on, at most
+CARD_DETECTION_SIDE = 1024
+
+
+#longest side of the preview tiers made next to the full resolution result
+#the first one is shown by the GUI, larger ones can be added for zooming
+PREVIEW_SIZES = (400,)
+
+
+#fill missing keys with the default thresholds
+def resolve_params(params=None):
+    resolved = dict(DEFAULT_PARAMS)
+    if params:
+        resolved.update(params)
+    return resolved
+
+
+#filtering to keep mask larger than said threshold
+def filter_connected_components(mask, min_component_size):
+    #perform connected component analysis
+    num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=8)
+
+    #lookup table of the labels, 255 for components larger than the threshold
+    lookup = np.where(stats[:, cv2.CC_STAT_AREA] >= min_component_size, 255, 0).astype(np.uint8)
+    lookup[0] = 0  #skip background label 0
+
+    #remap the label image in a single pass instead of one pass per label
+    return lookup[labels]
+
+
+#count pixels
+def count_pixels_in_hull(image, hull):
+    #create an empty mask
+    mask = np.zeros(image.shape[:2], dtype=np.uint8)
+
+    #fill the hull with white color on the mask
+    cv2.drawContours(mask, [hull], -1, (255), thickness=cv2.FILLED)
+
+    #count the number of non-zero pixels in the mask
+    pixel_count = cv2.countNonZero(mask)
+
+    return pixel_count
+
+
+#find the root of a hull on the union-find forest
+def _find_root(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]  #path halving
+        i = parent[i]
+    return i
+
+
+#pairs (i, j) of hulls having at least one pair of points closer than max_distance
+def close_hull_pairs(hulls, max_distance):
+    points = [hull.reshape(-1, 2).astype(np.int64) for hull in hulls]
+    if not points:
+        return []
+    mins = np.array([p.min(axis=0) for p in points])
+    maxs = np.array([p.max(axis=0) for p in points])
+    limit = max_distance * max_distance
+
+    pairs = []
+    for i in range(len(points) - 1):
+        #the gap between the bounding boxes is a lower bound of the distance
+        #so far away hulls are skipped without looking at their points
+        gap = np.maximum(0, np.maximum(mins[i] - maxs[i + 1:], mins[i + 1:] - maxs[i]))
+        candidates = np.nonzero((gap * gap).sum(axis=1) < limit)[0] + i + 1
+        if len(candidates) == 0:
+            continue
+
+        #squared distance of every point of hull i to every point of the candidates
+        others = np.concatenate([points[j] for j in candidates])
+        diff = others[None, :, :] - points[i][:, None, :]
+        nearest = (diff * diff).sum(axis=2).min(axis=0)
+
+        #closest distance per candidate hull
+        starts = np.cumsum([0] + [len(points[j]) for j in candidates[:-1]])
+        close = np.minimum.reduceat(nearest, starts) < limit
+        pairs.extend((i, int(j)) for j in candidates[close])
+    return pairs
+
+
+#merge convex hulls if they are close to each other
+#hulls are clustered with union-find so chains of close hulls end up on the same hull
+def merge_hulls(hulls, max_distance):
+    parent = list(range(len(hulls)))
+    for i, j in close_hull_pairs(hulls, max_distance):
+        root_i = _find_root(parent, i)
+        root_j = _find_root(parent, j)
+        if root_i != root_j:
+            #the smallest index is the root so clusters keep the order of the contours
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    clusters = {}
+    for i, hull in enumerate(hulls):
+        clusters.setdefault(_find_root(parent, i), []).append(hull)
+    return [cv2.convexHull(np.vstack(to_merge)) for to_merge in clusters.values()]
+
+
+#calculations
+def calculate_leaf_area_cm2(leaf_area_pixel, blue_area_pixel, blue_area_cm2=10):
+    if leaf_area_pixel == 0 or blue_area_pixel == 0:
+        return 0
+    else:
+        #calculate conversion factor
+        conversion_factor = blue_area_pixel / blue_area_cm2
+
+        #calculate leaf area in square centimeters
+        leaf_area_cm2 = leaf_area_pixel / conversion_factor
+
+        print(f"Leaf area: {leaf_area_cm2} square centimeters")
+
+        return leaf_area_cm2
+
+
+#calculations
+def calculate_convex_hull(convex_hull_pixel, blue_area_pixel, blue_area_cm2=10):
+    if convex_hull_pixel == 0 or blue_area_pixel == 0:
+        return 0
+    else:
+        #calculate conversion factor
+        conversion_factor = blue_area_pixel / blue_area_cm2
+
+        #calculate leaf area in square centimeters
+        convex_hull_cm2 = convex_hull_pixel / conversion_factor
+
+        print(f"Leaf area: {convex_hull_cm2} square centimeters")
+
+        return convex_hull_cm2
+
+
+#scale an image down so its longest side fits the preview size
+def make_preview(image, size):
+    height, width = image.shape[:2]
+    scale = min(size / width, size / height)
+    if scale >= 1:
+        return image.copy()
+    preview_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv2.resize(image, preview_size, interpolation=cv2.INTER_AREA)
+
+
+#previews of a processed image, one per size
+def make_previews(image, sizes=PREVIEW_SIZES):
+    return {size: make_preview(image, size) for size in sizes}
+
+
+#green mask of an hsv image with the opening done in the order of params['morphology']
+#'mask' opens one binary channel instead of three hsv channels, about a third of the work,
+#at the price of small differences along the leaf edges
+def green_threshold(hsv_image, params, kernel, profiler=NULL_PROFILER):
+    if params['morphology'] == 'hsv':
+        with profiler.stage('morphology'):
+            opened = cv2.morphologyEx(hsv_image, cv2.MORPH_OPEN, kernel)
+        with profiler.stage('in_range'):
+            return cv2.inRange(opened, params['green_lower'], params['green_upper'])
+    if params['morphology'] == 'mask':
+        with profiler.stage('in_range'):
+            green_mask = cv2.inRange(hsv_image, params['green_lower'], params['green_upper'])
+        with profiler.stage('morphology'):
+            return cv2.morphologyEx(green_mask, cv2.MORPH_OPEN, kernel, dst=green_mask)
+    raise ValueError(f"Unknown morphology mode: {params['morphology']}")
+
+
+#merged convex hulls of the green components, the largest one is the plant
+def find_largest_hull(green_mask, max_distance, profiler=NULL_PROFILER):
+    #find contours in the green mask
+    with profiler.stage('find_contours'):
+        contours, _ = cv2.findContours(green_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    with profiler.stage('hull_merge'):
+        #compute the convex hull for each contour
+        hulls = [cv2.convexHull(contour) for contour in contours]
+
+        #merging hulls and finding the largest one
+        return largest_merged_hull(hulls, max_distance)
+
+
+#largest of the merged hulls
+def largest_merged_hull(hulls, max_distance):
+    return max(merge_hulls(hulls, max_distance), key=cv2.contourArea)
+
+
+#the values stored in the dictionary from the pixel counts of the plant and the card found by locate_card
+def card_metrics(leaf_area_pixel, convex_hull_pixel, card, params):
+    return compute_metrics(leaf_area_pixel, card['pixels'] if card else 0, convex_hull_pixel, params['blue_area_cm2'],
+                           card['box'] if card else None)
+
+
+#the values stored in the dictionary from the pixel counts
+#card_box is the box (x, y, width, height) of the card, the card and the scale are None without one
+def compute_metrics(leaf_area_pixel, blue_area_pixel, convex_hull_pixel, blue_area_cm2=10, card_box=None):
+    leaf_area_cm2 = calculate_leaf_area_cm2(leaf_area_pixel, blue_area_pixel, blue_area_cm2)
+    convex_hull_cm2 = calculate_leaf_area_cm2(convex_hull_pixel, blue_area_pixel, blue_area_cm2)
+    card_x, card_y, card_width, card_height = card_box or (None, None, None, None)
+    return {
+        'leaf_area_cm2': leaf_area_cm2,
+        'number_of_green_pixels': leaf_area_pixel,
+        'number_of_blue_pixels': blue_area_pixel,
+        'convex_hull_cm2': convex_hull_cm2,
+        'convex_hull_pixels': convex_hull_pixel,
+        'card_x': card_x,
+        'card_y': card_y,
+        'card_width': card_width,
+        'card_height': card_height,
+        'pixels_per_cm2': blue_area_pixel / blue_area_cm2 if blue_area_pixel else None
+    }
+
+
+#metrics of the image and the finished rgb result with the hull drawn on it
+def _finish(combined_image, largest_hull, leaf_area_pixel, card, convex_hull_pixel, params):
+    print("Pixel area of the blue part:", card['pixels'] if card else 0, "pixels")
+    print("Pixel area of the green part:", leaf_area_pixel, "pixels")
+
+    metrics = card_metrics(leaf_area_pixel, convex_hull_pixel, card, params)
+
+    #draw contours on the original image to have the pesonalized image result requested by ipb
+    _draw_hull(combined_image, largest_hull)
+
+    #convert the image from BGR to RGB
+    return cv2.cvtColor(combined_image, cv2.COLOR_BGR2RGB, dst=combined_image), metrics
+
+
+def _draw_hull(image, hull, thickness=5):
+    cv2.drawContours(image, [hull], -1, (0, 255, 0), thickness)
+
+
+#fill the masks dictionary of process_image, the masks are given as their runs (see masks.py)
+def _record_masks(masks, shape, green_runs, blue_runs, hull):
+    masks.update({'shape': tuple(shape[:2]), 'green': green_runs, 'blue': blue_runs,
+                  'hull': hull.reshape(-1, 2).astype(np.int32)})
+
+
+#------------------------reference card-----------------
+#the card is searched in the region of the tracker first (see card.py), then on the whole image.
+#its pixels are counted at full resolution, on hsv_image when the pipeline holds it, otherwise on
+#a blurred crop of the box of the card found on a downscaled copy
+
+#the card found in a box of the image, with its box on the image
+#the card also holds its blurred pixels when they were blurred here
+def _find_card_in(image, hsv_image, box, params):
+    x, y, width, height = box
+    if hsv_image is not None:
+        hsv, blurred = hsv_image[y:y + height, x:x + width], None
+    else:
+        blurred, hsv, inner = _blurred_hsv_crop(image, box, 2)
+        hsv = hsv[inner]
+    card = find_card(cv2.inRange(hsv, params['blue_lower'], params['blue_upper']), params['card_mode'])
+    if card is None:
+        return None
+    card_x, card_y, card_width, card_height = card['box']
+    card['blurred'] = None if blurred is None else blurred[card_y:card_y + card_height, card_x:card_x + card_width]
+    card['box'] = (card_x + x, card_y + y, card_width, card_height)
+    return card
+
+
+#box of the image to measure the card in: the box of the card found on a downscaled copy of the whole image
+#grown by a few pixels, or the whole image when it is measured whole, None when there is no card
+def _card_search_box(image, params, hsv_image, small_hsv, shape):
+    if hsv_image is not None and (params['card_mode'] == 'threshold' or max(shape[:2]) <= CARD_DETECTION_SIDE):
+        #every blue pixel is counted, or the image is small already, the whole hsv image is searched
+        return (0, 0, shape[1], shape[0])
+    #the components of the whole image are found on a downscaled copy, only the card is measured at full resolution
+    if small_hsv is not None:
+        small_blue = cv2.inRange(small_hsv, params['blue_lower'], params['blue_upper'])
+    else:
+        #an integer factor takes the fast path of the area resize
+        scale = 1 / int(np.ceil(max(shape[:2]) / CARD_DETECTION_SIDE))
+        if hsv_image is not None:
+            #the mask is downscaled, a downscaled pixel covering any blue pixel stays blue
+            blue_mask = cv2.inRange(hsv_image, params['blue_lower'], params['blue_upper'])
+            small_blue = cv2.resize(blue_mask, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            del blue_mask
+        else:
+            small_image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            small_blue = cv2.inRange(cv2.cvtColor(small_image, cv2.COLOR_BGR2HSV), params['blue_lower'], params['blue_upper'])
+    small_card = find_card(small_blue, params['card_mode'])
+    if small_card is None:
+        return None
+    #full resolution pixels per downscaled pixel, the edges of the card can be off by a few of them
+    ratio_x, ratio_y = shape[1] / small_blue.shape[1], shape[0] / small_blue.shape[0]
+    x, y, width, height = small_card['box']
+    box = (int(x * ratio_x), int(y * ratio_y), int(np.ceil(width * ratio_x)), int(np.ceil(height * ratio_y)))
+    return _grow_box(box, 3 * int(np.ceil(max(ratio_x, ratio_y))), shape)
+
+
+#whether the box inner lies inside the box outer
+def _box_inside(inner, outer):
+    return (outer[0] <= inner[0] and outer[1] <= inner[1] and inner[0] + inner[2] <= outer[0] + outer[2]
+            and inner[1] + inner[3] <= outer[1] + outer[3])
+
+
+#the reference card of a bgr image (see card.find_card), None when there is none
+#with params['card_tracking'] the tracker (card.CardTracker) gives the region to measure first and remembers
+#the card for the next image, the card found there is only kept when it is also the card of the whole image
+#hsv_image: the blurred hsv image when the pipeline holds it, image is not read then and can be None
+#small_hsv: an hsv copy of the image downscaled by the pipeline, the whole image is searched on it
+def locate_card(image, params, tracker=None, hsv_image=None, small_hsv=None):
+    shape = image.shape if hsv_image is None else hsv_image.shape
+    #the threshold mode takes every blue pixel of the image, there is no card to follow,
+    #and a small image held in hsv is searched whole at once
+    tracking = (tracker is not None and params['card_tracking'] and params['card_mode'] != 'threshold'
+                and not (hsv_image is not None and max(shape[:2]) <= CARD_DETECTION_SIDE))
+    tracked = None
+    if tracking:
+        region = tracker.region(shape)
+        if region is not None:
+            card = _find_card_in(image, hsv_image, region, params)
+            if tracker.matches(card, region, shape):
+                tracked = card
+
+    box = _card_search_box(image, params, hsv_image, small_hsv, shape)
+    if tracked is not None and box is not None and _box_inside(tracked['box'], box):
+        #the largest card of the whole image is the tracked one, it was measured already
+        tracker.update(tracked, hit=True)
+        return tracked
+    #the card moved, or a blue object of its size took its place, the card of the whole image is measured
+    card = _find_card_in(image, hsv_image, box, params) if box is not None else None
+    if tracking:
+        tracker.update(card, hit=False)
+    return card
+
+
+#put the blurred pixels of the card on the result, blurred_image is the blurred image when the card has no crop of it
+def _paste_card(combined_image, card, blurred_image=None):
+    if card is None:
+        return
+    x, y, width, height = card['box']
+    blurred = card['blurred'] if card['blurred'] is not None else blurred_image[y:y + height, x:x + width]
+    cv2.copyTo(blurred, card['mask'], dst=combined_image[y:y + height, x:x + width])
+
+
+#runs of the card on an image of the given width
+def _card_runs(card, width):
+    if card is None:
+        return np.zeros(0, np.uint32)
+    return encode_mask(card['mask'], width, card['box'][:2])
+
+
+#bgr colours of the masks drawn without the image
+MASK_COLORS = {'green': (60, 170, 60), 'blue': (200, 90, 30)}
+
+
+#rgb result rebuilt from the masks returned by process_image
+#with the bgr image it was processed from it is the same image process_image returned,
+#without it (e.g. the image was moved) the masks are drawn in flat colours
+#masks is None for an image that could not be measured, its result is the blurred image
+def render_result(masks, image=None):
+    if masks is None:
+        return cv2.cvtColor(cv2.GaussianBlur(image, (5, 5), 0), cv2.COLOR_BGR2RGB)
+    shape = masks['shape']
+    green_mask = decode_mask(masks['green'], shape)
+    blue_mask = decode_mask(masks['blue'], shape)
+    if image is not None and image.shape[:2] == shape:
+        blurred_image = cv2.GaussianBlur(image, (5, 5), 0)
+        combined_mask = cv2.bitwise_or(green_mask, blue_mask, dst=green_mask)
+        combined_image = cv2.bitwise_and(blurred_image, blurred_image, mask=combined_mask)
+    else:
+        combined_image = np.zeros((*shape, 3), np.uint8)
+        combined_image[green_mask > 0] = MASK_COLORS['green']
+        combined_image[blue_mask > 0] = MASK_COLORS['blue']
+    _draw_hull(combined_image, masks['hull'])
+    return cv2.cvtColor(combined_image, cv2.COLOR_BGR2RGB, dst=combined_image)
+
+
+#read an image, data holds its raw bytes when they were already read (see prefetch.py)
+#with a profiler the disk read and the decoding are timed apart
+def read_image(image_path, profiler=NULL_PROFILER, data=None):
+    if data is None:
+        if profiler is NULL_PROFILER:
+            return cv2.imread(image_path)
+        with profiler.stage('read'):
+            try:
+                data = np.fromfile(image_path, dtype=np.uint8)
+            except OSError:
+                return None
+    with profiler.stage('decode'):
+        return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+
+
+#reduced decoding of opencv, jpeg images are decoded straight at 1/2, 1/4 or 1/8 of their size
+REDUCED_READ_FLAGS = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+
+#read an image for a preview of the given size, at the smallest reduced scale whose longest side
+#still covers the size, longest_side is the longest side of the full image
+def read_image_for_preview(image_path, longest_side, size):
+    for factor in sorted(REDUCED_READ_FLAGS, reverse=True):
+        if longest_side / factor >= size:
+            return cv2.imread(image_path, REDUCED_READ_FLAGS[factor])
+    return cv2.imread(image_path)
+
+
+#rgb preview of the given size rebuilt from the masks of a measured image and the image it was processed from,
+#about make_preview(render_result(masks, image), size) but the source image is decoded at a reduced scale and
+#the result is drawn at that scale, None when the source image cannot be read
+def render_preview(masks, image_path, size):
+    shape = masks['shape']
+    image = read_image_for_preview(image_path, max(shape), size)
+    if image is None:
+        return None
+    height, width = image.shape[:2]
+    scale = width / shape[1]
+    green_mask = cv2.resize(decode_mask(masks['green'], shape), (width, height), interpolation=cv2.INTER_NEAREST)
+    blue_mask = cv2.resize(decode_mask(masks['blue'], shape), (width, height), interpolation=cv2.INTER_NEAREST)
+    blurred_image = cv2.GaussianBlur(image, (5, 5), 0)
+    combined_mask = cv2.bitwise_or(green_mask, blue_mask, dst=green_mask)
+    combined_image = cv2.bitwise_and(blurred_image, blurred_image, mask=combined_mask)
+    #the hull line keeps the width it has on the full image
+    _draw_hull(combined_image, np.round(masks['hull'] * scale).astype(np.int32), max(1, round(5 * scale)))
+    return make_preview(cv2.cvtColor(combined_image, cv2.COLOR_BGR2RGB, dst=combined_image), size)
+
+
+#------------------------stages-----------------
+#the stages of the full resolution pipeline, process_decoded_image runs them in order and sweep.py
+#keeps their outputs to share them between parameter sets, so a stage never modifies its inputs
+
+#blurred bgr image and its hsv conversion
+def blur_hsv_stage(image, profiler=NULL_PROFILER):
+    #apply gaussian blur
+    #then convert it to hsv format for easy identification
+    with profiler.stage('blur'):
+        blurred_image = cv2.GaussianBlur(image, (5, 5), 0)
+    with profiler.stage('hsv'):
+        hsv_image = cv2.cvtColor(blurred_image, cv2.COLOR_BGR2HSV)
+    return blurred_image, hsv_image
+
+
+#green mask of the hsv image, morph first before masking (see green_threshold)
+def green_stage(hsv_image, params, profiler=NULL_PROFILER):
+    kernel_size = params['kernel_size']
+    return green_threshold(hsv_image, params, np.ones((kernel_size, kernel_size), np.uint8), profiler)
+
+
+#green mask without the components smaller than min_component_size
+def components_stage(green_mask, params, profiler=NULL_PROFILER):
+    with profiler.stage('components'):
+        return filter_connected_components(green_mask, params['min_component_size'])
+
+
+#the plant: its green pixels inside the merged hull, the hull and the pixel count of the filled hull
+def plant_stage(green_mask, params, profiler=NULL_PROFILER):
+    largest_hull = find_largest_hull(green_mask, params['max_distance'], profiler)
+    with profiler.stage('masking'):
+        #create a mask representing the largest hull, the filled hull is counted before it is cut
+        plant_mask = np.zeros_like(green_mask)
+        cv2.drawContours(plant_mask, [largest_hull], -1, (255), thickness=cv2.FILLED)
+        convex_hull_pixel = cv2.countNonZero(plant_mask)
+
+        #perform bitwise AND operation between green mask and largest hull mask
+        cv2.bitwise_and(green_mask, plant_mask, dst=plant_mask)
+    return plant_mask, largest_hull, convex_hull_pixel
+
+
+#tile size process_decoded_image uses on an image of this shape, 0 when it is processed whole
+#tile_size as given to process_image, None uses tiles for images above TILED_MIN_PIXELS
+def resolve_tile_size(shape, tile_size=None):
+    if tile_size is None:
+        return DEFAULT_TILE_SIZE if shape[0] * shape[1] > TILED_MIN_PIXELS else 0
+    return tile_size
+
+
+#image processing
+#returns the resulting rgb image and the metrics stored on leaf_area_dict
+#metrics is None when the image could not be measured
+#profiler (profiling.Profiler) times the stages, it is off by default
+#data holds the raw bytes of the image when they were already read
+#tile_size: side of the tiles of the tiled mode, 0 turns it off, None uses it for images above TILED_MIN_PIXELS
+#masks: dictionary filled with the runs of the green (inside the hull) and blue (the card) masks, the hull
+#and the shape of the image when it is given and the image could be measured, render_result rebuilds the result from it
+#card_tracker: card.CardTracker following the card from one image of a fixed rig to the next
+def process_image(image_path, params=None, profiler=NULL_PROFILER, data=None, tile_size=None, masks=None, card_tracker=None):
+    #read image using cv
+    #the image is not kept here, so process_decoded_image can free it once it is blurred
+    return process_decoded_image(read_image(image_path, profiler, data), params, image_path, profiler, tile_size, masks,
+                                 card_tracker)
+
+
+#process_image on a bgr image already decoded, e.g. a frame of a video (see video.py)
+#image_path only names the image in the messages
+def process_decoded_image(image, params=None, image_path="", profiler=NULL_PROFILER, tile_size=None, masks=None,
+                          card_tracker=None):
+    params = resolve_params(params)
+    if image is None:
+        raise ValueError(f"Cannot read image: {image_path}")
+    if params['detection_scale'] < 1:
+        return process_image_coarse_to_fine(image, params, image_path, profiler, masks, card_tracker)
+    tile_size = resolve_tile_size(image.shape, tile_size)
+    if tile_size:
+        return process_image_tiled(image, params, image_path, profiler, tile_size, masks, card_tracker)
+
+    blurred_image, hsv_image = blur_hsv_stage(image, profiler)
+    del image
+    green_mask = green_stage(hsv_image, params, profiler)
+    #apply filtering
+    green_mask = components_stage(green_mask, params, profiler)
+    #find the merged hull of the plant and keep the green pixels inside it
+    green_mask, largest_hull, convex_hull_pixel = plant_stage(green_mask, params, profiler)
+
+    #blue card (100,40,40) ~ (150,255,255), searched around the card of the previous image first
+    with profiler.stage('card'):
+        card = locate_card(None, params, card_tracker, hsv_image=hsv_image)
+        del hsv_image
+    try:
+        with profiler.stage('masking'):
+            #calculate pixel area of the green part
+            leaf_area_pixel = cv2.countNonZero(green_mask)
+
+            if masks is not None:
+                _record_masks(masks, green_mask.shape, encode_mask(green_mask), _card_runs(card, green_mask.shape[1]), largest_hull)
+
+            #slice the green mask and then the card out of the blurred image
+            #the blur works per channel so blurring before the RGB conversion gives the same pixels
+            combined_image = cv2.bitwise_and(blurred_image, blurred_image, mask=green_mask)
+            _paste_card(combined_image, card, blurred_image)
+
+        with profiler.stage('finish'):
+            return _finish(combined_image, largest_hull, leaf_area_pixel, card, convex_hull_pixel, params)
+
+    except Exception as e:
+        print("An error occurred:", e)
+        print(image_path)
+        return cv2.cvtColor(blurred_image, cv2.COLOR_BGR2RGB), None
+
+
+#------------------------coarse to fine-----------------
+#the plant and the card are located on a downscaled copy of the image,
+#the pixels are then counted at full resolution only inside their boxes
+
+#box (x, y, width, height) grown by a margin and clipped to the image
+def _grow_box(box, margin, shape):
+    x, y, width, height = box
+    x0, y0 = max(0, x - margin), max(0, y - margin)
+    x1, y1 = min(shape[1], x + width + margin), min(shape[0], y + height + margin)
+    return x0, y0, x1 - x0, y1 - y0
+
+
+#blurred crop of a box of the image and its hsv conversion
+#the crop is taken with a margin so the blur and the opening are the same as on the whole image,
+#the returned slices cut the margin away again
+def _blurred_hsv_crop(image, box, margin):
+    x, y, width, height = box
+    outer_x, outer_y, outer_width, outer_height = _grow_box(box, margin, image.shape)
+    blurred = cv2.GaussianBlur(image[outer_y:outer_y + outer_height, outer_x:outer_x + outer_width], (5, 5), 0)
+    hsv = cv2.cvtColor(blurred, cv2.COLOR_BGR2HSV)
+    inner = (slice(y - outer_y, y - outer_y + height), slice(x - outer_x, x - outer_x + width))
+    return blurred[inner], hsv, inner
+
+
+#hull found on the downscaled image mapped back to full resolution pixel centers
+def _scale_hull(hull, scale):
+    return np.round((hull.astype(np.float64) + 0.5) / scale - 0.5).astype(np.int32)
+
+
+#process_image with the detection done at params['detection_scale']
+def process_image_coarse_to_fine(image, params, image_path="", profiler=NULL_PROFILER, masks=None, card_tracker=None):
+    scale = params['detection_scale']
+    kernel_size = params['kernel_size']
+    kernel = np.ones((kernel_size, kernel_size), np.uint8)
+    #the blur reads 2 pixels around, the opening kernel_size pixels
+    margin = kernel_size + 4
+    #one downscaled pixel covers 1 / scale full resolution pixels, the edges of the masks
+    #found on the downscaled image can be off by a few of them
+    step = int(np.ceil(1 / scale))
+    slack = 3 * step
+
+    #---detection on the downscaled image, the area averaging already smooths it like the blur
+    with profiler.stage('detection'):
+        small_image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        small_hsv = cv2.cvtColor(small_image, cv2.COLOR_BGR2HSV)
+        small_kernel_size = max(1, round(kernel_size * scale))
+        small_kernel = np.ones((small_kernel_size, small_kernel_size), np.uint8)
+        small_green = green_threshold(small_hsv, params, small_kernel)
+        small_green = filter_connected_components(small_green, max(1, params['min_component_size'] * scale * scale))
+        coarse_hull = _scale_hull(find_largest_hull(small_green, params['max_distance'] * scale), scale)
+        del small_image, small_green
+
+    #---the card is found on the downscaled image too, unless it is where it was on the previous image
+    with profiler.stage('card'):
+        card = locate_card(image, params, card_tracker, small_hsv=small_hsv)
+        del small_hsv
+
+    #---green at full resolution inside the box of the plant
+    plant_box = _grow_box(cv2.boundingRect(coarse_hull), slack + 1, image.shape)
+    x, y, width, height = plant_box
+    with profiler.stage('blur_hsv'):
+        plant_blurred, plant_hsv, inner = _blurred_hsv_crop(image, plant_box, margin)
+    green_mask = np.ascontiguousarray(green_threshold(plant_hsv, params, kernel, profiler)[inner])
+    del plant_hsv
+    with profiler.stage('components'):
+        green_mask = filter_connected_components(green_mask, params['min_component_size'])
+
+    #the coarse hull grown by the slack keeps only the components of the plant,
+    #the hull is then rebuilt from their full resolution pixels
+    with profiler.stage('hull_merge'):
+        gate = np.zeros_like(green_mask)
+        cv2.drawContours(gate, [coarse_hull - (x, y)], -1, (255), thickness=cv2.FILLED)
+        gate = cv2.dilate(gate, np.ones((2 * slack + 1, 2 * slack + 1), np.uint8))
+        points = cv2.findNonZero(cv2.bitwise_and(green_mask, gate, dst=gate))
+        largest_hull = cv2.convexHull(points) if points is not None else coarse_hull - (x, y)
+
+    with profiler.stage('masking'):
+        largest_hull_mask = np.zeros_like(green_mask)
+        cv2.drawContours(largest_hull_mask, [largest_hull], -1, (255), thickness=cv2.FILLED)
+        cv2.bitwise_and(green_mask, largest_hull_mask, dst=green_mask)
+        largest_hull = largest_hull + (x, y)
+
+    try:
+        with profiler.stage('masking'):
+            leaf_area_pixel = cv2.countNonZero(green_mask)
+            convex_hull_pixel = cv2.countNonZero(largest_hull_mask)
+
+            #only the boxes of the plant and of the card are filled, the rest of the result stays black
+            combined_image = np.zeros_like(image)
+            plant_region = combined_image[y:y + height, x:x + width]
+            np.copyto(plant_region, plant_blurred, where=(green_mask > 0)[..., None])
+            _paste_card(combined_image, card)
+
+        if masks is not None:
+            _record_masks(masks, image.shape, encode_mask(green_mask, image.shape[1], (x, y)), _card_runs(card, image.shape[1]),
+                          largest_hull)
+
+        with profiler.stage('finish'):
+            return _finish(combined_image, largest_hull, leaf_area_pixel, card, convex_hull_pixel, params)
+
+    except Exception as e:
+        print("An error occurred:", e)
+        print(image_path)
+        return cv2.cvtColor(cv2.GaussianBlur(image, (5, 5), 0), cv2.COLOR_BGR2RGB), None
+
+
+#------------------------tiled-----------------
+#blur, hsv, morphology and thresholds run on overlapping tiles, so only the image, the result
+#and the green mask are held at full size, every other buffer is the size of a tile.
+#the components and their contours are found per tile and stitched across the tile borders,
+#the measurements are the same as on the whole image
+
+#pairs of global ids touching across a seam, side holds the pixels along one side of it and
+#facing the pixels on the other side padded by one on both ends, with 8-connectivity
+#a pixel touches the three pixels facing it
+def _seam_pairs(side, facing):
+    pairs = []
+    for shift in range(3):
+        other = facing[shift:shift + len(side)]
+        touching = (side > 0) & (other > 0)
+        pairs.append(np.stack([side[touching], other[touching]], axis=1))
+    return np.concatenate(pairs)
+
+
+#process_image on tiles of tile_size pixels
+def process_image_tiled(image, params, image_path="", profiler=NULL_PROFILER, tile_size=DEFAULT_TILE_SIZE, masks=None,
+                        card_tracker=None):
+    height, width = image.shape[:2]
+    kernel_size = params['kernel_size']
+    kernel = np.ones((kernel_size, kernel_size), np.uint8)
+    #the blur reads 2 pixels around and the opening twice its radius, the pixels of a tile
+    #are only right that far from its edge, unless it is the edge of the image
+    halo = 2 + 2 * (kernel_size // 2)
+
+    green_mask = np.zeros((height, width), np.uint8)
+    combined_image = np.zeros_like(image)
+
+    #---the card is found on a downscaled copy and measured on a crop, it goes to the result right away
+    with profiler.stage('card'):
+        card = locate_card(image, params, card_tracker)
+        _paste_card(combined_image, card)
+
+    #---first pass: green masks, components and contours of every tile
+    #pieces are the parts of the components inside a tile: global id, one of its pixels and convex hull
+    piece_ids, piece_seeds, piece_hulls = [], [], []
+    #area of every global id, 0 is the background, ids are the local labels shifted by an offset per tile
+    areas = [0]
+    #bounding box (x, y, width, height) of every global id
+    boxes = [(0, 0, 0, 0)]
+    pairs = []
+    offset = 0
+    #global ids of the last row of the previous row of tiles, padded by one on both ends
+    previous_bottom = np.zeros(width + 2, np.int64)
+    for y0 in range(0, height, tile_size):
+        y1 = min(y0 + tile_size, height)
+        bottom = np.zeros(width + 2, np.int64)
+        previous_right = None
+        for x0 in range(0, width, tile_size):
+            x1 = min(x0 + tile_size, width)
+            with profiler.stage('blur_hsv'):
+                blurred, hsv, inner = _blurred_hsv_crop(image, (x0, y0, x1 - x0, y1 - y0), halo)
+            tile_green = green_mask[y0:y1, x0:x1]
+            #the green pixels go to the result once the plant is known
+            tile_green[:] = green_threshold(hsv, params, kernel, profiler)[inner]
+            del blurred, hsv
+
+            with profiler.stage('components'):
+                count, labels, stats, _ = cv2.connectedComponentsWithStats(tile_green, connectivity=8)
+                areas.extend(stats[1:, cv2.CC_STAT_AREA])
+                boxes.extend(stats[1:, :4] + (x0, y0, 0, 0))
+                #only the pixels along the edges of the tile need their global ids
+                top, left, right, bottom_row = (np.where(edge > 0, edge + offset, 0)
+                                                for edge in (labels[0], labels[:, 0], labels[:, -1], labels[-1]))
+                pairs.append(_seam_pairs(top, previous_bottom[x0:x1 + 2]))
+                if previous_right is not None:
+                    pairs.append(_seam_pairs(left, np.pad(previous_right, 1)))
+                previous_right = right
+                bottom[x0 + 1:x1 + 1] = bottom_row
+
+            with profiler.stage('find_contours'):
+                #ccomp puts the outer contour of every piece on the top level, also of pieces inside holes
+                contours, hierarchy = cv2.findContours(tile_green, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+            with profiler.stage('hull_merge'):
+                for contour, link in zip(contours, hierarchy[0] if contours else []):
+                    if link[3] != -1:
+                        continue  #boundary of a hole
+                    x, y = contour[0, 0]
+                    piece_ids.append(labels[y, x] + offset)
+                    piece_seeds.append((int(x) + x0, int(y) + y0))
+                    piece_hulls.append(cv2.convexHull(contour) + (x0, y0))
+            del labels
+            offset += count - 1
+        previous_bottom = bottom
+
+    #---stitching: components touching across a seam are one component
+    with profiler.stage('components'):
+        parent = np.arange(offset + 1)
+        if pairs:
+            #unique pairs, packed into one integer each
+            pairs = np.unique(np.concatenate(pairs) @ np.array([offset + 1, 1]))
+            for i, j in zip(*np.divmod(pairs, offset + 1)):
+                root_i = _find_root(parent, i)
+                root_j = _find_root(parent, j)
+                if root_i != root_j:
+                    parent[max(root_i, root_j)] = min(root_i, root_j)
+        #point every id straight to its root
+        roots = parent
+        while True:
+            next_roots = roots[roots]
+            if np.array_equal(next_roots, roots):
+                break
+            roots = next_roots
+        keep = np.bincount(roots, weights=np.array(areas, np.float64))[roots] >= params['min_component_size']
+
+        #small components are filled away from one of their pixels, the fill follows them across the tiles
+        #it runs on the bounding box of the component, on the whole mask it would allocate a mask as large
+        dropped_boxes = {}
+        for piece_id in np.flatnonzero(~keep[roots[1:]]) + 1:
+            x, y, box_width, box_height = boxes[piece_id]
+            root = roots[piece_id]
+            box = dropped_boxes.get(root, (x, y, x + box_width, y + box_height))
+            dropped_boxes[root] = (min(box[0], x), min(box[1], y), max(box[2], x + box_width), max(box[3], y + box_height))
+        for piece_id, seed in zip(piece_ids, piece_seeds):
+            box = dropped_boxes.pop(roots[piece_id], None)
+            if box is not None:
+                cv2.floodFill(green_mask[box[1]:box[3], box[0]:box[2]], None, (seed[0] - box[0], seed[1] - box[1]), 0, flags=8)
+
+    with profiler.stage('hull_merge'):
+        pieces_by_root = {}
+        for piece_id, hull in zip(piece_ids, piece_hulls):
+            root = roots[piece_id]
+            if keep[root]:
+                pieces_by_root.setdefault(root, []).append(hull)
+        hulls = [cv2.convexHull(np.vstack(pieces)) for pieces in pieces_by_root.values()]
+        largest_hull = largest_merged_hull(hulls, params['max_distance'])
+
+    try:
+        #---second pass: green pixels inside the plant hull
+        #the hull is filled on a canvas holding it whole, filling it tile by tile would clip it
+        #and round its edges differently
+        hull_x, hull_y, hull_width, hull_height = cv2.boundingRect(largest_hull)
+        with profiler.stage('masking'):
+            largest_hull_mask = np.zeros((hull_height, hull_width), np.uint8)
+            cv2.drawContours(largest_hull_mask, [largest_hull - (hull_x, hull_y)], -1, (255), thickness=cv2.FILLED)
+            convex_hull_pixel = cv2.countNonZero(largest_hull_mask)
+            plant_green = green_mask[hull_y:hull_y + hull_height, hull_x:hull_x + hull_width]
+            cv2.bitwise_and(plant_green, largest_hull_mask, dst=plant_green)
+            leaf_area_pixel = cv2.countNonZero(plant_green)
+            del largest_hull_mask
+            if masks is not None:
+                _record_masks(masks, image.shape, encode_mask(plant_green, width, (hull_x, hull_y)), _card_runs(card, width),
+                              largest_hull)
+
+        #the blurred green pixels go to the result tile by tile, only inside the box of the hull
+        for y0 in range(hull_y, hull_y + hull_height, tile_size):
+            y1 = min(y0 + tile_size, hull_y + hull_height)
+            for x0 in range(hull_x, hull_x + hull_width, tile_size):
+                x1 = min(x0 + tile_size, hull_x + hull_width)
+                with profiler.stage('blur'):
+                    #the blur of the tile again, cheaper than keeping a blurred copy of the whole image
+                    outer_x, outer_y, outer_width, outer_height = _grow_box((x0, y0, x1 - x0, y1 - y0), 2, image.shape)
+                    blurred = cv2.GaussianBlur(image[outer_y:outer_y + outer_height, outer_x:outer_x + outer_width], (5, 5), 0)
+                    blurred = blurred[y0 - outer_y:y1 - outer_y, x0 - outer_x:x1 - outer_x]
+                with profiler.stage('masking'):
+                    cv2.copyTo(blurred, green_mask[y0:y1, x0:x1], dst=combined_image[y0:y1, x0:x1])
+        del green_mask
+
+        with profiler.stage('finish'):
+            return _finish(combined_image, largest_hull, leaf_area_pixel, card, convex_hull_pixel, params)
+
+    except Exception as e:
+        print("An error occurred:", e)
+        print(image_path)
+        return cv2.cvtColor(cv2.GaussianBlur(image, (5, 5), 0), cv2.COLOR_BGR2RGB), None
@@ -0,0 +1,115 @@
+"""
+Read-ahead of PhenoScan Cassava.
+
+Description:
+    Reads the raw bytes of the next images on a small thread pool while the
+    workers process the current ones, so the workers never wait on a slow
+    disk or network share. Only the compressed bytes are read here, the
+    decoding happens on the workers next to the processing. At most depth
+    images or max_bytes bytes are held ahead of the workers.
+"""
+
+
+import hashlib
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+#io threads, enough to keep a network share busy without flooding it
+DEFAULT_IO_WORKERS = 4
+
+#bytes read ahead of the workers at most
+DEFAULT_PREFETCH_BYTES = 512 * 1024 * 1024
+
+
+class Prefetcher:
+    #reads the images in the given order ahead of next()
+    #with digest=True the sha256 of the bytes is computed on the io threads too,
+    #so the result store does not read new images a second time to hash them
+    #known_digest(image_path) returns the digest of an image hashed before, such images are not read,
+    #their item has no data and the worker reads them if their result is not stored
+    def __init__(self, image_paths, depth=8, max_bytes=DEFAULT_PREFETCH_BYTES, io_workers=DEFAULT_IO_WORKERS,
+                 digest=False, known_digest=None):
+        self.depth = max(1, depth)
+        self.max_bytes = max_bytes
+        self.digest = digest
+        self.known_digest = known_digest
+        self._remaining = iter(image_paths)
+        self._window = deque()
+        self._window_bytes = 0
+        self._exhausted = False
+        self._closed = False
+        #reentrant, a read finished before add_done_callback runs its callback right away
+        self._lock = threading.RLock()
+        self._executor = ThreadPoolExecutor(max_workers=io_workers)
+
+    #read an image, the stat is taken on the open file so it matches the bytes
+    def _read(self, image_path):
+        item = {'image_path': image_path, 'data': None, 'digest': None, 'stat': None, 'error': None}
+        try:
+            if self.known_digest:
+                item['digest'] = self.known_digest(image_path)
+                if item['digest']:
+                    return item
+            with open(image_path, 'rb') as f:
+                item['stat'] = os.fstat(f.fileno())
+                item['data'] = f.read()
+        except OSError as e:
+            #the worker reads the file again and reports the error with the others
+            item['error'] = e
+            return item
+        if self.digest:
+            item['digest'] = hashlib.sha256(item['data']).hexdigest()
+        with self._lock:
+            self._window_bytes += len(item['data'])
+        return item
+
+    #start reading while there is room, called with the lock held
+    def _fill(self):
+        while not self._exhausted and not self._closed:
+            if len(self._window) >= self.depth or self._window_bytes >= self.max_bytes:
+                return
+            image_path = next(self._remaining, None)
+            if image_path is None:
+                self._exhausted = True
+                return
+            future = self._executor.submit(self._read, image_path)
+            future.add_done_callback(self._on_read)
+            self._window.append(future)
+
+    #a finished read may leave room for the next one
+    def _on_read(self, future):
+        with self._lock:
+            self._fill()
+
+    #next image as a dictionary (image_path, data, digest, stat, error), None once all were returned
+    #blocks until its bytes are read
+    def next(self):
+        with self._lock:
+            self._fill()
+            if not self._window:
+                return None
+            future = self._window[0]
+        item = future.result()
+        with self._lock:
+            self._window.popleft()
+            if item['data'] is not None:
+                self._window_bytes -= len(item['data'])
+            self._fill()
+        return item
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            for future in self._window:
+                future.cancel()
+            self._window.clear()
+        self._executor.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,165 @@
+"""
+Profiling of PhenoScan Cassava.
+
+Description:
+    Opt-in instrumentation of the pipeline. A Profiler measures the wall time
+    and the peak allocation of every stage of an image, and a TraceWriter
+    appends one JSON line per image to a trace file so a slow session can be
+    split into disk, decoding, morphology, hull merging or encoding time.
+
+    The peak allocation is measured with tracemalloc, which sees the numpy
+    arrays returned by opencv but not the buffers opencv keeps internally.
+    Without a profiler the pipeline only pays for an empty context manager.
+
+    A StartupLog records how long the GUI takes to show its window and its
+    first result, the numbers that matter on the laptops starting it all day.
+
+Usage:
+    PHENOSCAN_TRACE=trace.jsonl python application.py
+    PHENOSCAN_STARTUP_LOG=startup.jsonl python application.py
+    python batch.py /path/to/folder --trace trace.jsonl
+"""
+
+
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+
+#environment variable holding the trace file of the GUI
+TRACE_ENVIRONMENT_VARIABLE = 'PHENOSCAN_TRACE'
+
+
+#trace file set on the environment, None when profiling is off
+def trace_path_from_environment():
+    return os.environ.get(TRACE_ENVIRONMENT_VARIABLE) or None
+
+
+#environment variable holding the startup log of the GUI (see benchmarks/bench_startup.py)
+STARTUP_ENVIRONMENT_VARIABLE = 'PHENOSCAN_STARTUP_LOG'
+
+
+class StartupLog:
+    #seconds from started (a time.time()) to the milestones of the start of the GUI:
+    #'window' once the window is shown, 'warm' once the heavy modules are loaded, 'first_result'
+    #once the first processed image is shown, appended as one json line when close is called
+    def __init__(self, path, started):
+        self.path = path
+        self.record = {'started': started}
+
+    #the first time of a milestone is kept
+    def mark(self, name):
+        self.record.setdefault(f"{name}_s", time.time() - self.record['started'])
+
+    def close(self):
+        with TraceWriter(self.path) as writer:
+            writer.write(self.record)
+
+
+class Profiler:
+    #times the stages of one image, stages with the same name add up
+    #trace_memory=False only measures the wall time, the peaks are meaningless
+    #when several threads share the process, like the export threads do
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.stages = {}
+        self._start = time.perf_counter()
+
+    #time a stage, stages must not be nested since they share the tracemalloc peak
+    @contextmanager
+    def stage(self, name):
+        if self.trace_memory:
+            current = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            entry = self.stages.setdefault(name, {'seconds': 0.0, 'peak_bytes': 0, 'calls': 0})
+            entry['seconds'] += seconds
+            entry['calls'] += 1
+            if self.trace_memory:
+                peak = tracemalloc.get_traced_memory()[1] - current
+                entry['peak_bytes'] = max(entry['peak_bytes'], peak)
+
+    #record of the image for the trace file
+    def record(self, image_path, kind='process'):
+        return {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'kind': kind,
+            'image_path': image_path,
+            'pid': os.getpid(),
+            'total_s': time.perf_counter() - self._start,
+            'stages': self.stages,
+        }
+
+
+class _NullProfiler:
+    #stands in for a profiler when profiling is off
+    _context = nullcontext()
+
+    def stage(self, name):
+        return self._context
+
+
+NULL_PROFILER = _NullProfiler()
+
+
+class TraceWriter:
+    #appends the records as json lines, safe to share between threads
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._file = open(path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        with self._lock:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class StageSummary:
+    #running totals of the records, shown on the progress window and at the end of a batch
+    def __init__(self):
+        self.images = 0
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            self.images += 1
+            for name, stage in record['stages'].items():
+                entry = self.stages.setdefault(name, {'seconds': 0.0, 'peak_bytes': 0})
+                entry['seconds'] += stage['seconds']
+                entry['peak_bytes'] = max(entry['peak_bytes'], stage['peak_bytes'])
+
+    #one line per stage, slowest first: share of the time, mean time per image and peak allocation
+    def lines(self, limit=None):
+        with self._lock:
+            stages = sorted(self.stages.items(), key=lambda item: item[1]['seconds'], reverse=True)
+            total = sum(stage['seconds'] for _, stage in stages) or 1
+            lines = []
+            for name, stage in stages[:limit]:
+                line = f"{name}: {stage['seconds'] / total:.0%}, {stage['seconds'] / self.images * 1000:.0f} ms/image"
+                if stage['peak_bytes']:
+                    line += f", peak {stage['peak_bytes'] / 2 ** 20:.0f} MB"
+                lines.append(line)
+            return lines
@@ -0,0 +1,87 @@
+"""
+Priority scheduling of PhenoScan Cassava.
+
+Description:
+    Decides which image of an opened folder is processed next. The image on
+    the canvas comes first, then its neighbours, then the rest of the folder
+    from there on, so browsing a large folder does not wait for the whole
+    batch. The batch engine takes the images one at a time, so moving to
+    another image reorders everything not taken yet.
+"""
+
+
+import threading
+
+
+#images after and before the current one processed before the rest of the folder
+DEFAULT_AHEAD = 3
+DEFAULT_BEHIND = 1
+
+
+class ImageScheduler:
+    #iterates over image_paths in priority order, safe to share between threads
+    #focus(index) moves the current image, the next images taken are around it
+    def __init__(self, image_paths, ahead=DEFAULT_AHEAD, behind=DEFAULT_BEHIND):
+        self.image_paths = list(image_paths)
+        self._index_of = {image_path: index for index, image_path in enumerate(self.image_paths)}
+        #the current image, then its neighbours nearest first, the ones ahead first on a tie
+        self._offsets = [0]
+        for distance in range(1, max(ahead, behind) + 1):
+            if distance <= ahead:
+                self._offsets.append(distance)
+            if distance <= behind:
+                self._offsets.append(-distance)
+        #_next[i] leads to the first image at i or after it not taken yet, len(image_paths) when there is none
+        self._next = list(range(len(self.image_paths) + 1))
+        self._remaining = len(self.image_paths)
+        self._focus = 0
+        self._lock = threading.Lock()
+
+    #first image at index or after it not taken yet, with path halving like pipeline._find_root
+    def _find(self, index):
+        while self._next[index] != index:
+            self._next[index] = self._next[self._next[index]]
+            index = self._next[index]
+        return index
+
+    def _take(self, index):
+        self._next[index] = index + 1
+        self._remaining -= 1
+        return self.image_paths[index]
+
+    #move the current image, it is taken next unless it was taken already
+    def focus(self, index):
+        with self._lock:
+            self._focus = index
+
+    #images that must not be processed, e.g. recorded by a previous session
+    def skip(self, image_paths):
+        with self._lock:
+            for image_path in image_paths:
+                index = self._index_of.get(image_path)
+                if index is not None and self._find(index) == index:
+                    self._take(index)
+
+    #images not taken yet
+    def __len__(self):
+        with self._lock:
+            return self._remaining
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self._lock:
+            if not self._remaining:
+                raise StopIteration
+            count = len(self.image_paths)
+            focus = min(max(self._focus, 0), count - 1)
+            for offset in self._offsets:
+                index = focus + offset
+                if 0 <= index < count and self._find(index) == index:
+                    return self._take(index)
+            #then the rest of the folder from the current image on, wrapping around
+            index = self._find(focus)
+            if index == count:
+                index = self._find(0)
+            return self._take(index)
@@ -0,0 +1,349 @@
+"""
+Analysis service of PhenoScan Cassava.
+
+Description:
+    Headless HTTP service measuring images for clients that cannot run the
+    GUI, such as the data collection tablets. It listens on localhost only
+    and returns the metrics of the GUI (leaf area, green and blue pixels,
+    hull area and hull pixels) as JSON.
+
+    The requests wait on a bounded queue. A dispatcher thread takes them in
+    small batches (a batch closes when it is full or after a few
+    milliseconds) and hands every batch to a process pool, so a burst of
+    small requests costs one round trip to the workers per batch instead of
+    one per image. When the queue is full the service answers 429 with
+    Retry-After instead of letting the latency grow without bound.
+
+    Connections are kept alive (HTTP/1.1), so a client sending many images
+    does not pay for a new connection every time.
+
+Endpoints:
+    POST /analyze          the image file as the body, ?name=plant.jpg names it in the answer
+    POST /analyze          {"path": "..."} a file below --root on the machine of the service
+    GET  /metrics          requests, throughput, latency percentiles, queue and batch sizes
+    GET  /health           200 once the service is up
+
+Usage:
+    python serve.py --port 8765 --workers 4 --root /data/images
+    curl --data-binary @plant.jpg "http://127.0.0.1:8765/analyze?name=plant.jpg"
+    curl -d '{"path": "field1/plant.jpg"}' http://127.0.0.1:8765/analyze
+"""
+
+
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Pool
+from urllib.parse import parse_qs, urlparse
+
+from batch import _init_worker, add_pipeline_arguments, default_workers, pipeline_params
+from export import plain_metrics
+from pipeline import process_image
+
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+#requests waiting for a worker at most, the next ones get 429
+DEFAULT_QUEUE_SIZE = 64
+
+#images sent to a worker at once, and how long a batch waits to fill up
+DEFAULT_BATCH_SIZE = 4
+DEFAULT_BATCH_WAIT = 0.005
+
+#seconds a request waits for its result before it gets 504
+REQUEST_TIMEOUT = 300
+
+#largest upload accepted
+MAX_UPLOAD_BYTES = 256 * 1024 * 1024
+
+#latencies kept for the percentiles of /metrics
+LATENCY_WINDOW = 10000
+
+
+#runs on a worker process, must stay at module level so it can be pickled
+#measures the images of a batch, one (metrics, error) per task
+def _analyze_batch(tasks, params, tile_size):
+    results = []
+    for task in tasks:
+        try:
+            #no card tracking, the images of different clients do not come from one rig
+            _, metrics = process_image(task['image_path'], params, data=task['data'], tile_size=tile_size)
+            results.append((plain_metrics(metrics), None))
+        except Exception as e:
+            results.append((None, f"{type(e).__name__}: {e}"))
+    return results
+
+
+class _Request:
+    #a request waiting for its result, the handler thread waits on done
+    def __init__(self, image_path, data):
+        self.task = {'image_path': image_path, 'data': data}
+        self.done = threading.Event()
+        self.metrics = None
+        self.error = None
+        self.queued = time.perf_counter()
+
+    def finish(self, metrics, error):
+        self.metrics = metrics
+        self.error = error
+        self.done.set()
+
+
+class ServiceStats:
+    #counters and latencies of the service, thread safe
+    def __init__(self):
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        #completion times of the last minute for the current throughput
+        self._recent = deque()
+        self._batch_sizes = deque(maxlen=LATENCY_WINDOW)
+        self.counts = {'accepted': 0, 'rejected': 0, 'completed': 0, 'failed': 0, 'timed_out': 0}
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def add_batch(self, size):
+        with self._lock:
+            self._batch_sizes.append(size)
+
+    def add_latency(self, seconds):
+        now = time.time()
+        with self._lock:
+            self._latencies.append(seconds)
+            self._recent.append(now)
+            while self._recent and self._recent[0] < now - 60:
+                self._recent.popleft()
+
+    #dictionary served by /metrics
+    def snapshot(self, queued):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            batch_sizes = list(self._batch_sizes)
+            now = time.time()
+            recent = sum(1 for finished in self._recent if finished >= now - 60)
+            counts = dict(self.counts)
+        uptime = now - self.started
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1000, 1)
+
+        return {
+            'uptime_s': round(uptime, 1),
+            'requests': counts,
+            'queued': queued,
+            'throughput_per_s': round(counts['completed'] / uptime, 3) if uptime else 0,
+            'throughput_last_minute_per_s': round(recent / min(60, uptime), 3) if uptime else 0,
+            'latency_ms': {'p50': percentile(50), 'p90': percentile(90), 'p99': percentile(99),
+                           'max': round(latencies[-1] * 1000, 1) if latencies else None},
+            'mean_batch_size': round(sum(batch_sizes) / len(batch_sizes), 2) if batch_sizes else None,
+        }
+
+
+class AnalysisService:
+    #bounded queue of requests, micro-batched onto a process pool by a dispatcher thread
+    def __init__(self, workers=None, params=None, queue_size=DEFAULT_QUEUE_SIZE, batch_size=DEFAULT_BATCH_SIZE,
+                 batch_wait=DEFAULT_BATCH_WAIT, tile_size=None):
+        self.workers = workers or default_workers()
+        self.params = params
+        self.tile_size = tile_size
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.stats = ServiceStats()
+        self._queue = queue.Queue(maxsize=queue_size)
+        #one batch running and one waiting per worker, the rest stays on the queue where it counts for 429
+        self._slots = threading.BoundedSemaphore(2 * self.workers)
+        self._pool = Pool(processes=self.workers, initializer=_init_worker)
+        self._closed = threading.Event()
+        self._dispatcher = threading.Thread(target=self._dispatch, name="dispatcher", daemon=True)
+        self._dispatcher.start()
+
+    #queue an image, returns the request or None when the queue is full
+    #image_path names the image, data holds its bytes or None to read it from image_path
+    def submit(self, image_path, data=None):
+        request = _Request(image_path, data)
+        try:
+            self._queue.put_nowait(request)
+        except queue.Full:
+            self.stats.count('rejected')
+            return None
+        self.stats.count('accepted')
+        return request
+
+    def queued(self):
+        return self._queue.qsize()
+
+    #takes the requests in batches and sends them to the pool
+    def _dispatch(self):
+        while not self._closed.is_set():
+            try:
+                batch = [self._queue.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            #the first request does not wait, the others are the ones arriving within batch_wait
+            deadline = time.perf_counter() + self.batch_wait
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.perf_counter()
+                try:
+                    batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            #wait for a free worker, the requests queued meanwhile wait on the queue
+            while not self._slots.acquire(timeout=0.1):
+                if self._closed.is_set():
+                    return
+            self.stats.add_batch(len(batch))
+            self._pool.apply_async(_analyze_batch, ([request.task for request in batch], self.params, self.tile_size),
+                                   callback=lambda results, batch=batch: self._finish(batch, results),
+                                   error_callback=lambda error, batch=batch: self._fail(batch, error))
+
+    def _finish(self, batch, results):
+        self._slots.release()
+        for request, (metrics, error) in zip(batch, results):
+            request.finish(metrics, error)
+
+    def _fail(self, batch, error):
+        self._slots.release()
+        for request in batch:
+            request.finish(None, f"{type(error).__name__}: {error}")
+
+    def close(self):
+        self._closed.set()
+        self._dispatcher.join()
+        self._pool.terminate()
+
+
+class AnalysisHandler(BaseHTTPRequestHandler):
+    #keep-alive needs HTTP/1.1 and a Content-Length on every answer
+    protocol_version = "HTTP/1.1"
+    #set by make_server
+    service = None
+    root = None
+
+    def _send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        #one line per request would flood the console under load
+        pass
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/metrics":
+            self._send_json(200, self.service.stats.snapshot(self.service.queued()))
+        elif path == "/health":
+            self._send_json(200, {'status': 'ok'})
+        else:
+            self._send_json(404, {'error': f"Unknown endpoint: {path}"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/analyze":
+            self._send_json(404, {'error': f"Unknown endpoint: {url.path}"})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_UPLOAD_BYTES:
+            #the body is not read, the connection cannot be reused
+            self.close_connection = True
+            self._send_json(413, {'error': f"Images above {MAX_UPLOAD_BYTES // 2 ** 20} MB are not accepted"})
+            return
+        body = self.rfile.read(length)
+
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            try:
+                name = json.loads(body)['path']
+                image_path = self._server_path(name)
+            except (ValueError, KeyError, TypeError) as e:
+                self._send_json(400, {'error': f"Expected {{\"path\": ...}}: {e}"})
+                return
+            except PermissionError as e:
+                self._send_json(403, {'error': str(e)})
+                return
+            data = None
+        elif body:
+            name = image_path = parse_qs(url.query).get('name', ["upload"])[0]
+            data = body
+        else:
+            self._send_json(400, {'error': "Send the image as the body or {\"path\": ...} as json"})
+            return
+
+        request = self.service.submit(image_path, data)
+        if request is None:
+            self._send_json(429, {'error': "Too many requests waiting, retry later"}, {'Retry-After': "1"})
+            return
+        if not request.done.wait(REQUEST_TIMEOUT):
+            self.service.stats.count('timed_out')
+            self._send_json(504, {'error': "The image was not measured in time"})
+            return
+        self.service.stats.add_latency(time.perf_counter() - request.queued)
+        if request.error:
+            self.service.stats.count('failed')
+            self._send_json(422, {'image': name, 'error': request.error})
+            return
+        self.service.stats.count('completed')
+        #metrics is null for an image that could not be measured, like the GUI skipping it
+        self._send_json(200, {'image': name, 'metrics': request.metrics})
+
+    #absolute path of a path sent by a client, it must stay below the root of the service
+    def _server_path(self, path):
+        if not self.root:
+            raise PermissionError("Paths are not accepted, start the service with --root")
+        image_path = os.path.realpath(os.path.join(self.root, path))
+        if os.path.commonpath([image_path, self.root]) != self.root:
+            raise PermissionError(f"Path outside the root of the service: {path}")
+        return image_path
+
+
+#http server of a service, root is the folder the paths sent by the clients are below, None refuses paths
+def make_server(service, host=DEFAULT_HOST, port=DEFAULT_PORT, root=None):
+    handler = type("Handler", (AnalysisHandler,), {
+        'service': service, 'root': os.path.realpath(root) if root else None})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the leaf area analysis over HTTP on this machine.")
+    parser.add_argument('--host', default=DEFAULT_HOST, help=f"address to listen on (default: {DEFAULT_HOST})")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f"port to listen on (default: {DEFAULT_PORT})")
+    parser.add_argument('--workers', type=int, default=None, help="number of worker processes (default: all cores)")
+    parser.add_argument('--root', default=None, help="folder the paths sent by the clients are below, paths are refused without it")
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE, help="requests waiting at most before 429")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help="images sent to a worker at once")
+    parser.add_argument('--batch-wait-ms', type=float, default=DEFAULT_BATCH_WAIT * 1000,
+                        help="milliseconds a batch waits to fill up")
+    add_pipeline_arguments(parser, card_tracking=False)
+    args = parser.parse_args(argv)
+
+    service = AnalysisService(args.workers, pipeline_params(args), args.queue_size, args.batch_size,
+                              args.batch_wait_ms / 1000, args.tile_size)
+    server = make_server(service, args.host, args.port, args.root)
+    print(f"Listening on http://{args.host}:{server.server_port} with {service.workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
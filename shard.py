@@ -0,0 +1,369 @@
+"""
+Sharded batch runs of PhenoScan Cassava.
+
+Description:
+    Splits the images of a folder tree into a fixed number of shards so several
+    machines or containers can process them against shared storage. A run is a
+    folder on the shared storage: init lists the tree once and assigns every
+    image to a shard from a hash of its path below the root, so the split does
+    not depend on the machine, the mount point or the order of the listing.
+
+    The nodes claim the shards through a lease table in the sqlite database of
+    the run. A node renews its lease while it processes the shard, and a shard
+    whose lease expired (its node died) is claimed by the next node, which
+    skips what the manifest of the shard already records. A shard with images
+    that failed is put back to be claimed again, up to MAX_SHARD_ATTEMPTS
+    times, and merge lists the images still missing. Every shard writes
+    its own results, manifest and processed images, and merge combines the
+    manifests into one CSV file with the columns of the GUI.
+
+    sqlite locking needs a local disk or a share with working locks, which not
+    every NFS setup has. Containers sharing a folder of one machine are fine.
+
+Usage:
+    python shard.py init /shared/run /shared/images --shards 64
+    python shard.py work /shared/run --workers 16 --images
+    python shard.py status /shared/run
+    python shard.py merge /shared/run results.csv
+"""
+
+
+import argparse
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import time
+
+from batch import IMAGE_EXTENSIONS, add_pipeline_arguments, natural_sort_key, pipeline_params, process_batch
+from cache import ResultStore
+from export import EXPORT_FORMATS, ResultsWriter, read_manifest, write_results_csv
+from pipeline import PREVIEW_SIZES
+
+
+#seconds a node holds a shard without renewing its lease, it renews every third of that
+DEFAULT_LEASE_SECONDS = 600
+
+#runs of a shard with failed images, after the last one the shard is done and merge lists the failed images
+MAX_SHARD_ATTEMPTS = 3
+
+DATABASE_NAME = "run.sqlite3"
+
+
+#image paths of a folder tree relative to its root, with / separators, in natural order folder by folder
+def list_image_tree(root_path):
+    relative_paths = []
+    for directory, folders, files in os.walk(root_path):
+        folders.sort(key=natural_sort_key)
+        relative_directory = os.path.relpath(directory, root_path)
+        for filename in sorted(files, key=natural_sort_key):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                relative_path = os.path.normpath(os.path.join(relative_directory, filename))
+                relative_paths.append(relative_path.replace(os.sep, '/'))
+    return relative_paths
+
+
+#shard of an image from its relative path, the same on every machine
+def shard_of(relative_path, shard_count):
+    return int(hashlib.sha1(relative_path.encode()).hexdigest()[:8], 16) % shard_count
+
+
+#id of a node on the lease table
+def default_node_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def _connect(run_directory):
+    #autocommit, the claims open their own write transaction
+    return sqlite3.connect(os.path.join(run_directory, DATABASE_NAME), timeout=60, isolation_level=None)
+
+
+class ShardRun:
+    #a sharded run on its folder, made by ShardRun.create
+    def __init__(self, run_directory):
+        self.run_directory = run_directory
+        if not os.path.exists(os.path.join(run_directory, DATABASE_NAME)):
+            raise FileNotFoundError(f"No sharded run in {run_directory}")
+        self._connection = _connect(run_directory)
+        settings = dict(self._connection.execute("SELECT key, value FROM settings"))
+        self.root_path = settings['root_path']
+        self.shard_count = int(settings['shard_count'])
+        self.params = json.loads(settings['params'])
+        self.tile_size = json.loads(settings['tile_size'])
+        #runs made before the shards were retried have no attempts column
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(shards)")]
+        if 'attempts' not in columns:
+            self._connection.execute("ALTER TABLE shards ADD COLUMN attempts INTEGER DEFAULT 0")
+
+    #list the tree and make the run, params are the pipeline parameters of every shard
+    @classmethod
+    def create(cls, run_directory, root_path, shard_count, params=None, tile_size=None):
+        if os.path.exists(os.path.join(run_directory, DATABASE_NAME)):
+            raise FileExistsError(f"A sharded run already exists in {run_directory}")
+        os.makedirs(run_directory, exist_ok=True)
+        root_path = os.path.abspath(root_path)
+        relative_paths = list_image_tree(root_path)
+        connection = _connect(run_directory)
+        with connection:
+            connection.execute("BEGIN")
+            connection.execute("CREATE TABLE settings (key TEXT PRIMARY KEY, value TEXT)")
+            connection.execute("CREATE TABLE images (path TEXT PRIMARY KEY, shard INTEGER, position INTEGER)")
+            connection.execute("CREATE INDEX images_shard ON images (shard, position)")
+            connection.execute("CREATE TABLE shards (shard INTEGER PRIMARY KEY, owner TEXT, expires REAL, "
+                               "done INTEGER DEFAULT 0, processed INTEGER DEFAULT 0, errors INTEGER DEFAULT 0, "
+                               "attempts INTEGER DEFAULT 0)")
+            connection.executemany("INSERT INTO settings VALUES (?, ?)", [
+                ('root_path', root_path),
+                ('shard_count', str(shard_count)),
+                #only the parameters given, json would turn the default colour ranges into lists
+                ('params', json.dumps(params or {}, sort_keys=True)),
+                ('tile_size', json.dumps(tile_size)),
+                ('created', time.strftime('%Y-%m-%dT%H:%M:%S')),
+            ])
+            connection.executemany("INSERT INTO images VALUES (?, ?, ?)", (
+                (relative_path, shard_of(relative_path, shard_count), position)
+                for position, relative_path in enumerate(relative_paths)))
+            connection.executemany("INSERT INTO shards (shard) VALUES (?)", ((shard,) for shard in range(shard_count)))
+        connection.close()
+        return cls(run_directory)
+
+    #claim a shard that is not done and not leased, None when there is none left
+    #the shards released to retry their errors come after the ones not tried yet
+    def claim(self, node_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        now = time.time()
+        #immediate takes the write lock first, two nodes never claim the same shard
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._connection.execute(
+                "SELECT shard FROM shards WHERE done = 0 AND (owner IS NULL OR expires < ?) ORDER BY attempts, shard LIMIT 1",
+                (now,)).fetchone()
+            if row is not None:
+                self._connection.execute(
+                    "UPDATE shards SET owner = ?, expires = ? WHERE shard = ?", (node_id, now + lease_seconds, row[0]))
+            self._connection.execute("COMMIT")
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+        return row[0] if row else None
+
+    #extend the lease of a shard, False when the node lost it to another one
+    def renew(self, shard, node_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        cursor = self._connection.execute(
+            "UPDATE shards SET expires = ? WHERE shard = ? AND owner = ? AND done = 0",
+            (time.time() + lease_seconds, shard, node_id))
+        return cursor.rowcount == 1
+
+    #mark a shard as done, a shard with errors is released to be claimed again until it ran max_attempts times
+    #returns whether the shard is done, None when the node lost its lease
+    def finish(self, shard, node_id, processed, errors, max_attempts=MAX_SHARD_ATTEMPTS):
+        cursor = self._connection.execute(
+            "UPDATE shards SET attempts = attempts + 1, processed = ?, errors = ?, "
+            "done = CASE WHEN ? = 0 OR attempts + 1 >= ? THEN 1 ELSE 0 END, "
+            "owner = CASE WHEN ? = 0 OR attempts + 1 >= ? THEN owner END, "
+            "expires = CASE WHEN ? = 0 OR attempts + 1 >= ? THEN expires END "
+            "WHERE shard = ? AND owner = ?",
+            (processed, errors, errors, max_attempts, errors, max_attempts, errors, max_attempts, shard, node_id))
+        if cursor.rowcount != 1:
+            return None
+        return bool(self._connection.execute("SELECT done FROM shards WHERE shard = ?", (shard,)).fetchone()[0])
+
+    #relative image paths of a shard, or of the whole run, in the order of the tree
+    def images(self, shard=None):
+        if shard is None:
+            rows = self._connection.execute("SELECT path FROM images ORDER BY position")
+        else:
+            rows = self._connection.execute("SELECT path FROM images WHERE shard = ? ORDER BY position", (shard,))
+        return [row[0] for row in rows]
+
+    def shard_directory(self, shard):
+        return os.path.join(self.run_directory, "shards", f"shard-{shard:04d}")
+
+    #results file of a shard, json lines keep the relative path of the images
+    def results_path(self, shard):
+        return os.path.join(self.shard_directory(shard), "results.jsonl")
+
+    #state of every shard: shard, images, owner, expires, done, processed, errors and attempts
+    def status(self):
+        counts = dict(self._connection.execute("SELECT shard, COUNT(*) FROM images GROUP BY shard"))
+        rows = self._connection.execute(
+            "SELECT shard, owner, expires, done, processed, errors, attempts FROM shards ORDER BY shard")
+        return [{'shard': shard, 'images': counts.get(shard, 0), 'owner': owner, 'expires': expires, 'done': bool(done),
+                 'processed': processed, 'errors': errors, 'attempts': attempts}
+                for shard, owner, expires, done, processed, errors, attempts in rows]
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+#process the images of a claimed shard that its manifest does not record yet
+#root_path is where the tree is mounted on this node (default: where init listed it)
+#with save_images the processed images go to the images folder of the shard, in the subfolders of the tree
+#returns a dictionary: shard, processed, skipped, errors, lost (True when the lease was lost,
+#another node then finishes the shard) and done (False when the shard was released to retry its errors)
+def process_shard(run, shard, node_id, workers=None, store=None, save_images=False, output_format='jpeg',
+                  output_quality=None, root_path=None, lease_seconds=DEFAULT_LEASE_SECONDS):
+    root_path = root_path or run.root_path
+    #the images are recorded by their path in the tree, which is already relative, and found below root_path
+    results_writer = ResultsWriter(run.results_path(shard), params=run.params, root_path=os.curdir,
+                                   source_root=root_path)
+    recorded = results_writer.recorded()
+    relative_paths = [relative_path for relative_path in run.images(shard) if relative_path not in recorded]
+    image_paths = [os.path.join(root_path, *relative_path.split('/')) for relative_path in relative_paths]
+    relative_path_of = dict(zip(image_paths, relative_paths))
+    output_dir = os.path.join(run.shard_directory(shard), "images") if save_images else None
+
+    summary = {'shard': shard, 'processed': 0, 'skipped': len(recorded), 'errors': 0, 'lost': False, 'done': False}
+    results = process_batch(image_paths, workers, run.params, output_dir=output_dir, store=store,
+                            preview_sizes=PREVIEW_SIZES if store else (), return_image=False,
+                            output_format=output_format, output_quality=output_quality, tile_size=run.tile_size,
+                            source_root=root_path)
+    renewed = time.monotonic()
+    try:
+        for result in results:
+            if result['error']:
+                #not recorded, finish puts the shard back so the next run of it tries the image again
+                summary['errors'] += 1
+                print(f"shard {shard}: {result['image_path']}: {result['error']}")
+            else:
+                results_writer.write(relative_path_of[result['image_path']], result['metrics'])
+                summary['processed'] += 1
+            if time.monotonic() - renewed > lease_seconds / 3:
+                if not run.renew(shard, node_id, lease_seconds):
+                    summary['lost'] = True
+                    break
+                renewed = time.monotonic()
+    finally:
+        results.close()
+        results_writer.close()
+    if not summary['lost']:
+        processed = summary['processed'] + summary['skipped']
+        done = run.finish(shard, node_id, processed, summary['errors'])
+        summary['lost'] = done is None
+        summary['done'] = bool(done)
+    return summary
+
+
+#combine the manifests of the shards into one csv file with the columns of the GUI, in the order of the tree,
+#the filename column holds the path of the image below the root of the tree
+#returns a dictionary: images (of the run), merged (rows written), unmeasured, missing (not processed yet)
+#and missing_paths, the relative paths of the missing images
+def merge_shards(run, output_path):
+    recorded = {}
+    for shard in range(run.shard_count):
+        recorded.update(read_manifest(run.results_path(shard), run.params, run.root_path))
+    leaf_area_dict = {}
+    counts = {'images': 0, 'merged': 0, 'unmeasured': 0, 'missing': 0, 'missing_paths': []}
+    for relative_path in run.images():
+        counts['images'] += 1
+        if relative_path not in recorded:
+            counts['missing'] += 1
+            counts['missing_paths'].append(relative_path)
+        elif recorded[relative_path] is None:
+            #images that could not be measured are not exported, like on save_to_csv
+            counts['unmeasured'] += 1
+        else:
+            leaf_area_dict[os.path.join(run.root_path, *relative_path.split('/'))] = recorded[relative_path]
+            counts['merged'] += 1
+    #the images are named by their path in the tree, different plots often share filenames
+    write_results_csv(output_path, leaf_area_dict, run.root_path)
+    return counts
+
+
+def _init_command(args):
+    run = ShardRun.create(args.run, args.root, args.shards, pipeline_params(args), args.tile_size)
+    with run:
+        print(f"Sharded run of {len(run.images())} images in {run.shard_count} shards created in {args.run}")
+
+
+def _work_command(args):
+    node_id = args.node or default_node_id()
+    store = ResultStore(args.store) if args.store else None
+    with ShardRun(args.run) as run:
+        while True:
+            shard = run.claim(node_id, args.lease)
+            if shard is None:
+                break
+            start = time.perf_counter()
+            summary = process_shard(run, shard, node_id, args.workers, store, args.images, args.format, args.quality,
+                                    args.root, args.lease)
+            state = "lease lost" if summary['lost'] else "done" if summary['done'] else "released to retry the errors"
+            print(f"shard {shard}: {summary['processed']} processed, {summary['skipped']} already recorded, "
+                  f"{summary['errors']} errors in {time.perf_counter() - start:.1f}s ({state})")
+        leased = sum(1 for shard in run.status() if not shard['done'])
+    if store:
+        store.close()
+    print(f"No shard left to claim, {leased} still processed by other nodes" if leased else "All shards are done")
+
+
+def _status_command(args):
+    with ShardRun(args.run) as run:
+        shards = run.status()
+    now = time.time()
+    for shard in shards:
+        if shard['done']:
+            state = f"done, {shard['processed']} processed, {shard['errors']} errors"
+            if shard['errors']:
+                state += f" after {shard['attempts']} attempts"
+        elif shard['owner'] and shard['expires'] >= now:
+            state = f"leased by {shard['owner']}"
+        else:
+            state = "waiting"
+        print(f"shard {shard['shard']}: {shard['images']} images, {state}")
+    print(f"{sum(shard['done'] for shard in shards)}/{len(shards)} shards done")
+
+
+def _merge_command(args):
+    with ShardRun(args.run) as run:
+        counts = merge_shards(run, args.output)
+    for relative_path in counts['missing_paths']:
+        print("Not processed:", relative_path)
+    print(f"{counts['merged']}/{counts['images']} images merged, {counts['unmeasured']} could not be measured, "
+          f"{counts['missing']} not processed yet")
+    print("CSV file saved to:", args.output)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Process a folder tree in shards on several machines.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    init_parser = commands.add_parser('init', help="list the tree and split it into shards")
+    init_parser.add_argument('run', help="folder of the run on the shared storage")
+    init_parser.add_argument('root', help="root folder of the image tree")
+    init_parser.add_argument('--shards', type=int, default=64, help="number of shards")
+    add_pipeline_arguments(init_parser)
+    init_parser.set_defaults(function=_init_command)
+
+    work_parser = commands.add_parser('work', help="claim and process shards until none is left")
+    work_parser.add_argument('run', help="folder of the run on the shared storage")
+    work_parser.add_argument('--workers', type=int, default=None, help="number of worker processes (default: all cores)")
+    work_parser.add_argument('--root', default=None, help="root of the image tree on this node (default: as given to init)")
+    work_parser.add_argument('--images', action='store_true', help="save the processed images on the folder of the shard")
+    work_parser.add_argument('--format', default='jpeg', choices=list(EXPORT_FORMATS), help="format of the processed images")
+    work_parser.add_argument('--quality', type=int, default=None, help="JPEG/WebP quality or PNG compression level")
+    work_parser.add_argument('--store', default=None, help="result store folder, images already stored are not processed again")
+    work_parser.add_argument('--node', default=None, help="id of this node on the lease table (default: host name and pid)")
+    work_parser.add_argument('--lease', type=float, default=DEFAULT_LEASE_SECONDS, help="seconds of a lease")
+    work_parser.set_defaults(function=_work_command)
+
+    status_parser = commands.add_parser('status', help="show the state of the shards")
+    status_parser.add_argument('run', help="folder of the run")
+    status_parser.set_defaults(function=_status_command)
+
+    merge_parser = commands.add_parser('merge', help="combine the results of the shards into one csv file")
+    merge_parser.add_argument('run', help="folder of the run")
+    merge_parser.add_argument('output', help="csv file to write")
+    merge_parser.set_defaults(function=_merge_command)
+
+    args = parser.parse_args(argv)
+    args.function(args)
+
+
+if __name__ == "__main__":
+    main()
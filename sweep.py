@@ -0,0 +1,246 @@
+"""
+Parameter sweep of PhenoScan Cassava.
+
+Description:
+    Measures the images of a folder with every combination of a grid of
+    thresholds, e.g. to tune the green range and the component size for a new
+    cultivar without editing the pipeline. The measurement runs the stages of
+    pipeline.process_decoded_image (hsv, green, components, plant, blue) and
+    the output of every stage is kept per image under the parameters it
+    depends on. Decoding, blurring and the hsv conversion run once per image,
+    the green mask once per green range, the card once per blue range and card
+    mode, and so on.
+
+    The parameter sets are visited with the parameters of the first stages
+    changing least often, so only the last mask of every stage is kept and
+    the memory of a sweep stays close to the one of a single image.
+
+    The metrics are the ones batch.py and the GUI report with the same
+    parameters. The options of batch.py (--detection-scale, --tile-size, ...)
+    apply to every parameter set. An image located on a downscaled copy or
+    processed in tiles runs the whole pipeline for every parameter set, its
+    stages are not shared. The table has one row per parameter set and image
+    with the columns of the GUI.
+
+Usage:
+    python sweep.py /path/to/folder --grid min_component_size=10000,20000,40000 --grid max_distance=250,500 --csv sweep.csv
+    python sweep.py /path/to/folder --grid green_lower=30/25/25,34/25/25,38/25/25 --workers 4
+"""
+
+
+import argparse
+import csv
+import itertools
+import os
+import time
+from collections import Counter, OrderedDict
+from multiprocessing import Pool
+
+import cv2
+
+from batch import _init_worker, add_pipeline_arguments, default_workers, list_image_files, pipeline_params
+from export import CSV_HEADER, METRIC_KEYS
+from pipeline import (DEFAULT_PARAMS, blur_hsv_stage, card_metrics, components_stage, green_stage, locate_card,
+                      plant_stage, process_decoded_image, read_image, resolve_params, resolve_tile_size)
+
+
+#parameters each stage depends on, with the ones of the stages it reads
+STAGE_PARAMS = {
+    'hsv': (),
+    'green': ('kernel_size', 'morphology', 'green_lower', 'green_upper'),
+    'components': ('kernel_size', 'morphology', 'green_lower', 'green_upper', 'min_component_size'),
+    'plant': ('kernel_size', 'morphology', 'green_lower', 'green_upper', 'min_component_size', 'max_distance'),
+    'blue': ('blue_lower', 'blue_upper', 'card_mode'),
+}
+
+#outputs kept per stage, None keeps them all
+#the masks are large, only the last one is kept, the pixel counts are small
+STAGE_KEEP = {'hsv': 1, 'green': 1, 'components': 1, 'plant': None, 'blue': None}
+
+#parameters a sweep can vary, in the order of the stages reading them
+SWEEP_PARAMS = ('detection_scale', 'kernel_size', 'morphology', 'green_lower', 'green_upper', 'min_component_size', 'max_distance',
+                'blue_lower', 'blue_upper', 'card_mode', 'blue_area_cm2')
+
+
+class StageMemo:
+    #outputs of the stages of one image keyed by the parameters they depend on
+    def __init__(self):
+        self._outputs = {stage: OrderedDict() for stage in STAGE_PARAMS}
+        self.computed = Counter()
+        self.reused = Counter()
+
+    #output of a stage for params, compute() runs only when no earlier parameter set had the same key
+    #a failed stage is remembered too, the parameter sets sharing it fail the same way
+    def get(self, stage, params, compute):
+        key = tuple(params[name] for name in STAGE_PARAMS[stage])
+        outputs = self._outputs[stage]
+        if key in outputs:
+            self.reused[stage] += 1
+            output = outputs[key]
+        else:
+            self.computed[stage] += 1
+            try:
+                output = compute()
+            except Exception as e:
+                output = e
+            keep = STAGE_KEEP[stage]
+            if keep is not None and len(outputs) >= keep:
+                outputs.popitem(last=False)
+            outputs[key] = output
+        if isinstance(output, Exception):
+            raise output
+        return output
+
+
+#pixels of the plant and of its merged hull, the plant mask itself is not kept
+def _plant_pixels(green_mask, params):
+    plant_mask, _, convex_hull_pixel = plant_stage(green_mask, params)
+    return cv2.countNonZero(plant_mask), convex_hull_pixel
+
+
+#the card without its masks, only its pixels and box are measured
+def _card(hsv_image, params):
+    card = locate_card(None, params, hsv_image=hsv_image)
+    return {'box': card['box'], 'pixels': card['pixels']} if card else None
+
+
+#metrics of a bgr image for one resolved parameter set, the stages computed for earlier sets are reused
+#tile_size as given to pipeline.process_image
+def measure(image, params, memo, tile_size=None):
+    if params['detection_scale'] < 1 or resolve_tile_size(image.shape, tile_size):
+        #the stages of the coarse to fine and tiled pipelines are not the full resolution ones
+        _, metrics = process_decoded_image(image, params, tile_size=tile_size)
+        if metrics is None:
+            raise ValueError("Cannot measure the image")
+        return metrics
+
+    hsv_image = memo.get('hsv', params, lambda: blur_hsv_stage(image)[1])
+    green_mask = memo.get('green', params, lambda: green_stage(hsv_image, params))
+    components_mask = memo.get('components', params, lambda: components_stage(green_mask, params))
+    leaf_area_pixel, convex_hull_pixel = memo.get('plant', params, lambda: _plant_pixels(components_mask, params))
+    card = memo.get('blue', params, lambda: _card(hsv_image, params))
+    return card_metrics(leaf_area_pixel, convex_hull_pixel, card, params)
+
+
+#every combination of a grid {name: [values]} as parameter overrides
+#the parameters of the first stages change least often, so the stages before them are reused
+def parameter_sets(grid):
+    unknown = [name for name in grid if name not in SWEEP_PARAMS]
+    if unknown:
+        raise ValueError(f"Cannot sweep: {', '.join(unknown)}")
+    names = [name for name in SWEEP_PARAMS if name in grid]
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+#runs on a worker process, must stay at module level so it can be pickled
+def _sweep_task(task):
+    image_path = task['image_path']
+    result = {'image_path': image_path, 'metrics': [], 'errors': [], 'computed': None, 'reused': None, 'error': None}
+    image = read_image(image_path)
+    if image is None:
+        result['error'] = f"ValueError: Cannot read image: {image_path}"
+        return result
+    memo = StageMemo()
+    for params in task['param_sets']:
+        try:
+            result['metrics'].append(measure(image, resolve_params({**task['params'], **params}), memo, task['tile_size']))
+            result['errors'].append(None)
+        except Exception as e:
+            result['metrics'].append(None)
+            result['errors'].append(f"{type(e).__name__}: {e}")
+    result['computed'] = dict(memo.computed)
+    result['reused'] = dict(memo.reused)
+    return result
+
+
+#measure every image with every parameter set on worker processes
+#yields one result per image as they finish, result['metrics'][i] belongs to param_sets[i]
+#params are the pipeline parameters the sets override, tile_size is passed to pipeline.process_image
+def sweep_folder(image_paths, param_sets, workers=None, params=None, tile_size=None):
+    workers = workers or default_workers()
+    tasks = [{'image_path': image_path, 'param_sets': param_sets, 'params': params or {}, 'tile_size': tile_size}
+             for image_path in image_paths]
+    if workers == 1 or len(tasks) < 2:
+        yield from map(_sweep_task, tasks)
+        return
+    with Pool(processes=min(workers, len(tasks)), initializer=_init_worker) as pool:
+        yield from pool.imap_unordered(_sweep_task, tasks)
+
+
+#write one row per parameter set and image, the swept parameters come before the columns of the GUI
+#results are the results of sweep_folder in the order of the rows
+def write_sweep_csv(file_path, param_sets, results):
+    names = [name for name in SWEEP_PARAMS if any(name in params for params in param_sets)]
+    with open(file_path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['Parameter Set'] + names + CSV_HEADER)
+        for index, params in enumerate(param_sets):
+            values = ['/'.join(map(str, params[name])) if isinstance(params[name], tuple) else params[name] for name in names]
+            for result in results:
+                metrics = result['metrics'][index] if result['metrics'] else None
+                if metrics is not None:
+                    filename = os.path.basename(result['image_path'])
+                    writer.writerow([index] + values + [filename] + [metrics[key] for key in METRIC_KEYS])
+
+
+#values of a --grid argument name=v1,v2 with the type of the default, hsv bounds are written 34/25/25
+def parse_grid_argument(argument):
+    name, _, values = argument.partition('=')
+    if name not in DEFAULT_PARAMS or not values:
+        raise argparse.ArgumentTypeError(f"expected name=value,value with a pipeline parameter: {argument}")
+    default = DEFAULT_PARAMS[name]
+    if isinstance(default, tuple):
+        convert = lambda value: tuple(int(part) for part in value.split('/'))
+    else:
+        convert = type(default)
+    try:
+        return name, [convert(value) for value in values.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid values for {name}: {values}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure a folder of cassava images with a grid of thresholds.")
+    parser.add_argument('folder', help="folder containing the images")
+    parser.add_argument('--grid', type=parse_grid_argument, action='append', required=True,
+                        help="parameter and its values, e.g. max_distance=250,500 or green_lower=30/25/25,34/25/25")
+    parser.add_argument('--workers', type=int, default=None, help="number of worker processes (default: all cores)")
+    parser.add_argument('--csv', default=None, help="csv file to write the table to")
+    #the card of one image does not depend on the images measured before it
+    add_pipeline_arguments(parser, card_tracking=False)
+    args = parser.parse_args(argv)
+
+    try:
+        param_sets = parameter_sets(dict(args.grid))
+    except ValueError as e:
+        parser.error(str(e))
+    image_paths = list_image_files(args.folder)
+    start = time.perf_counter()
+    computed, reused = Counter(), Counter()
+    results = {}
+    results_iter = sweep_folder(image_paths, param_sets, args.workers, pipeline_params(args), args.tile_size)
+    for i, result in enumerate(results_iter, start=1):
+        results[result['image_path']] = result
+        if result['error']:
+            print(f"[{i}/{len(image_paths)}] {result['image_path']}: {result['error']}")
+            continue
+        computed.update(result['computed'])
+        reused.update(result['reused'])
+        print(f"[{i}/{len(image_paths)}] {result['image_path']}")
+    elapsed = time.perf_counter() - start
+    print(f"Measured {len(image_paths)} images with {len(param_sets)} parameter sets in {elapsed:.1f}s")
+    print("Stages computed / reused:", ", ".join(f"{stage} {computed[stage]}/{reused[stage]}" for stage in STAGE_PARAMS))
+
+    #keep the table in folder order even though the results arrive out of order
+    ordered = [results[image_path] for image_path in image_paths]
+    for index, params in enumerate(param_sets):
+        measured = [result['metrics'][index] for result in ordered if result['metrics'] and result['metrics'][index]]
+        mean = sum(metrics['leaf_area_cm2'] for metrics in measured) / len(measured) if measured else 0
+        print(f"set {index} {params}: {len(measured)}/{len(image_paths)} measured, mean leaf area {mean:.2f} cm2")
+    if args.csv:
+        write_sweep_csv(args.csv, param_sets, ordered)
+        print("CSV file saved to:", args.csv)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Tests of the result store of PhenoScan Cassava.
+
+Description:
+    Checks that opening a cache.ResultStore deletes the mask packs no result
+    points to, and keeps the packs of results, of running processes and the
+    ones written recently, whose results may still be recorded.
+
+Usage:
+    python -m pytest tests
+"""
+
+
+import os
+import socket
+import sys
+import time
+
+import numpy as np
+import psutil
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache import PACK_GRACE_SECONDS, ResultStore
+from masks import append_arrays
+
+
+#id of a process that is not running
+def stopped_pid():
+    pid = 4000000
+    while psutil.pid_exists(pid):
+        pid -= 1
+    return pid
+
+
+#a pack of masks of the given process on this host, written age seconds ago, returns its name
+def write_pack(blob_directory, pid, age):
+    name = f"masks-{socket.gethostname()}-{pid}.pack"
+    path = os.path.join(blob_directory, name)
+    offset = append_arrays(path, (np.arange(4, dtype=np.uint32), np.zeros(0, np.uint32), np.zeros(8, np.int32)))
+    written = time.time() - age
+    os.utime(path, (written, written))
+    return name, offset
+
+
+def test_unused_packs_are_removed_when_the_store_opens(tmp_path):
+    store = ResultStore(str(tmp_path))
+    blob_directory = store.blob_directory
+    old = PACK_GRACE_SECONDS + 60
+    pid = stopped_pid()
+    unused, _ = write_pack(blob_directory, pid, old)
+    used, offset = write_pack(blob_directory, pid - 1, old)
+    recent, _ = write_pack(blob_directory, pid - 2, 60)
+    running, _ = write_pack(blob_directory, os.getppid(), old)
+    store.put("key", {'leaf_area_cm2': 1.0},
+              {'pack': used, 'offset': offset, 'shape': (2, 2), 'counts': (4, 0, 8)})
+    store.close()
+
+    store = ResultStore(str(tmp_path))
+    names = set(os.listdir(blob_directory))
+    assert unused not in names
+    assert {used, recent, running} <= names
+    assert np.array_equal(store.load_masks("key")['green'], np.arange(4))
+    assert store.remove_unused_packs() == []
+    store.close()
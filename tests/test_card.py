@@ -0,0 +1,80 @@
+"""
+Tests of the reference card of PhenoScan Cassava.
+
+Description:
+    Checks the card search of pipeline.locate_card with and without a
+    card.CardTracker on scenes drawn here: a card followed on a fixed rig, a
+    card that moved while a blue object of about its size took its place, and
+    the tracker being ignored unless card_tracking is on.
+
+Usage:
+    python -m pytest tests
+"""
+
+
+import os
+import sys
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from card import CardTracker, find_card
+from pipeline import locate_card, resolve_params
+
+
+SOIL_COLOR = (70, 100, 135)
+CARD_COLOR = (190, 70, 30)
+
+
+#a soil image of 3000 x 2000 pixels with blue squares (x, y, side)
+def scene(*squares):
+    image = np.full((2000, 3000, 3), SOIL_COLOR, np.uint8)
+    for x, y, side in squares:
+        image[y:y + side, x:x + side] = CARD_COLOR
+    return image
+
+
+#box of a card found on a blurred image, its edges move by a pixel or two
+def near(box, expected, tolerance=3):
+    return all(abs(value - other) <= tolerance for value, other in zip(box, expected))
+
+
+def test_find_card_takes_the_largest_card_shape():
+    mask = np.zeros((400, 400), np.uint8)
+    #a long strip is larger but not shaped like a card
+    mask[10:20, 0:400] = 255
+    mask[100:150, 100:150] = 255
+    mask[300:320, 300:320] = 255
+    card = find_card(mask)
+    assert card['box'] == (100, 100, 50, 50)
+    assert card['pixels'] == 2500
+    assert find_card(mask, 'threshold')['pixels'] == cv2.countNonZero(mask)
+
+
+def test_tracked_card_on_a_fixed_rig():
+    params = resolve_params({'card_tracking': True})
+    tracker = CardTracker()
+    for _ in range(3):
+        card = locate_card(scene((100, 100, 100), (2000, 1500, 40)), params, tracker)
+        assert near(card['box'], (100, 100, 100, 100))
+    assert tracker.hits == 2 and tracker.misses == 1
+
+
+def test_moved_card_is_not_mistaken_for_a_blue_object():
+    params = resolve_params({'card_tracking': True})
+    tracker = CardTracker()
+    locate_card(scene((100, 100, 100)), params, tracker)
+    #the card moved and a blue object of about its size is where it was
+    card = locate_card(scene((105, 105, 95), (2000, 1000, 110)), params, tracker)
+    untracked = locate_card(scene((105, 105, 95), (2000, 1000, 110)), resolve_params(None))
+    assert card['box'] == untracked['box']
+    assert near(card['box'], (2000, 1000, 110, 110))
+    assert tracker.misses == 2
+
+
+def test_tracker_is_ignored_without_card_tracking():
+    tracker = CardTracker()
+    locate_card(scene((100, 100, 100)), resolve_params(None), tracker)
+    assert tracker.box is None and tracker.hits == tracker.misses == 0
@@ -0,0 +1,139 @@
+"""
+Tests of the results files of PhenoScan Cassava.
+
+Description:
+    Checks export.ResultsWriter across runs: a rerun resumes with the images
+    its manifest records, an image measured again or changed on disk is
+    measured again with one row left for it, rows repeated by a crash and
+    rows of other parameters are dropped when the file is opened, and the
+    parts of a parquet results folder share their column types.
+
+Usage:
+    python -m pytest tests
+"""
+
+
+import csv
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from export import METRIC_KEYS, ResultsWriter, read_manifest
+
+
+#metrics of a measured image, every value derived from leaf_area
+def metrics_of(leaf_area, card=True):
+    metrics = {key: int(leaf_area) for key in METRIC_KEYS}
+    metrics['leaf_area_cm2'] = float(leaf_area)
+    if not card:
+        for key in ('card_x', 'card_y', 'card_width', 'card_height'):
+            metrics[key] = None
+    return metrics
+
+
+#images on disk, their size and modification time are recorded with their results
+@pytest.fixture
+def images(tmp_path):
+    paths = []
+    for name in ("a.jpg", "b.jpg", "c.jpg"):
+        path = tmp_path / name
+        path.write_bytes(name.encode())
+        paths.append(str(path))
+    return paths
+
+
+#rows of a csv results file as (filename, leaf area)
+def csv_rows(path):
+    with open(path, newline='') as f:
+        return [(row[0], float(row[1])) for row in list(csv.reader(f))[1:]]
+
+
+def test_rerun_resumes_with_the_recorded_images(tmp_path, images):
+    path = str(tmp_path / "results.csv")
+    with ResultsWriter(path) as writer:
+        writer.write(images[0], metrics_of(10))
+        writer.write(images[1], None)
+    with ResultsWriter(path) as writer:
+        assert writer.recorded() == {images[0]: metrics_of(10), images[1]: None}
+        assert images[2] not in writer
+        writer.write(images[2], metrics_of(30))
+    #images that could not be measured have no row
+    assert csv_rows(path) == [("a.jpg", 10.0), ("c.jpg", 30.0)]
+    assert read_manifest(path) == {images[0]: metrics_of(10), images[1]: None, images[2]: metrics_of(30)}
+
+
+def test_one_row_per_image_measured_again(tmp_path, images):
+    path = str(tmp_path / "results.csv")
+    with ResultsWriter(path) as writer:
+        writer.write(images[0], metrics_of(10))
+        writer.write(images[1], metrics_of(20))
+    with ResultsWriter(path) as writer:
+        writer.write(images[0], metrics_of(11))
+    #the replaced row goes when the file is opened again
+    ResultsWriter(path).close()
+    assert sorted(csv_rows(path)) == [("a.jpg", 11.0), ("b.jpg", 20.0)]
+
+
+def test_changed_image_is_measured_again(tmp_path, images):
+    path = str(tmp_path / "results.csv")
+    with ResultsWriter(path) as writer:
+        writer.write(images[0], metrics_of(10))
+        writer.write(images[1], metrics_of(20))
+    with open(images[1], 'ab') as f:
+        f.write(b"changed")
+    with ResultsWriter(path) as writer:
+        assert list(writer.recorded()) == [images[0]]
+    assert csv_rows(path) == [("a.jpg", 10.0)]
+
+
+def test_rows_repeated_by_a_crash_are_dropped(tmp_path, images):
+    path = str(tmp_path / "results.csv")
+    with ResultsWriter(path) as writer:
+        writer.write(images[0], metrics_of(10))
+    #a crash after the rows reached the disk but before the manifest did: the rerun writes them again
+    with open(path, 'a', newline='') as f:
+        csv.writer(f).writerow(["b.jpg", 20] + [20] * (len(METRIC_KEYS) - 1))
+    with ResultsWriter(path) as writer:
+        assert list(writer.recorded()) == [images[0]]
+        writer.write(images[1], metrics_of(20))
+    assert csv_rows(path) == [("a.jpg", 10.0), ("b.jpg", 20.0)]
+
+
+def test_other_parameters_start_over(tmp_path, images):
+    path = str(tmp_path / "results.jsonl")
+    with ResultsWriter(path) as writer:
+        writer.write(images[0], metrics_of(10))
+    params = {'min_component_size': 1000}
+    with ResultsWriter(path, params=params) as writer:
+        assert writer.recorded() == {}
+        writer.write(images[1], metrics_of(20))
+    assert read_manifest(path) == {}
+    assert read_manifest(path, params) == {images[1]: metrics_of(20)}
+    with open(path, encoding='utf-8') as f:
+        assert len(f.readlines()) == 1
+
+
+def test_relative_paths_are_checked_below_their_root(tmp_path, images):
+    path = str(tmp_path / "run" / "results.jsonl")
+    with ResultsWriter(path, source_root=str(tmp_path)) as writer:
+        writer.write("a.jpg", metrics_of(10))
+    assert read_manifest(path, source_root=str(tmp_path)) == {"a.jpg": metrics_of(10)}
+    #from the current folder the image would not be found and its change would go unnoticed
+    with open(images[0], 'ab') as f:
+        f.write(b"changed")
+    assert read_manifest(path, source_root=str(tmp_path)) == {}
+
+
+def test_parquet_parts_share_their_types(tmp_path, images):
+    parquet = pytest.importorskip("pyarrow.parquet")
+    path = str(tmp_path / "results.parquet")
+    #the first part has no card at all, the second one has
+    with ResultsWriter(path, sync_every=1) as writer:
+        writer.write(images[0], metrics_of(10, card=False))
+        writer.write(images[1], metrics_of(20))
+    table = parquet.read_table(path)
+    assert table.num_rows == 2
+    assert table.column('card_x').to_pylist() == [None, 20]
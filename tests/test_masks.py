@@ -0,0 +1,95 @@
+"""
+Tests of the compact masks of PhenoScan Cassava.
+
+Description:
+    Checks that the runs of a mask decode to the same mask, also when the mask
+    is encoded in pieces like the tiles of an image, and that the masks
+    appended to a pack by several threads of a process at once read back the
+    same as they were written.
+
+Usage:
+    python -m pytest tests
+"""
+
+
+import os
+import sys
+import threading
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from masks import PackReader, append_arrays, decode_mask, encode_mask, pack_path
+
+
+SHAPE = (300, 400)
+
+
+#a random mask of blobs, different for every seed
+def random_mask(seed):
+    rng = np.random.default_rng(seed)
+    mask = np.zeros(SHAPE, np.uint8)
+    for _ in range(20):
+        y, x = rng.integers(0, SHAPE[0]), rng.integers(0, SHAPE[1])
+        height, width = rng.integers(1, 60, 2)
+        mask[y:y + height, x:x + width] = 255
+    return mask
+
+
+def test_runs_decode_to_the_mask():
+    blank = np.zeros(SHAPE, np.uint8)
+    full = np.full(SHAPE, 255, np.uint8)
+    #runs touching the edges of the rows, the first and the last pixel
+    edges = blank.copy()
+    edges[:, 0] = edges[:, -1] = 255
+    edges[0, :] = 255
+    corners = blank.copy()
+    corners[0, 0] = corners[-1, -1] = 255
+    for mask in (blank, full, edges, corners, random_mask(1), random_mask(2)):
+        runs = encode_mask(mask)
+        assert runs.dtype == np.uint32
+        assert np.array_equal(decode_mask(runs, SHAPE), mask)
+    assert len(encode_mask(blank)) == 0
+    #one run per row, a run never goes on to the next row
+    assert len(encode_mask(full)) == 2 * SHAPE[0]
+
+
+def test_pieces_decode_to_the_whole_mask():
+    mask = random_mask(3)
+    height, width = SHAPE
+    pieces = []
+    for y in range(0, height, 128):
+        for x in range(0, width, 150):
+            piece = mask[y:y + 128, x:x + 150]
+            pieces.append(encode_mask(piece, width, (x, y)))
+    assert np.array_equal(decode_mask(np.concatenate(pieces), SHAPE), mask)
+
+
+def test_threads_append_to_one_pack(tmp_path):
+    path = pack_path(str(tmp_path))
+    records = {}
+    records_lock = threading.Lock()
+
+    def append(thread):
+        for i in range(20):
+            seed = thread * 1000 + i
+            runs = encode_mask(random_mask(seed))
+            #a large array between the runs makes a torn record likely without the lock
+            filler = np.full(100000, seed, np.uint32)
+            offset = append_arrays(path, (runs, filler))
+            with records_lock:
+                records[seed] = (offset, len(runs))
+
+    threads = [threading.Thread(target=append, args=(thread,)) for thread in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    reader = PackReader(str(tmp_path))
+    assert len(records) == 80
+    for seed, (offset, count) in records.items():
+        runs, filler = reader.read(os.path.basename(path), offset, (count, 100000), (np.uint32, np.uint32))
+        assert np.array_equal(decode_mask(runs, SHAPE), random_mask(seed))
+        assert (filler == seed).all()
@@ -0,0 +1,143 @@
+"""
+Tests of the pipeline of PhenoScan Cassava.
+
+Description:
+    Checks pipeline.merge_hulls against a brute force transitive merge built on
+    the point by point distance check of the first versions: hulls are merged
+    when a chain of close hulls links them, whatever order they come in.
+
+    Checks that a plant drawn across the seams of the tiles measures and
+    records the same masks in tiles as whole, and that locating it on a
+    downscaled copy (detection_scale) gives the metrics of the full resolution.
+
+Usage:
+    python -m pytest tests
+"""
+
+
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pipeline import merge_hulls, process_decoded_image, resolve_params
+
+
+SOIL_COLOR = (70, 100, 135)
+LEAF_COLOR = (40, 160, 50)
+CARD_COLOR = (190, 70, 30)
+
+
+#distance check of the first versions, point by point
+def reference_hulls_close(hull1, hull2, max_distance):
+    for point1 in hull1:
+        for point2 in hull2:
+            if np.linalg.norm(point1[0] - point2[0]) < max_distance:
+                return True
+    return False
+
+
+#brute force transitive merge using the reference distance check
+def reference_merge_hulls(hulls, max_distance):
+    unvisited = list(range(len(hulls)))
+    merged = []
+    while unvisited:
+        cluster = [unvisited.pop(0)]
+        k = 0
+        while k < len(cluster):
+            for j in list(unvisited):
+                if reference_hulls_close(hulls[cluster[k]], hulls[j], max_distance):
+                    unvisited.remove(j)
+                    cluster.append(j)
+            k += 1
+        merged.append(cv2.convexHull(np.vstack([hulls[i] for i in sorted(cluster)])))
+    return merged
+
+
+#order independent form of a list of hulls
+def canonical(hulls):
+    return sorted(tuple(sorted(map(tuple, hull.reshape(-1, 2).tolist()))) for hull in hulls)
+
+
+def square_hull(x, y, side=10):
+    points = np.array([[x, y], [x + side, y], [x + side, y + side], [x, y + side]], np.int32)
+    return cv2.convexHull(points.reshape(-1, 1, 2))
+
+
+#random blobs spread over a field image, like the contours surviving the filtering
+def random_hulls(rng, count, width=6000, height=4000):
+    hulls = []
+    for _ in range(count):
+        center = rng.integers((0, 0), (width, height))
+        radius = rng.integers(20, 300)
+        angles = np.sort(rng.uniform(0, 2 * np.pi, rng.integers(8, 60)))
+        radii = radius * rng.uniform(0.6, 1.0, len(angles))
+        points = np.stack([center[0] + radii * np.cos(angles), center[1] + radii * np.sin(angles)], axis=1)
+        hulls.append(cv2.convexHull(points.astype(np.int32).reshape(-1, 1, 2)))
+    return hulls
+
+
+#a soil image of 3000 x 2000 pixels with a plant of overlapping leaves in the middle and a card in a corner
+def plant_scene(seed):
+    rng = np.random.default_rng(seed)
+    image = np.full((2000, 3000, 3), SOIL_COLOR, np.uint8)
+    for _ in range(12):
+        center = (int(1500 + rng.integers(-500, 500)), int(1000 + rng.integers(-400, 400)))
+        axes = (int(rng.integers(80, 220)), int(rng.integers(40, 120)))
+        cv2.ellipse(image, center, axes, float(rng.uniform(0, 180)), 0, 360, LEAF_COLOR, -1)
+    image[150:350, 150:350] = CARD_COLOR
+    return image
+
+
+def test_merge_hulls_follows_chains():
+    #the first and last squares are far apart, the middle one is close to both
+    hulls = [square_hull(0, 0), square_hull(100, 0), square_hull(50, 0)]
+    merged = merge_hulls(hulls, 45)
+    assert len(merged) == 1
+    assert canonical(merged) == canonical([cv2.convexHull(np.vstack(hulls))])
+
+
+def test_merge_hulls_keeps_far_hulls_apart():
+    hulls = [square_hull(0, 0), square_hull(500, 0), square_hull(0, 500)]
+    assert canonical(merge_hulls(hulls, 100)) == canonical(hulls)
+
+
+def test_merge_hulls_without_hulls():
+    assert len(merge_hulls([], 100)) == 0
+
+
+@pytest.mark.parametrize('count', [1, 10, 30, 60])
+def test_merge_hulls_matches_reference(count):
+    rng = np.random.default_rng(count)
+    for _ in range(5):
+        hulls = random_hulls(rng, count)
+        assert canonical(merge_hulls(list(hulls), 500)) == canonical(reference_merge_hulls(hulls, 500))
+
+
+@pytest.mark.parametrize('tile_size', [512, 700])
+def test_tiles_measure_like_the_whole_image(tile_size):
+    image = plant_scene(tile_size)
+    params = resolve_params({})
+    whole_masks, tiled_masks = {}, {}
+    _, whole = process_decoded_image(image, params, tile_size=0, masks=whole_masks)
+    _, tiled = process_decoded_image(image, params, tile_size=tile_size, masks=tiled_masks)
+    assert whole['number_of_green_pixels'] > 0
+    assert tiled == whole
+    assert tiled_masks['shape'] == whole_masks['shape']
+    for name in ('green', 'blue', 'hull'):
+        assert np.array_equal(tiled_masks[name], whole_masks[name])
+
+
+@pytest.mark.parametrize('detection_scale', [0.5, 0.25])
+def test_coarse_to_fine_measures_at_full_resolution(detection_scale):
+    image = plant_scene(1)
+    _, full = process_decoded_image(image, resolve_params({}), tile_size=0)
+    _, coarse = process_decoded_image(image, resolve_params({'detection_scale': detection_scale}), tile_size=0)
+    #the card and the plant are counted on the full resolution pixels
+    assert coarse['number_of_blue_pixels'] == full['number_of_blue_pixels']
+    assert coarse['number_of_green_pixels'] == pytest.approx(full['number_of_green_pixels'], rel=0.01)
+    assert coarse['convex_hull_pixels'] == pytest.approx(full['convex_hull_pixels'], rel=0.01)
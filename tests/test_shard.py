@@ -0,0 +1,113 @@
+"""
+Tests of the sharded runs of PhenoScan Cassava.
+
+Description:
+    Checks the lease table of shard.ShardRun: a shard is claimed by one node
+    at a time, an expired lease is claimed by the next node and the old owner
+    can neither renew nor finish it, and a shard with errors is put back
+    until it ran out of attempts. Then runs the shards of a small tree: a
+    shard run again skips the images its manifest records unless they
+    changed, and merge writes one row per image.
+
+Usage:
+    python -m pytest tests
+"""
+
+
+import csv
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shard import ShardRun, merge_shards, process_shard, shard_of
+
+
+#a soil image with a plant of a few leaves and a card, the plant grows with size
+def plant_image(size):
+    image = np.full((800, 1200, 3), (70, 100, 135), np.uint8)
+    cv2.ellipse(image, (600, 400), (size, size // 2), 30, 0, 360, (40, 160, 50), -1)
+    cv2.ellipse(image, (650, 450), (size, size // 2), 120, 0, 360, (40, 160, 50), -1)
+    image[50:150, 50:150] = (190, 70, 30)
+    return image
+
+
+#a tree of images whose filenames repeat in every plot
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / "images"
+    for plot, size in (("plotA", 200), ("plotB", 240), ("plotC", 280)):
+        os.makedirs(root / plot)
+        for name in ("IMG_1.png", "IMG_2.png"):
+            cv2.imwrite(str(root / plot / name), plant_image(size))
+    return root
+
+
+def test_shards_of_the_tree(tmp_path, tree):
+    with ShardRun.create(str(tmp_path / "run"), str(tree), 4) as run:
+        images = run.images()
+        assert len(images) == 6
+        assert images[0] == "plotA/IMG_1.png"
+        assert sorted(sum((run.images(shard) for shard in range(4)), [])) == sorted(images)
+        for shard in range(4):
+            assert all(shard_of(relative_path, 4) == shard for relative_path in run.images(shard))
+    with pytest.raises(FileExistsError):
+        ShardRun.create(str(tmp_path / "run"), str(tree), 4)
+
+
+def test_one_node_per_shard_and_expired_leases(tmp_path, tree):
+    with ShardRun.create(str(tmp_path / "run"), str(tree), 2) as run:
+        assert run.claim("a") == 0
+        assert run.claim("b") == 1
+        assert run.claim("c") is None
+
+        #the lease of a expired, c takes its shard and a cannot renew or finish it any more
+        assert run.renew(0, "a", lease_seconds=-1)
+        assert run.claim("c") == 0
+        assert not run.renew(0, "a")
+        assert run.finish(0, "a", 3, 0) is None
+        assert run.finish(0, "c", 3, 0) is True
+        assert run.finish(1, "b", 3, 0) is True
+        assert run.claim("a") is None
+        assert [(status['done'], status['processed'], status['attempts']) for status in run.status()] == [
+            (True, 3, 1), (True, 3, 1)]
+
+
+def test_shard_with_errors_is_retried(tmp_path, tree):
+    with ShardRun.create(str(tmp_path / "run"), str(tree), 2) as run:
+        shard = run.claim("a")
+        #put back after its first and second run, done after the last one
+        assert run.finish(shard, "a", 2, 1, max_attempts=3) is False
+        #the shard not tried yet comes first
+        assert run.claim("b") == 1 - shard
+        assert run.claim("a") == shard
+        assert run.finish(shard, "a", 2, 1, max_attempts=3) is False
+        assert run.claim("a") == shard
+        assert run.finish(shard, "a", 2, 1, max_attempts=3) is True
+        assert run.status()[shard]['attempts'] == 3
+
+
+def test_rerun_skips_recorded_images_unless_they_changed(tmp_path, tree):
+    with ShardRun.create(str(tmp_path / "run"), str(tree), 1) as run:
+        run.claim("a")
+        summary = process_shard(run, 0, "a", workers=1)
+        assert (summary['processed'], summary['skipped'], summary['errors'], summary['done']) == (6, 0, 0, True)
+
+        #the images are found below the root of the tree whatever the current folder is
+        cv2.imwrite(str(tree / "plotB" / "IMG_2.png"), plant_image(150))
+        summary = process_shard(run, 0, "a", workers=1)
+        assert (summary['processed'], summary['skipped']) == (1, 5)
+
+        counts = merge_shards(run, str(tmp_path / "results.csv"))
+        assert (counts['images'], counts['merged'], counts['missing']) == (6, 6, 0)
+    with open(tmp_path / "results.csv", newline='') as f:
+        rows = list(csv.reader(f))[1:]
+    assert [row[0] for row in rows] == [
+        "plotA/IMG_1.png", "plotA/IMG_2.png", "plotB/IMG_1.png", "plotB/IMG_2.png", "plotC/IMG_1.png", "plotC/IMG_2.png"]
+    areas = {row[0]: float(row[1]) for row in rows}
+    #the changed image was measured again
+    assert areas["plotB/IMG_2.png"] < areas["plotA/IMG_1.png"] < areas["plotB/IMG_1.png"]
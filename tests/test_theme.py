@@ -0,0 +1,40 @@
+"""
+Tests of the theme sheet of PhenoScan Cassava.
+
+Description:
+    Checks that the packed sheet of the forest-dark theme was packed from the
+    images of the theme, forest-dark.tcl loads it without looking at them,
+    and that a changed image is noticed.
+
+Usage:
+    python -m pytest tests
+"""
+
+
+import os
+import shutil
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from pack_theme import main, pack_theme, read_stamp, theme_stamp
+
+
+THEME = os.path.join(ROOT, "forest-dark")
+
+
+def test_sheet_is_packed_from_the_theme_images():
+    #fails after an image of the theme changed until "python pack_theme.py" is run
+    assert read_stamp(THEME) == theme_stamp(THEME)
+
+
+def test_changed_image_makes_the_sheet_out_of_date(tmp_path):
+    theme = str(tmp_path / "forest-dark")
+    shutil.copytree(THEME, theme)
+    assert read_stamp(theme) is None
+    pack_theme(theme)
+    assert main(['--theme', theme, '--check']) == 0
+    with open(os.path.join(theme, "card.png"), 'ab') as f:
+        f.write(b"\0")
+    assert main(['--theme', theme, '--check']) == 1
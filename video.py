@@ -0,0 +1,277 @@
+"""
+Video ingest of PhenoScan Cassava.
+
+Description:
+    Measures the plants of turntable or walk-by recordings. A source is a
+    video file, a folder of numbered frames, a printf pattern of frame files
+    (frames/frame_%05d.png) or a camera index. The frames are decoded one at
+    a time as a stream, a whole video is never held in memory.
+
+    Frames are sampled at a fixed interval of video time (--every), on scene
+    changes (--scene-change, the mean difference of small colour copies of
+    the frame and the last sampled one) or both. Frames that are not sampled
+    are skipped without decoding them when the sampling allows it.
+
+    The sampled frames are measured on a bounded process pool while the next
+    frames are decoded. With --realtime (always on for a camera) the source is
+    read at its own frame rate and a sampled frame arriving while every worker
+    is busy is dropped, so the analysis never falls behind the source.
+    Without it the reader waits for the workers and every sampled frame is
+    measured. The metrics stream out in frame order with their timestamps.
+
+Usage:
+    python video.py trial1.mp4 trial2.mp4 --every 0.5 --output trial.csv
+    python video.py /path/to/frames --fps 25 --scene-change 5 --output frames.jsonl
+    python video.py 0 --every 1 --workers 2
+"""
+
+
+import argparse
+import csv
+import json
+import os
+import queue
+import sys
+import time
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+
+from batch import _init_worker, add_pipeline_arguments, default_workers, list_image_files, pipeline_params
+from card import process_tracker
+from export import CSV_HEADER, METRIC_KEYS, plain_metrics
+from pipeline import process_decoded_image
+
+
+#frame rate of frame sequences and of videos that do not tell theirs
+DEFAULT_FPS = 30.0
+
+#size of the copies compared for the scene changes, in colour since leaves and soil differ more
+#in colour than in brightness
+SCENE_THUMBNAIL_SIZE = (64, 36)
+
+
+#frames of a source as (index, timestamp in seconds, retrieve), the frames are read as they are iterated
+#retrieve() decodes the current frame, it must be called before the next one is taken
+#source is a video file, a folder of numbered frames, a printf pattern of frames or a camera index
+def read_frames(source, fps=None):
+    if os.path.isdir(source):
+        frame_paths = list_image_files(source)
+        frame_rate = fps or DEFAULT_FPS
+        for index, frame_path in enumerate(frame_paths):
+            yield index, index / frame_rate, lambda frame_path=frame_path: cv2.imread(frame_path)
+        return
+
+    capture = cv2.VideoCapture(int(source) if source.isdigit() else source)
+    if not capture.isOpened():
+        raise ValueError(f"Cannot open video: {source}")
+    try:
+        frame_rate = fps or capture.get(cv2.CAP_PROP_FPS) or DEFAULT_FPS
+        index = 0
+        #grab moves to the next frame without decoding it, retrieve decodes it
+        while capture.grab():
+            yield index, index / frame_rate, lambda: capture.retrieve()[1]
+            index += 1
+    finally:
+        capture.release()
+
+
+#frame rate of a source, the one given or the one of the video
+def source_fps(source, fps=None):
+    if fps or os.path.isdir(source):
+        return fps or DEFAULT_FPS
+    capture = cv2.VideoCapture(int(source) if source.isdigit() else source)
+    try:
+        return capture.get(cv2.CAP_PROP_FPS) or DEFAULT_FPS
+    finally:
+        capture.release()
+
+
+def _scene_thumbnail(frame):
+    return cv2.resize(frame, SCENE_THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA).astype(np.int16)
+
+
+#sampled frames of read_frames as (index, timestamp, frame)
+#every: seconds of video between two sampled frames, scene_change: mean difference (0 to 255) of the
+#thumbnails of a frame and the last sampled one above which the frame is sampled
+#without either every frame is sampled, with both a frame is sampled when one of them says so
+def sample_frames(frames, every=None, scene_change=None):
+    next_time = 0.0
+    last_thumbnail = None
+    for index, timestamp, retrieve in frames:
+        due = every is None or timestamp >= next_time - 1e-9
+        if scene_change is None:
+            if not due:
+                #skipped without decoding it
+                continue
+            frame = retrieve()
+        else:
+            #the scene change needs every frame decoded
+            frame = retrieve()
+            if frame is None:
+                continue
+            thumbnail = _scene_thumbnail(frame)
+            changed = last_thumbnail is None or np.abs(thumbnail - last_thumbnail).mean() > scene_change
+            if not (changed or (every is not None and due)):
+                continue
+            last_thumbnail = thumbnail
+        if frame is None:
+            continue
+        if every is not None:
+            next_time = timestamp + every
+        yield index, timestamp, frame
+
+
+#runs on a worker process, must stay at module level so it can be pickled
+def _process_frame(task):
+    result = {'source': task['source'], 'frame': task['frame'], 'timestamp': task['timestamp'],
+              'metrics': None, 'error': None}
+    try:
+        name = f"{task['source']}#{task['frame']}"
+        _, metrics = process_decoded_image(task.pop('image'), task['params'], name, tile_size=task['tile_size'],
+                                           card_tracker=process_tracker)
+        result['metrics'] = plain_metrics(metrics)
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+    return result
+
+
+#measure the sampled frames of a source on a process pool, yields one result per measured frame in frame order
+#realtime reads the source at its frame rate and drops the sampled frames no worker is free for,
+#stats (a dictionary) receives the counts of read, sampled, dropped and measured frames
+def process_video(source, workers=None, params=None, every=None, scene_change=None, fps=None, realtime=False,
+                  tile_size=None, stats=None):
+    workers = workers or default_workers()
+    stats = stats if stats is not None else {}
+    stats.update({'read': 0, 'sampled': 0, 'dropped': 0, 'measured': 0, 'seconds': 0.0, 'video_seconds': 0.0})
+    frame_rate = source_fps(source, fps)
+    max_in_flight = 2 * workers
+    results = queue.Queue()
+    #results arriving before the frames sent ahead of them wait here
+    finished = {}
+    order = []
+    in_flight = 0
+    start = time.perf_counter()
+
+    def counted(frames):
+        for frame in frames:
+            stats['read'] += 1
+            stats['video_seconds'] = frame[1] + 1 / frame_rate
+            if realtime:
+                #a recording is read no faster than it was recorded, like a camera
+                delay = frame[1] - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            yield frame
+
+    def ready():
+        while order and order[0] in finished:
+            yield finished.pop(order.pop(0))
+
+    pool = Pool(processes=workers, initializer=_init_worker)
+    try:
+        for index, timestamp, frame in sample_frames(counted(read_frames(source, fps)), every, scene_change):
+            stats['sampled'] += 1
+            #take the results already back without waiting
+            while True:
+                try:
+                    result = results.get_nowait()
+                except queue.Empty:
+                    break
+                in_flight -= 1
+                finished[result['frame']] = result
+            if in_flight >= max_in_flight:
+                if realtime:
+                    stats['dropped'] += 1
+                    continue
+                result = results.get()
+                in_flight -= 1
+                finished[result['frame']] = result
+            yield from ready()
+
+            task = {'source': source, 'frame': index, 'timestamp': timestamp, 'image': frame, 'params': params,
+                    'tile_size': tile_size}
+            pool.apply_async(_process_frame, (task,), callback=results.put,
+                             error_callback=lambda error, task=task: results.put(
+                                 {'source': source, 'frame': task['frame'], 'timestamp': task['timestamp'],
+                                  'metrics': None, 'error': f"{type(error).__name__}: {error}"}))
+            order.append(index)
+            in_flight += 1
+            stats['measured'] += 1
+            del frame, task
+        while in_flight:
+            result = results.get()
+            in_flight -= 1
+            finished[result['frame']] = result
+            yield from ready()
+    finally:
+        pool.terminate()
+        stats['seconds'] = time.perf_counter() - start
+
+
+class FrameResultsWriter:
+    #streams the results of process_video to a csv or json lines file, every row is flushed as it is written
+    def __init__(self, path):
+        self.path = path
+        self.jsonl = os.path.splitext(path)[1].lower() in ('.jsonl', '.json')
+        self._file = open(path, 'w', newline='')
+        if not self.jsonl:
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(['Source', 'Frame', 'Timestamp s'] + CSV_HEADER[1:])
+
+    def write(self, result):
+        if self.jsonl:
+            self._file.write(json.dumps(result) + "\n")
+        else:
+            metrics = result['metrics']
+            values = [metrics[key] for key in METRIC_KEYS] if metrics else [''] * len(METRIC_KEYS)
+            self._writer.writerow([result['source'], result['frame'], round(result['timestamp'], 3)] + values)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the plants of video files or frame sequences.")
+    parser.add_argument('sources', nargs='+', help="video files, folders of numbered frames, frame patterns or camera indexes")
+    parser.add_argument('--every', type=float, default=None, help="seconds of video between two sampled frames")
+    parser.add_argument('--scene-change', type=float, default=None,
+                        help="also sample a frame when it differs this much (0-255) from the last sampled one")
+    parser.add_argument('--fps', type=float, default=None, help=f"frame rate of frame sequences (default: {DEFAULT_FPS:g})")
+    parser.add_argument('--realtime', action='store_true',
+                        help="read the source at its frame rate and drop the frames no worker is free for")
+    parser.add_argument('--workers', type=int, default=None, help="number of worker processes (default: all cores)")
+    parser.add_argument('--output', default=None, help="csv or .jsonl file receiving the metrics of every frame")
+    add_pipeline_arguments(parser)
+    args = parser.parse_args(argv)
+
+    writer = FrameResultsWriter(args.output) if args.output else None
+    try:
+        for source in args.sources:
+            stats = {}
+            #a camera is always read live
+            realtime = args.realtime or source.isdigit()
+            try:
+                for result in process_video(source, args.workers, pipeline_params(args), args.every, args.scene_change,
+                                            args.fps, realtime, args.tile_size, stats):
+                    if writer:
+                        writer.write(result)
+                    metrics = result['metrics']
+                    area = f"{metrics['leaf_area_cm2']:.2f} cm2" if metrics else result['error'] or "not measured"
+                    print(f"{source} frame {result['frame']} at {result['timestamp']:.2f}s: {area}")
+            except ValueError as e:
+                print(e, file=sys.stderr)
+                continue
+            speed = stats['video_seconds'] / stats['seconds'] if stats['seconds'] else 0
+            print(f"{source}: {stats['read']} frames read, {stats['sampled']} sampled, {stats['dropped']} dropped, "
+                  f"{stats['measured']} measured, {speed:.2f}x the speed of the video")
+    finally:
+        if writer:
+            writer.close()
+            print("Results written to:", args.output)
+
+
+if __name__ == "__main__":
+    main()
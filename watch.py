@@ -0,0 +1,261 @@
+"""
+Watch mode of PhenoScan Cassava.
+
+Description:
+    Processes the images of a folder while the imaging station writes them.
+    The folder is scanned a few times per second, and when watchdog is
+    installed its file events wake the scan up as soon as a file is closed.
+    A file is processed once it is completely written: its size and
+    modification time stopped changing and the trailer of its format is there.
+
+    Results go to the results file of the folder, whose manifest makes sure
+    every image is processed once, also across restarts of the station.
+
+Usage:
+    python watch.py /path/to/folder --workers 4 --store /path/to/store
+"""
+
+
+import argparse
+import os
+import queue
+import threading
+import time
+from multiprocessing import Pool
+
+from batch import (IMAGE_EXTENSIONS, _failed_result, _init_worker, _prepare, _process_task, _record, _task_options,
+                   add_pipeline_arguments, default_workers, natural_sort_key, pipeline_params)
+from cache import ResultStore
+from export import EXPORT_FORMATS, RESULT_FORMATS, ResultsWriter, session_results_path
+from pipeline import PREVIEW_SIZES
+
+
+#seconds between two scans of the folder
+DEFAULT_POLL_INTERVAL = 0.2
+
+#a file unchanged for that long is complete even if its trailer was not recognised
+DEFAULT_SETTLE_TIME = 2.0
+
+#a folder modified less than that long ago is scanned again, coarse timestamps
+#of network shares can hide a file created right after the previous scan
+FOLDER_MTIME_SLACK = 2.0
+
+
+#True when the file ends like a complete image of its format
+def looks_complete(path, size):
+    extension = os.path.splitext(path)[1].lower()
+    try:
+        with open(path, 'rb') as f:
+            if extension in ('.jpg', '.jpeg'):
+                f.seek(max(0, size - 2))
+                return f.read(2) == b'\xff\xd9'
+            if extension == '.png':
+                f.seek(max(0, size - 12))
+                return f.read(12)[4:8] == b'IEND'
+            if extension == '.gif':
+                f.seek(max(0, size - 1))
+                return f.read(1) == b';'
+            if extension == '.bmp':
+                header = f.read(6)
+                return header[:2] == b'BM' and int.from_bytes(header[2:6], 'little') <= size
+    except OSError:
+        #still locked by the writer on windows
+        return False
+    return False
+
+
+class FolderWatcher:
+    #finds the images of a folder that are completely written and were not returned before
+    #skip holds image paths already processed, they are never returned
+    def __init__(self, folder_path, skip=(), settle_time=DEFAULT_SETTLE_TIME):
+        self.folder_path = folder_path
+        self.settle_time = settle_time
+        self._done = set(skip)
+        #image path -> (size, mtime_ns) of the last scan and since when it is unchanged
+        self._pending = {}
+        #image paths closed by their writer, filled by the watchdog thread
+        self._closed = set()
+        self._lock = threading.Lock()
+        self._folder_mtime_ns = None
+        self._observer = None
+
+    #the folder is only listed again when it changed
+    def _folder_changed(self):
+        stat = os.stat(self.folder_path)
+        changed = stat.st_mtime_ns != self._folder_mtime_ns or time.time() - stat.st_mtime < FOLDER_MTIME_SLACK
+        self._folder_mtime_ns = stat.st_mtime_ns
+        return changed
+
+    #image paths that became ready since the previous call, in natural order
+    def poll(self):
+        now = time.monotonic()
+        if self._folder_changed():
+            with os.scandir(self.folder_path) as entries:
+                for entry in entries:
+                    if not entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                        continue
+                    image_path = os.path.join(self.folder_path, entry.name)
+                    if image_path not in self._done and image_path not in self._pending:
+                        self._pending[image_path] = None
+        with self._lock:
+            closed, self._closed = self._closed, set()
+
+        ready = []
+        #only the files still being written are looked at again
+        for image_path, previous in list(self._pending.items()):
+            try:
+                stat = os.stat(image_path)
+            except FileNotFoundError:
+                del self._pending[image_path]
+                continue
+            state = (stat.st_size, stat.st_mtime_ns)
+            if previous is None or previous[0] != state:
+                self._pending[image_path] = (state, now)
+                #a closed file is ready at once, it is not written any more
+                if not (image_path in closed and stat.st_size and looks_complete(image_path, stat.st_size)):
+                    continue
+            elif not stat.st_size:
+                continue
+            elif not looks_complete(image_path, stat.st_size) and now - previous[1] < self.settle_time:
+                continue
+            del self._pending[image_path]
+            self._done.add(image_path)
+            ready.append(image_path)
+        ready.sort(key=lambda image_path: natural_sort_key(os.path.basename(image_path)))
+        return ready
+
+    #wake(): called from the watchdog thread when a file is created, moved in or closed
+    #returns False when watchdog is not installed, polling alone then finds the files
+    def start(self, wake=None):
+        try:
+            from watchdog.events import FileSystemEventHandler
+            from watchdog.observers import Observer
+        except ImportError:
+            return False
+
+        watcher = self
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                if event.is_directory or event.event_type not in ('created', 'moved', 'closed'):
+                    return
+                if event.event_type == 'closed':
+                    with watcher._lock:
+                        watcher._closed.add(os.path.join(watcher.folder_path, os.path.basename(event.src_path)))
+                if wake:
+                    wake()
+
+        self._observer = Observer()
+        self._observer.schedule(Handler(), self.folder_path, recursive=False)
+        self._observer.start()
+        return True
+
+    def stop(self):
+        if self._observer:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+
+
+#process the images of a folder as they are written until stop_event is set
+#yields the same result dictionaries as batch.process_batch, as soon as each image finishes
+#images in skip (e.g. recorded on the results file) are not processed
+#once stop_event is set, the images already sent to the workers are finished first
+def watch_folder(folder_path, stop_event, workers=None, params=None, store=None, skip=(), output_dir=None,
+                 preview_sizes=PREVIEW_SIZES, return_image=True, output_format='jpeg', output_quality=None,
+                 profile=False, poll_interval=DEFAULT_POLL_INTERVAL, settle_time=DEFAULT_SETTLE_TIME, tile_size=None):
+    workers = workers or default_workers()
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    options = _task_options(params, output_dir, store, preview_sizes, return_image, output_format, output_quality, profile,
+                            tile_size)
+
+    #finished results and wake ups (None) of the watchdog thread
+    events = queue.Queue()
+    watcher = FolderWatcher(folder_path, skip, settle_time)
+    watcher.start(wake=lambda: events.put(None))
+    in_flight = 0
+    try:
+        #the pool stays up for the whole session, a new image is sent to it as soon as it is ready
+        with Pool(processes=workers, initializer=_init_worker) as pool:
+            while True:
+                if not stop_event.is_set():
+                    for image_path in watcher.poll():
+                        stored, task = _prepare(image_path, store, options)
+                        if stored is not None:
+                            yield stored
+                            continue
+                        pool.apply_async(_process_task, (task,), callback=events.put,
+                                         error_callback=lambda error, task=task: events.put(_failed_result(task, error)))
+                        in_flight += 1
+                elif not in_flight:
+                    return
+
+                try:
+                    item = events.get(timeout=poll_interval)
+                except queue.Empty:
+                    continue
+                while item is not None or not events.empty():
+                    if item is not None:
+                        in_flight -= 1
+                        _record(store, item)
+                        yield item
+                    try:
+                        item = events.get_nowait()
+                    except queue.Empty:
+                        break
+    finally:
+        watcher.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Process the images of a folder while they are written.")
+    parser.add_argument('folder', help="folder the imaging station writes to")
+    parser.add_argument('--workers', type=int, default=None, help="number of worker processes (default: all cores)")
+    parser.add_argument('--output', default=None, help="folder to save the processed images to")
+    parser.add_argument('--format', default='jpeg', choices=list(EXPORT_FORMATS), help="format of the processed images")
+    parser.add_argument('--quality', type=int, default=None, help="JPEG/WebP quality or PNG compression level")
+    parser.add_argument('--results', default=None, help="results file (default: the session file of the folder, like the GUI)")
+    parser.add_argument('--results-format', default=None, choices=RESULT_FORMATS, help="csv, jsonl or parquet (default: from the extension)")
+    add_pipeline_arguments(parser)
+    parser.add_argument('--store', default=None, help="result store folder, images already stored are not processed again")
+    parser.add_argument('--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL, help="seconds between two scans of the folder")
+    args = parser.parse_args(argv)
+
+    store = ResultStore(args.store) if args.store else None
+    params = pipeline_params(args)
+    results_path = args.results or session_results_path(args.folder)
+    #every result reaches the disk right away, the station writes a few images per second at most
+    results_writer = ResultsWriter(results_path, args.results_format, params, sync_every=1)
+    recorded = results_writer.recorded()
+    print(f"Watching {args.folder}, {len(recorded)} images already recorded on {results_path} (Ctrl+C to stop)")
+
+    stop_event = threading.Event()
+    results = watch_folder(args.folder, stop_event, args.workers, params, store, skip=recorded, output_dir=args.output,
+                           preview_sizes=PREVIEW_SIZES if store else (), return_image=False,
+                           output_format=args.format, output_quality=args.quality, poll_interval=args.poll_interval,
+                           tile_size=args.tile_size)
+    count = 0
+    try:
+        for result in results:
+            image_path = result['image_path']
+            if result['error']:
+                print(f"{image_path}: {result['error']}")
+                continue
+            results_writer.write(image_path, result['metrics'])
+            count += 1
+            #time from the last write of the file to its recorded metrics
+            latency = time.time() - os.path.getmtime(image_path)
+            print(f"[{count}] {image_path} ({latency:.2f}s after it was written)")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        results.close()
+        results_writer.close()
+        if store:
+            store.close()
+        print(f"Processed {count} images, results written to: {results_path}")
+
+
+if __name__ == "__main__":
+    main()